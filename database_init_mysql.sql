@@ -74,6 +74,47 @@ CREATE TABLE `failed_emails` (
     KEY `idx_mail_from` (`mail_from`(100))
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='解析失败邮件记录表';
 
+-- 统计计数器表（由程序在保存/删除邮件时增量维护）
+DROP TABLE IF EXISTS `email_stats`;
+CREATE TABLE `email_stats` (
+    `stat_key` varchar(64) NOT NULL COMMENT '计数器名称',
+    `stat_value` bigint NOT NULL DEFAULT '0' COMMENT '计数值',
+    `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`stat_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='统计计数器表';
+
+-- 按天汇总表
+DROP TABLE IF EXISTS `email_stats_daily`;
+CREATE TABLE `email_stats_daily` (
+    `stat_date` date NOT NULL COMMENT '日期',
+    `emails` int NOT NULL DEFAULT '0' COMMENT '邮件数',
+    `attachments` int NOT NULL DEFAULT '0' COMMENT '附件数',
+    `bytes` bigint NOT NULL DEFAULT '0' COMMENT '邮件总大小',
+    PRIMARY KEY (`stat_date`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='按天统计表';
+
+-- 按收件域名汇总表
+DROP TABLE IF EXISTS `email_stats_domains`;
+CREATE TABLE `email_stats_domains` (
+    `domain` varchar(255) NOT NULL COMMENT '收件域名',
+    `emails` int NOT NULL DEFAULT '0' COMMENT '邮件数',
+    `last_timestamp` bigint NOT NULL DEFAULT '0' COMMENT '最近收件时间',
+    PRIMARY KEY (`domain`),
+    KEY `idx_emails` (`emails`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='按域名统计表';
+
+-- 按收件人汇总表
+DROP TABLE IF EXISTS `email_stats_recipients`;
+CREATE TABLE `email_stats_recipients` (
+    `recipient_email` varchar(255) NOT NULL COMMENT '收件人邮箱',
+    `domain` varchar(255) NOT NULL COMMENT '收件域名',
+    `emails` int NOT NULL DEFAULT '0' COMMENT '邮件数',
+    `last_timestamp` bigint NOT NULL DEFAULT '0' COMMENT '最近收件时间',
+    PRIMARY KEY (`recipient_email`),
+    KEY `idx_domain` (`domain`),
+    KEY `idx_emails` (`emails`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='按收件人统计表';
+
 -- 创建用于快速查询某个邮箱收到的邮件的视图
 DROP VIEW IF EXISTS `email_summary`;
 CREATE VIEW `email_summary` AS
@@ -15,6 +15,39 @@ fi
 
 echo ' [+] Starting nginx'
 
+# /json/ and /api/raw-html/ are answered by the mailserver if READAPI_PORT is set, PHP handles
+# whatever it refuses (session logins, ALLOWED_IPS) or when it's not running
+mkdir -p /etc/nginx/opentrashmail
+if [[ ${READAPI_PORT:-0} -gt 0 ]]; then
+  cat > /etc/nginx/opentrashmail/readapi.conf <<EOF
+location /json/ {
+    proxy_pass http://127.0.0.1:${READAPI_PORT};
+    proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+    proxy_intercept_errors on;
+    error_page 401 403 500 502 503 504 = @php;
+}
+location /api/raw-html/ {
+    proxy_pass http://127.0.0.1:${READAPI_PORT}/html/;
+    proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+    proxy_intercept_errors on;
+    error_page 401 403 500 502 503 504 = @php;
+}
+location @php {
+    rewrite ^ /index.php last;
+}
+location ~ ^/(events|wait)/ {
+    proxy_pass http://127.0.0.1:${READAPI_PORT};
+    proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+    proxy_http_version 1.1;
+    proxy_set_header Connection "";
+    proxy_buffering off;
+    proxy_read_timeout 1h;
+}
+EOF
+else
+  rm -f /etc/nginx/opentrashmail/readapi.conf
+fi
+
 mkdir -p /var/log/nginx/opentrashmail
 touch /var/log/nginx/opentrashmail/web.access.log
 touch /var/log/nginx/opentrashmail/web.error.log
@@ -33,6 +66,9 @@ _buildConfig() {
     echo "URL=${URL:-http://localhost:8080}"
     echo "PASSWORD=${PASSWORD:-}"
     echo "ALLOWED_IPS=${ALLOWED_IPS:-}"
+    echo "DATA_LAYOUT=${DATA_LAYOUT:-flat}"
+    echo "FEED_ITEMS=${FEED_ITEMS:-0}"
+    echo "HTML_CACHE_SIZE=${HTML_CACHE_SIZE:-0}"
     echo ""
     echo "[MAILSERVER]"
     echo "MAILPORT=${MAILPORT:-25}"
@@ -41,6 +77,28 @@ _buildConfig() {
     echo "MAILPORT_TLS=${MAILPORT_TLS:-0}"
     echo "TLS_CERTIFICATE=${TLS_CERTIFICATE:-}"
     echo "TLS_PRIVATE_KEY=${TLS_PRIVATE_KEY:-0}"
+    echo "TLS_SESSION_TICKETS=${TLS_SESSION_TICKETS:-true}"
+    echo "TLS_NUM_TICKETS=${TLS_NUM_TICKETS:-2}"
+    echo "TLS_CIPHERS=${TLS_CIPHERS:-}"
+    echo "TLS_PREFER_SERVER_CIPHERS=${TLS_PREFER_SERVER_CIPHERS:-true}"
+    echo "TLS_ECDH_CURVE=${TLS_ECDH_CURVE:-}"
+    echo "TLS_MINIMUM_VERSION=${TLS_MINIMUM_VERSION:-}"
+    echo "WORKERS=${WORKERS:-1}"
+    echo "SHUTDOWN_TIMEOUT=${SHUTDOWN_TIMEOUT:-8}"
+    echo "METRICS_PORT=${METRICS_PORT:-0}"
+    echo "METRICS_HOST=${METRICS_HOST:-127.0.0.1}"
+    echo "DURABILITY=${DURABILITY:-none}"
+    echo "READAPI_PORT=${READAPI_PORT:-0}"
+    echo "READAPI_HOST=127.0.0.1"
+    echo "READAPI_CACHE_SIZE=${READAPI_CACHE_SIZE:-1000}"
+    echo "GROUP_COMMIT_MS=${GROUP_COMMIT_MS:-10}"
+    echo "RATELIMIT_MAX_CONNECTIONS=${RATELIMIT_MAX_CONNECTIONS:-0}"
+    echo "RATELIMIT_CONNECTIONS=${RATELIMIT_CONNECTIONS:-0}"
+    echo "RATELIMIT_MESSAGES=${RATELIMIT_MESSAGES:-0}"
+    echo "RATELIMIT_RECIPIENTS=${RATELIMIT_RECIPIENTS:-0}"
+    echo "RATELIMIT_PREFIX_MESSAGES=${RATELIMIT_PREFIX_MESSAGES:-0}"
+    echo "RATELIMIT_MAX_TRACKED=${RATELIMIT_MAX_TRACKED:-10000}"
+    echo "RATELIMIT_EXEMPT=${RATELIMIT_EXEMPT:-127.0.0.1,::1}"
     echo ""
     echo "[DATETIME]"
     echo "DATEFORMAT=${DATEFORMAT:-D.M.YYYY HH:mm}"
@@ -62,4 +120,5 @@ _buildConfig() {
 _buildConfig > /var/www/opentrashmail/config.ini
 
 echo ' [+] Starting Mailserver'
-su - nginx -s /bin/ash -c 'cd /var/www/opentrashmail/python;python3 -u mailserver3.py >> /var/www/opentrashmail/logs/mailserver.log 2>&1 '
+# exec so "docker stop" delivers SIGTERM to the mailserver and it can drain in-flight mail
+exec su - nginx -s /bin/ash -c 'cd /var/www/opentrashmail/python;exec python3 -u mailserver3.py >> /var/www/opentrashmail/logs/mailserver.log 2>&1 '
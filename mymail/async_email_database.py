@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+异步邮件数据库操作类
+基于 aiomysql 连接池，供运行在 asyncio 中的 SMTP 处理器直接 await 使用
+"""
+
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional
+
+import aiomysql
+
+from email_database import (
+    EMAILS_BY_RECIPIENT_SQL, EMAIL_BY_ID_SQL, EMAIL_RECIPIENTS_SQL,
+    EMAIL_ATTACHMENTS_SQL, STATS_SQL, STATS_KEYS,
+    save_email_statements, save_failed_email_statements,
+)
+
+logger = logging.getLogger(__name__)
+
+class AsyncEmailDatabase:
+    """
+    异步邮件数据库操作类
+    
+    方法与 EmailDatabase 一致（save_email、save_failed_email、
+    get_emails_by_recipient、get_email_by_id、get_stats），SQL 语句也与之共用。
+    表结构由 EmailDatabase 负责初始化。
+    
+    连接池在第一次调用时于当前事件循环中创建，多个并发SMTP会话共享少量连接。
+    连接为自动提交模式，写操作在 _run_transaction 中显式开启事务；
+    否则只读查询留下未结束的事务，归还时连接池会关闭该连接而不是复用。
+    """
+    
+    def __init__(self, host: str = "localhost", port: int = 3306,
+                 database: str = "tempmail", user: str = "root", password: str = "",
+                 partition_by: Optional[str] = None, minsize: int = 1, maxsize: int = 10):
+        """
+        初始化异步数据库配置（不立即连接）
+        
+        Args:
+            host: MySQL服务器地址
+            port: MySQL端口
+            database: 数据库名
+            user: 用户名
+            password: 密码
+            partition_by: 邮件表的分区方式，需与 EmailDatabase 初始化时一致
+            minsize: 连接池最小连接数
+            maxsize: 连接池最大连接数
+        """
+        self.host = host
+        self.port = port
+        self.database = database
+        self.user = user
+        self.password = password
+        self.partition_by = partition_by
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._pool = None
+        self._pool_lock = None
+    
+    async def get_pool(self):
+        """获取连接池（首次调用时创建）"""
+        if self._pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await aiomysql.create_pool(
+                        host=self.host,
+                        port=self.port,
+                        db=self.database,
+                        user=self.user,
+                        password=self.password,
+                        charset='utf8mb4',
+                        init_command="SET NAMES utf8mb4 COLLATE utf8mb4_unicode_ci",
+                        minsize=self.minsize,
+                        maxsize=self.maxsize,
+                        autocommit=True
+                    )
+                    logger.info(f"✅ 异步连接池已创建: {self.host}:{self.port}/{self.database} (最大 {self.maxsize} 个连接)")
+        return self._pool
+    
+    async def close(self):
+        """关闭连接池"""
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+    
+    async def _run_statements(self, cursor, statements):
+        """执行SQL语句生成器（见 EmailDatabase._run_statements）"""
+        try:
+            sql, params = next(statements)
+            while True:
+                await cursor.execute(sql, params)
+                sql, params = statements.send(cursor)
+        except StopIteration as e:
+            return e.value
+    
+    async def _run_transaction(self, statements):
+        """在一个事务中执行语句生成器，失败时回滚"""
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    result = await self._run_statements(cursor, statements)
+                await conn.commit()
+                return result
+            except Exception:
+                await conn.rollback()
+                raise
+    
+    async def save_email(self, email_data: Dict[str, Any]) -> Optional[int]:
+        """
+        保存邮件到数据库
+        
+        Args:
+            email_data: 邮件数据字典
+        
+        Returns:
+            保存成功返回邮件ID，失败返回None
+        """
+        try:
+            email_id = await self._run_transaction(save_email_statements(email_data, self.partition_by))
+            logger.info(f"✅ 邮件已保存到数据库，ID: {email_id}")
+            return email_id
+        
+        except Exception as e:
+            logger.error(f"❌ 保存邮件到数据库失败: {e}")
+            return None
+    
+    async def save_failed_email(self, sender_ip: str, mail_from: str,
+                                raw_content: bytes, error_message: str) -> Optional[int]:
+        """
+        保存解析失败的邮件
+        
+        Args:
+            sender_ip: 发送者IP
+            mail_from: 发件人
+            raw_content: 原始邮件内容
+            error_message: 错误信息
+        
+        Returns:
+            保存成功返回记录ID，失败返回None
+        """
+        try:
+            record_id = await self._run_transaction(
+                save_failed_email_statements(sender_ip, mail_from, raw_content, error_message))
+            logger.info(f"✅ 失败邮件已保存到数据库，ID: {record_id}")
+            return record_id
+        
+        except Exception as e:
+            logger.error(f"❌ 保存失败邮件到数据库失败: {e}")
+            return None
+    
+    async def get_emails_by_recipient(self, recipient_email: str,
+                                      limit: int = 50, offset: int = 0) -> List[Dict]:
+        """
+        根据收件人邮箱查询邮件
+        
+        Args:
+            recipient_email: 收件人邮箱
+            limit: 限制返回数量
+            offset: 偏移量
+        
+        Returns:
+            邮件列表
+        """
+        try:
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(EMAILS_BY_RECIPIENT_SQL, (recipient_email, limit, offset))
+                    return list(await cursor.fetchall())
+        
+        except Exception as e:
+            logger.error(f"❌ 查询邮件失败: {e}")
+            return []
+    
+    async def get_email_by_id(self, email_id: int) -> Optional[Dict]:
+        """
+        根据ID获取邮件详情
+        
+        Args:
+            email_id: 邮件ID
+        
+        Returns:
+            邮件详情字典，不存在返回None
+        """
+        try:
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cursor:
+                    await cursor.execute(EMAIL_BY_ID_SQL, (email_id,))
+                    email_dict = await cursor.fetchone()
+                    if not email_dict:
+                        return None
+                    
+                    await cursor.execute(EMAIL_RECIPIENTS_SQL, (email_id,))
+                    email_dict['recipients'] = [row['recipient_email'] for row in await cursor.fetchall()]
+                    
+                    await cursor.execute(EMAIL_ATTACHMENTS_SQL, (email_id,))
+                    email_dict['attachments'] = list(await cursor.fetchall())
+                    
+                    return email_dict
+        
+        except Exception as e:
+            logger.error(f"❌ 获取邮件详情失败: {e}")
+            return None
+    
+    async def get_stats(self) -> Dict[str, int]:
+        """
+        获取数据库统计信息（读取增量维护的计数器）
+        
+        Returns:
+            统计信息字典
+        """
+        try:
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(STATS_SQL)
+                    stats = {key: 0 for key in STATS_KEYS}
+                    for key, value in await cursor.fetchall():
+                        stats[key] = int(value)
+                    return stats
+        
+        except Exception as e:
+            logger.error(f"❌ 获取统计信息失败: {e}")
+            return {}
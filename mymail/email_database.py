@@ -7,8 +7,8 @@
 import mysql.connector
 import os
 import logging
-from typing import List, Dict, Any, Optional
-from datetime import datetime
+from typing import List, Dict, Any, Optional, Iterator
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +16,8 @@ class EmailDatabase:
     """邮件数据库操作类"""
     
     def __init__(self, host: str = "localhost", port: int = 3306, 
-                 database: str = "tempmail", user: str = "root", password: str = ""):
+                 database: str = "tempmail", user: str = "root", password: str = "",
+                 partition_by: Optional[str] = None, partitions_ahead: int = 7):
         """
         初始化数据库连接
         
@@ -26,12 +27,18 @@ class EmailDatabase:
             database: 数据库名
             user: 用户名
             password: 密码
+            partition_by: 按 'day' 或 'week' 对邮件表做范围分区，None 表示不分区
+            partitions_ahead: 预先创建的未来分区数量
         """
+        if partition_by not in PARTITION_PERIODS and partition_by is not None:
+            raise ValueError(f"不支持的分区方式: {partition_by}")
         self.host = host
         self.port = port
         self.database = database
         self.user = user
         self.password = password
+        self.partition_by = partition_by
+        self.partitions_ahead = partitions_ahead
         self.init_database()
     
     def get_connection(self):
@@ -50,77 +57,134 @@ class EmailDatabase:
         """初始化数据库，创建必要的表"""
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
+            try:
+                cursor = conn.cursor()
             
-            # 创建邮件主表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS emails (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    timestamp DECIMAL(15,6) NOT NULL,
-                    datetime VARCHAR(32) NOT NULL,
-                    sender_ip VARCHAR(45),
-                    mail_from VARCHAR(255) NOT NULL,
-                    subject TEXT,
-                    plaintext_body LONGTEXT,
-                    html_body LONGTEXT,
-                    raw_content LONGBLOB,
-                    raw_size INT DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_timestamp (timestamp),
-                    INDEX idx_datetime (datetime),
-                    INDEX idx_mail_from (mail_from(100))
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+                if self.partition_by:
+                    self._create_partitioned_tables(cursor)
             
-            # 创建收件人表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS email_recipients (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    email_id INT NOT NULL,
-                    recipient_email VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE,
-                    INDEX idx_email_id (email_id),
-                    INDEX idx_recipient_email (recipient_email)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+                # 创建邮件主表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS emails (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        timestamp DECIMAL(15,6) NOT NULL,
+                        datetime VARCHAR(32) NOT NULL,
+                        sender_ip VARCHAR(45),
+                        mail_from VARCHAR(255) NOT NULL,
+                        subject TEXT,
+                        plaintext_body LONGTEXT,
+                        html_body LONGTEXT,
+                        raw_content LONGBLOB,
+                        raw_size INT DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        INDEX idx_timestamp (timestamp),
+                        INDEX idx_datetime (datetime),
+                        INDEX idx_mail_from (mail_from(100))
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
             
-            # 创建附件表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS email_attachments (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    email_id INT NOT NULL,
-                    filename VARCHAR(255) NOT NULL,
-                    content_type VARCHAR(100),
-                    file_size INT DEFAULT 0,
-                    file_path VARCHAR(500),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE,
-                    INDEX idx_email_id (email_id),
-                    INDEX idx_filename (filename)
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+                # 创建收件人表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_recipients (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        email_id INT NOT NULL,
+                        recipient_email VARCHAR(255) NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE,
+                        INDEX idx_email_id (email_id),
+                        INDEX idx_recipient_email (recipient_email)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
             
-            # 创建失败邮件记录表
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS failed_emails (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    timestamp DECIMAL(15,6) NOT NULL,
-                    datetime VARCHAR(32) NOT NULL,
-                    sender_ip VARCHAR(45),
-                    mail_from VARCHAR(255),
-                    raw_content LONGBLOB,
-                    error_message TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    INDEX idx_timestamp (timestamp),
-                    INDEX idx_mail_from (mail_from(100))
-                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
-            """)
+                # 创建附件表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_attachments (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        email_id INT NOT NULL,
+                        filename VARCHAR(255) NOT NULL,
+                        content_type VARCHAR(100),
+                        file_size INT DEFAULT 0,
+                        file_path VARCHAR(500),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE,
+                        INDEX idx_email_id (email_id),
+                        INDEX idx_filename (filename)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
             
-            # MySQL表已包含索引定义，无需单独创建
+                # 创建失败邮件记录表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS failed_emails (
+                        id INT AUTO_INCREMENT PRIMARY KEY,
+                        timestamp DECIMAL(15,6) NOT NULL,
+                        datetime VARCHAR(32) NOT NULL,
+                        sender_ip VARCHAR(45),
+                        mail_from VARCHAR(255),
+                        raw_content LONGBLOB,
+                        error_message TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        INDEX idx_timestamp (timestamp),
+                        INDEX idx_mail_from (mail_from(100))
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
             
-            conn.commit()
-            conn.close()
+                # 统计计数器表（按键存放总量，O(1)读取）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_stats (
+                        stat_key VARCHAR(64) PRIMARY KEY,
+                        stat_value BIGINT NOT NULL DEFAULT 0,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+            
+                # 按天汇总表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_stats_daily (
+                        stat_date DATE PRIMARY KEY,
+                        emails INT NOT NULL DEFAULT 0,
+                        attachments INT NOT NULL DEFAULT 0,
+                        bytes BIGINT NOT NULL DEFAULT 0
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+            
+                # 按收件域名汇总表
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_stats_domains (
+                        domain VARCHAR(255) PRIMARY KEY,
+                        emails INT NOT NULL DEFAULT 0,
+                        last_timestamp BIGINT NOT NULL DEFAULT 0,
+                        INDEX idx_emails (emails)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+            
+                # 按收件人汇总表（行数即唯一收件人数）
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS email_stats_recipients (
+                        recipient_email VARCHAR(255) PRIMARY KEY,
+                        domain VARCHAR(255) NOT NULL,
+                        emails INT NOT NULL DEFAULT 0,
+                        last_timestamp BIGINT NOT NULL DEFAULT 0,
+                        INDEX idx_domain (domain),
+                        INDEX idx_emails (emails)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+            
+                # MySQL表已包含索引定义，无需单独创建
+            
+                conn.commit()
+            
+                # 首次升级时根据现有数据初始化统计表
+                cursor.execute("SELECT COUNT(*) FROM email_stats")
+                needs_rebuild = cursor.fetchone()[0] == 0
+            finally:
+                # 建表中途出错时也要释放连接
+                conn.close()
+            
+            if needs_rebuild:
+                self.rebuild_stats()
+            
+            if self.partition_by:
+                self.ensure_partitions()
             
             logger.info(f"✅ 数据库初始化成功: {self.host}:{self.port}/{self.database}")
             
@@ -142,50 +206,7 @@ class EmailDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # 插入邮件主记录
-            cursor.execute("""
-                INSERT INTO emails (
-                    timestamp, datetime, sender_ip, mail_from, subject,
-                    plaintext_body, html_body, raw_content, raw_size
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                email_data.get('timestamp'),
-                email_data.get('datetime'),
-                email_data.get('sender_ip'),
-                email_data.get('from'),
-                email_data.get('subject'),
-                email_data.get('plaintext_body'),
-                email_data.get('html_body'),
-                email_data.get('raw_content'),  # 原始邮件内容
-                email_data.get('raw_size', 0)
-            ))
-            
-            email_id = cursor.lastrowid
-            
-            # 插入收件人记录
-            recipients = email_data.get('to', [])
-            if isinstance(recipients, str):
-                recipients = [recipients]
-            
-            for recipient in recipients:
-                cursor.execute("""
-                    INSERT INTO email_recipients (email_id, recipient_email)
-                    VALUES (%s, %s)
-                """, (email_id, recipient))
-            
-            # 插入附件记录
-            attachments = email_data.get('attachments', [])
-            for attachment in attachments:
-                cursor.execute("""
-                    INSERT INTO email_attachments (
-                        email_id, filename, content_type, file_size
-                    ) VALUES (%s, %s, %s, %s)
-                """, (
-                    email_id,
-                    attachment.get('filename'),
-                    attachment.get('content_type'),
-                    attachment.get('size', 0)
-                ))
+            email_id = self._run_statements(cursor, save_email_statements(email_data, self.partition_by))
             
             conn.commit()
             conn.close()
@@ -215,25 +236,8 @@ class EmailDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            now = datetime.now()
-            timestamp = now.timestamp()
-            datetime_str = now.isoformat()
-            
-            cursor.execute("""
-                INSERT INTO failed_emails (
-                    timestamp, datetime, sender_ip, mail_from, 
-                    raw_content, error_message
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                timestamp,
-                datetime_str,
-                sender_ip,
-                mail_from,
-                raw_content,
-                error_message
-            ))
-            
-            record_id = cursor.lastrowid
+            record_id = self._run_statements(
+                cursor, save_failed_email_statements(sender_ip, mail_from, raw_content, error_message))
             
             conn.commit()
             conn.close()
@@ -262,20 +266,7 @@ class EmailDatabase:
             conn = self.get_connection()
             cursor = conn.cursor(dictionary=True)  # 使结果可以按列名访问
             
-            cursor.execute("""
-                SELECT e.*, GROUP_CONCAT(er.recipient_email) as recipients,
-                       COUNT(ea.id) as attachment_count
-                FROM emails e
-                LEFT JOIN email_recipients er ON e.id = er.email_id
-                LEFT JOIN email_attachments ea ON e.id = ea.email_id
-                WHERE e.id IN (
-                    SELECT DISTINCT email_id FROM email_recipients 
-                    WHERE recipient_email = %s
-                )
-                GROUP BY e.id
-                ORDER BY e.timestamp DESC
-                LIMIT %s OFFSET %s
-            """, (recipient_email, limit, offset))
+            cursor.execute(EMAILS_BY_RECIPIENT_SQL, (recipient_email, limit, offset))
             
             rows = cursor.fetchall()
             conn.close()
@@ -302,7 +293,7 @@ class EmailDatabase:
             cursor = conn.cursor(dictionary=True)
             
             # 获取邮件基本信息
-            cursor.execute("SELECT * FROM emails WHERE id = %s", (email_id,))
+            cursor.execute(EMAIL_BY_ID_SQL, (email_id,))
             email = cursor.fetchone()
             
             if not email:
@@ -312,27 +303,12 @@ class EmailDatabase:
             email_dict = email
             
             # 获取收件人列表
-            cursor.execute("""
-                SELECT recipient_email FROM email_recipients 
-                WHERE email_id = %s
-            """, (email_id,))
-            recipients = [row[0] for row in cursor.fetchall()]
-            email_dict['recipients'] = recipients
+            cursor.execute(EMAIL_RECIPIENTS_SQL, (email_id,))
+            email_dict['recipients'] = [row['recipient_email'] for row in cursor.fetchall()]
             
             # 获取附件列表
-            cursor.execute("""
-                SELECT filename, content_type, file_size 
-                FROM email_attachments 
-                WHERE email_id = %s
-            """, (email_id,))
-            attachments = []
-            for row in cursor.fetchall():
-                attachments.append({
-                    'filename': row[0],
-                    'content_type': row[1],
-                    'size': row[2]
-                })
-            email_dict['attachments'] = attachments
+            cursor.execute(EMAIL_ATTACHMENTS_SQL, (email_id,))
+            email_dict['attachments'] = cursor.fetchall()
             
             conn.close()
             return email_dict
@@ -355,9 +331,9 @@ class EmailDatabase:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute("DELETE FROM emails WHERE id = %s", (email_id,))
+            deleted = self._delete_batch(cursor, [email_id])
             
-            if cursor.rowcount > 0:
+            if deleted > 0:
                 conn.commit()
                 conn.close()
                 logger.info(f"✅ 邮件 {email_id} 已删除")
@@ -371,34 +347,234 @@ class EmailDatabase:
             logger.error(f"❌ 删除邮件失败: {e}")
             return False
     
-    def get_stats(self) -> Dict[str, int]:
+    def delete_emails(self, ids: Optional[List[int]] = None, recipient: Optional[str] = None,
+                      before_ts: Optional[float] = None, batch_size: int = 1000) -> int:
         """
-        获取数据库统计信息
+        批量删除邮件
         
+        多个条件同时给出时取交集。使用同一个连接分批删除，每批一个事务，
+        避免单个大事务长时间持锁。
+        
+        Args:
+            ids: 邮件ID列表
+            recipient: 收件人邮箱
+            before_ts: 删除早于该Unix时间戳的邮件
+            batch_size: 每批删除的数量
+            
         Returns:
-            统计信息字典
+            删除的邮件数量
         """
+        if ids is None and recipient is None and before_ts is None:
+            raise ValueError("delete_emails 至少需要一个筛选条件")
+        
+        where, params = self._email_filter(ids=ids, recipient=recipient, before_ts=before_ts)
+        
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            stats = {}
+            total = 0
+            while True:
+                cursor.execute(f"SELECT e.id FROM emails e {where} LIMIT %s", params + (batch_size,))
+                batch = [row[0] for row in cursor.fetchall()]
+                if not batch:
+                    break
+                total += self._delete_batch(cursor, batch)
+                conn.commit()
             
-            # 总邮件数
-            cursor.execute("SELECT COUNT(*) FROM emails")
-            stats['total_emails'] = cursor.fetchone()[0]
+            conn.close()
+            logger.info(f"✅ 已批量删除 {total} 封邮件")
+            return total
             
-            # 失败邮件数
-            cursor.execute("SELECT COUNT(*) FROM failed_emails")
-            stats['failed_emails'] = cursor.fetchone()[0]
+        except Exception as e:
+            logger.error(f"❌ 批量删除邮件失败: {e}")
+            return 0
+    
+    def iter_emails(self, ids: Optional[List[int]] = None, recipient: Optional[str] = None,
+                    before_ts: Optional[float] = None, after_ts: Optional[float] = None,
+                    include_content: bool = True) -> Iterator[Dict]:
+        """
+        流式遍历邮件（按时间正序）
+        
+        使用非缓冲游标逐行从服务器读取，内存占用与结果集大小无关。
+        遍历期间该连接不能执行其他查询，因此收件人通过子查询一并取出。
+        
+        Args:
+            ids: 邮件ID列表
+            recipient: 收件人邮箱
+            before_ts: 只包含早于该时间戳的邮件
+            after_ts: 只包含不早于该时间戳的邮件
+            include_content: 是否包含正文和原始内容
             
-            # 总附件数
-            cursor.execute("SELECT COUNT(*) FROM email_attachments")
-            stats['total_attachments'] = cursor.fetchone()[0]
+        Yields:
+            邮件字典，recipients 为收件人列表
+        """
+        where, params = self._email_filter(ids=ids, recipient=recipient,
+                                           before_ts=before_ts, after_ts=after_ts)
+        columns = "e.*" if include_content else SUMMARY_COLUMNS
+        
+        for row in self._iter_query(f"""
+            SELECT {columns},
+                   (SELECT GROUP_CONCAT(er.recipient_email) FROM email_recipients er
+                    WHERE er.email_id = e.id) AS recipients
+            FROM emails e {where}
+            ORDER BY e.timestamp
+        """, params):
+            row['recipients'] = row['recipients'].split(',') if row['recipients'] else []
+            yield row
+    
+    def iter_email_summaries(self, recipient: Optional[str] = None,
+                             limit: Optional[int] = None, offset: int = 0) -> Iterator[Dict]:
+        """
+        流式列出邮件摘要（按时间倒序，不含正文和原始内容）
+        
+        Args:
+            recipient: 收件人邮箱，None 表示全部邮件
+            limit: 限制返回数量，None 表示不限制
+            offset: 偏移量
             
-            # 唯一收件人数
-            cursor.execute("SELECT COUNT(DISTINCT recipient_email) FROM email_recipients")
-            stats['unique_recipients'] = cursor.fetchone()[0]
+        Yields:
+            邮件摘要字典（含 attachment_count）
+        """
+        where, params = self._email_filter(recipient=recipient)
+        limit_clause, limit_params = self._limit_clause(limit, offset)
+        
+        yield from self._iter_query(f"""
+            SELECT {SUMMARY_COLUMNS},
+                   (SELECT COUNT(*) FROM email_attachments ea WHERE ea.email_id = e.id) AS attachment_count
+            FROM emails e {where}
+            ORDER BY e.timestamp DESC
+            {limit_clause}
+        """, params + limit_params)
+    
+    def iter_search(self, query: str, field: str = 'all',
+                    limit: Optional[int] = 50) -> Iterator[Dict]:
+        """
+        流式搜索邮件（按时间倒序，只返回摘要列）
+        
+        Args:
+            query: 搜索关键词
+            field: 搜索字段，all/from/subject/recipient
+            limit: 限制返回数量，None 表示不限制
+            
+        Yields:
+            邮件摘要字典
+        """
+        pattern = f"%{query}%"
+        if field == 'all':
+            where = """WHERE e.mail_from LIKE %s OR e.subject LIKE %s
+                       OR e.plaintext_body LIKE %s OR e.html_body LIKE %s"""
+            params = (pattern,) * 4
+        elif field == 'from':
+            where, params = "WHERE e.mail_from LIKE %s", (pattern,)
+        elif field == 'subject':
+            where, params = "WHERE e.subject LIKE %s", (pattern,)
+        elif field == 'recipient':
+            where = "WHERE e.id IN (SELECT email_id FROM email_recipients WHERE recipient_email LIKE %s)"
+            params = (pattern,)
+        else:
+            raise ValueError(f"不支持的搜索字段: {field}")
+        
+        limit_clause, limit_params = self._limit_clause(limit, 0)
+        yield from self._iter_query(f"""
+            SELECT {SUMMARY_COLUMNS} FROM emails e
+            {where}
+            ORDER BY e.timestamp DESC
+            {limit_clause}
+        """, params + limit_params)
+    
+    def _limit_clause(self, limit: Optional[int], offset: int) -> tuple:
+        """构造 LIMIT/OFFSET 子句，limit 为 None 时不限制数量"""
+        if limit is None:
+            if not offset:
+                return "", ()
+            # MySQL 要求 OFFSET 必须配合 LIMIT 使用
+            return "LIMIT 18446744073709551615 OFFSET %s", (offset,)
+        return "LIMIT %s OFFSET %s", (limit, offset)
+    
+    def _iter_query(self, sql: str, params: tuple = ()) -> Iterator[Dict]:
+        """
+        以非缓冲游标执行查询并逐行产出结果
+        
+        调用方提前停止遍历时直接断开连接，避免读完剩余结果。
+        """
+        conn = self.get_connection()
+        finished = False
+        try:
+            cursor = conn.cursor(dictionary=True, buffered=False)
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+            finished = True
+        finally:
+            if finished:
+                conn.close()
+            else:
+                conn.shutdown()
+    
+    def _email_filter(self, ids: Optional[List[int]] = None, recipient: Optional[str] = None,
+                      before_ts: Optional[float] = None, after_ts: Optional[float] = None) -> tuple:
+        """构造 emails e 的 WHERE 子句及参数"""
+        conditions = []
+        params = []
+        if ids is not None:
+            if not ids:
+                # 空ID列表不匹配任何邮件
+                conditions.append("1 = 0")
+            else:
+                conditions.append(f"e.id IN ({', '.join(['%s'] * len(ids))})")
+                params.extend(ids)
+        if recipient is not None:
+            conditions.append("e.id IN (SELECT email_id FROM email_recipients WHERE recipient_email = %s)")
+            params.append(recipient)
+        if before_ts is not None:
+            conditions.append("e.timestamp < %s")
+            params.append(before_ts)
+        if after_ts is not None:
+            conditions.append("e.timestamp >= %s")
+            params.append(after_ts)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        return where, tuple(params)
+    
+    def _delete_batch(self, cursor, email_ids: List[int]) -> int:
+        """
+        在当前事务内删除一批邮件并扣减统计计数
+        
+        Returns:
+            实际删除的邮件数量
+        """
+        # 先收集待删除邮件的统计增量，再在同一事务内删除
+        delta = self._collect_stats_delta(cursor, email_ids)
+        placeholders = ', '.join(['%s'] * len(email_ids))
+        if self.partition_by:
+            # 分区表不支持外键，需要手动删除子表记录
+            cursor.execute(f"DELETE FROM email_recipients WHERE email_id IN ({placeholders})", tuple(email_ids))
+            cursor.execute(f"DELETE FROM email_attachments WHERE email_id IN ({placeholders})", tuple(email_ids))
+        cursor.execute(f"DELETE FROM emails WHERE id IN ({placeholders})", tuple(email_ids))
+        deleted = cursor.rowcount
+        
+        if deleted > 0:
+            self._run_statements(cursor, stats_statements(delta, -1))
+        return deleted
+    
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取数据库统计信息
+        
+        读取由 save_email/delete_email 增量维护的计数器，不扫描邮件表
+        
+        Returns:
+            统计信息字典
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            stats = {key: 0 for key in STATS_KEYS}
+            
+            cursor.execute(STATS_SQL)
+            for key, value in cursor.fetchall():
+                stats[key] = int(value)
             
             conn.close()
             return stats
@@ -406,3 +582,770 @@ class EmailDatabase:
         except Exception as e:
             logger.error(f"❌ 获取统计信息失败: {e}")
             return {}
+    
+    def get_daily_stats(self, days: int = 7) -> List[Dict]:
+        """
+        获取最近若干天的按天统计
+        
+        Args:
+            days: 天数（包含今天）
+            
+        Returns:
+            按日期倒序的统计列表
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor(dictionary=True)
+            
+            cursor.execute("""
+                SELECT stat_date, emails, attachments, bytes
+                FROM email_stats_daily
+                WHERE stat_date > CURDATE() - INTERVAL %s DAY
+                ORDER BY stat_date DESC
+            """, (max(days, 1),))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return rows
+            
+        except Exception as e:
+            logger.error(f"❌ 获取按天统计失败: {e}")
+            return []
+    
+    def get_domain_stats(self, limit: int = 20) -> List[Dict]:
+        """
+        获取收件域名统计（按邮件数倒序）
+        
+        Args:
+            limit: 限制返回数量
+            
+        Returns:
+            域名统计列表
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor(dictionary=True)
+            
+            cursor.execute("""
+                SELECT domain, emails, last_timestamp
+                FROM email_stats_domains
+                ORDER BY emails DESC
+                LIMIT %s
+            """, (limit,))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return rows
+            
+        except Exception as e:
+            logger.error(f"❌ 获取域名统计失败: {e}")
+            return []
+    
+    def get_recipient_stats(self, limit: int = 20, domain: Optional[str] = None) -> List[Dict]:
+        """
+        获取收件人统计（按邮件数倒序）
+        
+        Args:
+            limit: 限制返回数量
+            domain: 仅返回该域名下的收件人
+            
+        Returns:
+            收件人统计列表
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor(dictionary=True)
+            
+            if domain:
+                cursor.execute("""
+                    SELECT recipient_email, domain, emails, last_timestamp
+                    FROM email_stats_recipients
+                    WHERE domain = %s
+                    ORDER BY emails DESC
+                    LIMIT %s
+                """, (domain.lower(), limit))
+            else:
+                cursor.execute("""
+                    SELECT recipient_email, domain, emails, last_timestamp
+                    FROM email_stats_recipients
+                    ORDER BY emails DESC
+                    LIMIT %s
+                """, (limit,))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return rows
+            
+        except Exception as e:
+            logger.error(f"❌ 获取收件人统计失败: {e}")
+            return []
+    
+    def rebuild_stats(self) -> bool:
+        """
+        根据现有数据全量重建统计表
+        
+        需要扫描全部邮件，仅用于首次升级或数据修复
+        
+        Returns:
+            重建成功返回True，失败返回False
+        """
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            logger.info("🔄 正在重建统计表...")
+            
+            for table in ('email_stats', 'email_stats_daily',
+                          'email_stats_domains', 'email_stats_recipients'):
+                cursor.execute(f"DELETE FROM {table}")
+            
+            cursor.execute("""
+                INSERT INTO email_stats (stat_key, stat_value)
+                SELECT 'total_emails', COUNT(*) FROM emails
+                UNION ALL SELECT 'failed_emails', COUNT(*) FROM failed_emails
+                UNION ALL SELECT 'total_attachments', COUNT(*) FROM email_attachments
+                UNION ALL SELECT 'total_bytes', COALESCE(SUM(raw_size), 0) FROM emails
+                UNION ALL SELECT 'latest_timestamp', COALESCE(FLOOR(MAX(timestamp)), 0) FROM emails
+            """)
+            
+            cursor.execute("""
+                INSERT INTO email_stats_daily (stat_date, emails, attachments, bytes)
+                SELECT DATE(FROM_UNIXTIME(e.timestamp)), COUNT(*),
+                       COALESCE(SUM(a.cnt), 0), COALESCE(SUM(e.raw_size), 0)
+                FROM emails e
+                LEFT JOIN (
+                    SELECT email_id, COUNT(*) AS cnt FROM email_attachments GROUP BY email_id
+                ) a ON a.email_id = e.id
+                GROUP BY DATE(FROM_UNIXTIME(e.timestamp))
+            """)
+            
+            cursor.execute("""
+                INSERT INTO email_stats_recipients (recipient_email, domain, emails, last_timestamp)
+                SELECT er.recipient_email,
+                       LOWER(SUBSTRING_INDEX(er.recipient_email, '@', -1)),
+                       COUNT(DISTINCT er.email_id), FLOOR(MAX(e.timestamp))
+                FROM email_recipients er
+                JOIN emails e ON e.id = er.email_id
+                GROUP BY er.recipient_email
+            """)
+            
+            cursor.execute("""
+                INSERT INTO email_stats_domains (domain, emails, last_timestamp)
+                SELECT LOWER(SUBSTRING_INDEX(er.recipient_email, '@', -1)) AS d,
+                       COUNT(DISTINCT er.email_id), FLOOR(MAX(e.timestamp))
+                FROM email_recipients er
+                JOIN emails e ON e.id = er.email_id
+                GROUP BY d
+            """)
+            
+            cursor.execute("""
+                INSERT INTO email_stats (stat_key, stat_value)
+                SELECT 'unique_recipients', COUNT(*) FROM email_stats_recipients
+            """)
+            
+            conn.commit()
+            conn.close()
+            
+            logger.info("✅ 统计表重建完成")
+            return True
+            
+        except Exception as e:
+            logger.error(f"❌ 重建统计表失败: {e}")
+            return False
+    
+    def _create_partitioned_tables(self, cursor):
+        """
+        创建按时间范围分区的邮件表
+        
+        MySQL分区表不支持外键，且分区键必须包含在主键中，因此三张表都带有
+        received_day（UTC纪元日）列并按相同边界分区，过期数据可整体删除分区。
+        """
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'emails'
+        """, (self.database,))
+        if cursor.fetchone()[0] > 0:
+            if not self._list_partitions(cursor, 'emails'):
+                raise RuntimeError("emails 表已存在但未分区，请先迁移数据或使用新的数据库")
+            return
+        
+        partition_clause = self._initial_partition_clause()
+        
+        cursor.execute(f"""
+            CREATE TABLE emails (
+                id INT AUTO_INCREMENT,
+                received_day INT NOT NULL,
+                timestamp DECIMAL(15,6) NOT NULL,
+                datetime VARCHAR(32) NOT NULL,
+                sender_ip VARCHAR(45),
+                mail_from VARCHAR(255) NOT NULL,
+                subject TEXT,
+                plaintext_body LONGTEXT,
+                html_body LONGTEXT,
+                raw_content LONGBLOB,
+                raw_size INT DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, received_day),
+                INDEX idx_timestamp (timestamp),
+                INDEX idx_datetime (datetime),
+                INDEX idx_mail_from (mail_from(100))
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            {partition_clause}
+        """)
+        
+        cursor.execute(f"""
+            CREATE TABLE email_recipients (
+                id INT AUTO_INCREMENT,
+                email_id INT NOT NULL,
+                received_day INT NOT NULL,
+                recipient_email VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, received_day),
+                INDEX idx_email_id (email_id),
+                INDEX idx_recipient_email (recipient_email)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            {partition_clause}
+        """)
+        
+        cursor.execute(f"""
+            CREATE TABLE email_attachments (
+                id INT AUTO_INCREMENT,
+                email_id INT NOT NULL,
+                received_day INT NOT NULL,
+                filename VARCHAR(255) NOT NULL,
+                content_type VARCHAR(100),
+                file_size INT DEFAULT 0,
+                file_path VARCHAR(500),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id, received_day),
+                INDEX idx_email_id (email_id),
+                INDEX idx_filename (filename)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            {partition_clause}
+        """)
+        
+        logger.info(f"✅ 已创建按{self.partition_by}分区的邮件表")
+    
+    def _initial_partition_clause(self) -> str:
+        """生成建表时的分区定义：从当前周期开始，预建若干未来分区"""
+        start = period_start(day_number(datetime.now().timestamp()), self.partition_by)
+        step = PARTITION_PERIODS[self.partition_by]
+        partitions = []
+        for i in range(self.partitions_ahead + 1):
+            bound = start + step * (i + 1)
+            partitions.append(f"PARTITION {partition_name(bound - step)} VALUES LESS THAN ({bound})")
+        partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        return "PARTITION BY RANGE (received_day) (\n" + ",\n".join(partitions) + "\n)"
+    
+    def _list_partitions(self, cursor, table: str) -> List[tuple]:
+        """
+        列出表的分区
+        
+        Returns:
+            [(分区名, 上界纪元日或None表示MAXVALUE), ...]，按分区顺序
+        """
+        cursor.execute("""
+            SELECT PARTITION_NAME, PARTITION_DESCRIPTION
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+            ORDER BY PARTITION_ORDINAL_POSITION
+        """, (self.database, table))
+        partitions = []
+        for name, description in cursor.fetchall():
+            bound = None if description == 'MAXVALUE' else int(description)
+            partitions.append((name, bound))
+        return partitions
+    
+    def ensure_partitions(self, ahead: Optional[int] = None) -> int:
+        """
+        确保未来若干周期的分区已存在（从 pmax 中拆分出新分区）
+        
+        应定期调用（例如与 purge 一起放入定时任务），保持 pmax 为空，
+        这样拆分只是元数据操作。
+        
+        Args:
+            ahead: 预建的未来分区数量，默认使用构造时的 partitions_ahead
+            
+        Returns:
+            新建的分区数量
+        """
+        if not self.partition_by:
+            return 0
+        ahead = self.partitions_ahead if ahead is None else ahead
+        step = PARTITION_PERIODS[self.partition_by]
+        target = period_start(day_number(datetime.now().timestamp()), self.partition_by) + step * (ahead + 1)
+        
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            created = 0
+            for table in PARTITIONED_TABLES:
+                partitions = self._list_partitions(cursor, table)
+                bounds = [bound for _, bound in partitions if bound is not None]
+                last = max(bounds) if bounds else period_start(day_number(datetime.now().timestamp()), self.partition_by)
+                
+                new_partitions = []
+                while last < target:
+                    new_partitions.append(f"PARTITION {partition_name(last)} VALUES LESS THAN ({last + step})")
+                    last += step
+                if not new_partitions:
+                    continue
+                
+                new_partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+                cursor.execute(f"""
+                    ALTER TABLE {table} REORGANIZE PARTITION pmax INTO (
+                        {', '.join(new_partitions)}
+                    )
+                """)
+                created = max(created, len(new_partitions) - 1)
+            
+            conn.close()
+            if created:
+                logger.info(f"✅ 已新建 {created} 个分区")
+            return created
+            
+        except Exception as e:
+            logger.error(f"❌ 创建分区失败: {e}")
+            return 0
+    
+    def drop_expired_partitions(self, older_than_days: float) -> List[str]:
+        """
+        删除整段过期的分区（替代逐行删除）
+        
+        只删除上界早于截止时间的分区，即分区内全部邮件都已过期。
+        DROP PARTITION 是DDL（隐式提交），无法与统计扣减放在同一事务：
+        先汇总增量、再删除分区，确认分区确实已删除后才扣减统计；
+        删除中途失败时按现有数据重建统计表。
+        进程恰好在删除后、扣减前退出时统计会偏大，可用 rebuild_stats 修复。
+        
+        Args:
+            older_than_days: 保留天数，早于该天数的分区会被删除
+            
+        Returns:
+            被删除的分区名列表
+        """
+        if not self.partition_by:
+            return []
+        cutoff = day_number(datetime.now().timestamp() - older_than_days * 86400)
+        
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            expired = [name for name, bound in self._list_partitions(cursor, 'emails')
+                       if bound is not None and bound <= cutoff]
+            if not expired:
+                conn.close()
+                return []
+            
+            delta = self._collect_stats_delta(cursor, partitions=expired)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"❌ 删除过期分区失败: {e}")
+            return []
+        
+        try:
+            # 先删子表，失败时 emails 仍保留
+            for table in reversed(PARTITIONED_TABLES):
+                cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+            
+            self._run_statements(cursor, stats_statements(delta, -1))
+            conn.commit()
+            conn.close()
+            logger.info(f"✅ 已删除过期分区: {', '.join(expired)}（{delta['total_emails']} 封邮件）")
+            return expired
+            
+        except Exception as e:
+            logger.error(f"❌ 删除过期分区失败: {e}")
+            try:
+                conn.close()
+            except Exception:
+                pass
+            # 部分分区可能已删除，统计按实际剩余的数据重建
+            self.rebuild_stats()
+            remaining = self._partition_names('emails')
+            return [name for name in expired if remaining is not None and name not in remaining]
+    
+    def _partition_names(self, table: str) -> Optional[List[str]]:
+        """返回表当前的分区名，查询失败返回None"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            names = [name for name, _ in self._list_partitions(cursor, table)]
+            conn.close()
+            return names
+        except Exception as e:
+            logger.error(f"❌ 查询分区失败: {e}")
+            return None
+    
+    def maintain_partitions(self, older_than_days: Optional[float] = None) -> List[str]:
+        """
+        分区的定期维护，应每天调用一次
+        
+        预建未来的分区，否则预建范围用完后新邮件都会落入 pmax、
+        再也无法按分区过期；给出保留天数时同时删除过期分区。
+        
+        Args:
+            older_than_days: 保留天数，None 表示只预建分区
+            
+        Returns:
+            被删除的分区名列表
+        """
+        if not self.partition_by:
+            return []
+        self.ensure_partitions()
+        if older_than_days is None:
+            return []
+        return self.drop_expired_partitions(older_than_days)
+    
+    def _collect_stats_delta(self, cursor, email_ids: Optional[List[int]] = None,
+                             partitions: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        汇总一批邮件对统计表的贡献，用于删除前扣减计数
+        
+        Args:
+            cursor: 当前事务的游标
+            email_ids: 邮件ID列表
+            partitions: 分区名列表（按分区整体汇总，用于删除过期分区）
+            
+        Returns:
+            统计增量字典（结构同 stats_delta_from_email_data）
+        """
+        delta = empty_stats_delta()
+        if not email_ids and not partitions:
+            return delta
+        
+        partition_clause = f" PARTITION ({', '.join(partitions)})" if partitions else ""
+        if email_ids:
+            where = f"WHERE e.id IN ({', '.join(['%s'] * len(email_ids))})"
+            params = tuple(email_ids)
+        else:
+            where = ""
+            params = ()
+        
+        cursor.execute(f"""
+            SELECT FLOOR(MIN(e.timestamp)), COUNT(*), COALESCE(SUM(e.raw_size), 0), FLOOR(MAX(e.timestamp))
+            FROM emails{partition_clause} e {where}
+            GROUP BY DATE(FROM_UNIXTIME(e.timestamp))
+        """, params)
+        for day_ts, emails, size, latest in cursor.fetchall():
+            delta['total_emails'] += emails
+            delta['total_bytes'] += int(size)
+            delta['latest_timestamp'] = max(delta['latest_timestamp'], int(latest))
+            delta['daily'][int(day_ts)] = [emails, 0, int(size)]
+        
+        cursor.execute(f"""
+            SELECT FLOOR(MIN(e.timestamp)), COUNT(*)
+            FROM email_attachments{partition_clause} ea
+            JOIN emails{partition_clause} e ON e.id = ea.email_id {where}
+            GROUP BY DATE(FROM_UNIXTIME(e.timestamp))
+        """, params)
+        for day_ts, attachments in cursor.fetchall():
+            delta['total_attachments'] += attachments
+            day = delta['daily'].setdefault(int(day_ts), [0, 0, 0])
+            day[1] += attachments
+        
+        cursor.execute(f"""
+            SELECT er.recipient_email, COUNT(DISTINCT er.email_id)
+            FROM email_recipients{partition_clause} er
+            JOIN emails{partition_clause} e ON e.id = er.email_id {where}
+            GROUP BY er.recipient_email
+        """, params)
+        for recipient, count in cursor.fetchall():
+            delta['recipients'][recipient] = count
+        
+        cursor.execute(f"""
+            SELECT LOWER(SUBSTRING_INDEX(er.recipient_email, '@', -1)) AS d, COUNT(DISTINCT er.email_id)
+            FROM email_recipients{partition_clause} er
+            JOIN emails{partition_clause} e ON e.id = er.email_id {where}
+            GROUP BY d
+        """, params)
+        for domain, count in cursor.fetchall():
+            delta['domains'][domain] = count
+        
+        return delta
+    
+    def _run_statements(self, cursor, statements):
+        """
+        执行SQL语句生成器
+        
+        每条语句执行后把游标回传给生成器（供其读取 rowcount/lastrowid），
+        返回生成器的返回值。
+        """
+        try:
+            sql, params = next(statements)
+            while True:
+                cursor.execute(sql, params)
+                sql, params = statements.send(cursor)
+        except StopIteration as e:
+            return e.value
+
+
+# 分区周期（天）
+PARTITION_PERIODS = {'day': 1, 'week': 7}
+
+# 按相同边界分区的表
+PARTITIONED_TABLES = ('emails', 'email_recipients', 'email_attachments')
+
+
+def day_number(timestamp) -> int:
+    """Unix时间戳转换为UTC纪元日（分区键）"""
+    return int(float(timestamp or 0) // 86400)
+
+
+def period_start(day: int, partition_by: str) -> int:
+    """返回某纪元日所在分区周期的起始日（周分区以周一为起点）"""
+    if partition_by == 'week':
+        # 1970-01-01 是周四
+        return day - (day + 3) % 7
+    return day
+
+
+def partition_name(start_day: int) -> str:
+    """按周期起始日期命名分区，例如 p20240101"""
+    return 'p' + datetime.fromtimestamp(start_day * 86400, tz=timezone.utc).strftime('%Y%m%d')
+
+
+# 按收件人查询邮件（同步/异步共用）
+EMAILS_BY_RECIPIENT_SQL = """
+    SELECT e.*, GROUP_CONCAT(er.recipient_email) as recipients,
+           COUNT(ea.id) as attachment_count
+    FROM emails e
+    LEFT JOIN email_recipients er ON e.id = er.email_id
+    LEFT JOIN email_attachments ea ON e.id = ea.email_id
+    WHERE e.id IN (
+        SELECT DISTINCT email_id FROM email_recipients 
+        WHERE recipient_email = %s
+    )
+    GROUP BY e.id
+    ORDER BY e.timestamp DESC
+    LIMIT %s OFFSET %s
+"""
+
+EMAIL_BY_ID_SQL = "SELECT * FROM emails WHERE id = %s"
+
+EMAIL_RECIPIENTS_SQL = """
+    SELECT recipient_email FROM email_recipients 
+    WHERE email_id = %s
+"""
+
+EMAIL_ATTACHMENTS_SQL = """
+    SELECT filename, content_type, file_size AS size
+    FROM email_attachments 
+    WHERE email_id = %s
+"""
+
+STATS_SQL = "SELECT stat_key, stat_value FROM email_stats"
+
+# 列表/摘要查询使用的列（不含 LONGTEXT/LONGBLOB）
+SUMMARY_COLUMNS = "e.id, e.timestamp, e.datetime, e.sender_ip, e.mail_from, e.subject, e.raw_size"
+
+# 统计计数器键
+STATS_KEYS = ('total_emails', 'failed_emails', 'total_attachments',
+              'unique_recipients', 'total_bytes', 'latest_timestamp')
+
+
+def empty_stats_delta() -> Dict[str, Any]:
+    """创建空的统计增量"""
+    return {
+        'total_emails': 0,
+        'total_attachments': 0,
+        'total_bytes': 0,
+        'latest_timestamp': 0,
+        'daily': {},
+        'domains': {},
+        'recipients': {},
+    }
+
+
+def stats_delta_from_email_data(email_data: Dict[str, Any]) -> Dict[str, Any]:
+    """根据 save_email 的输入数据计算统计增量"""
+    recipients = email_data.get('to', [])
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    # 一封邮件对同一收件人/域名只计一次
+    recipients = set(recipients)
+    
+    timestamp = int(float(email_data.get('timestamp') or 0))
+    attachment_count = len(email_data.get('attachments', []))
+    raw_size = email_data.get('raw_size', 0) or 0
+    
+    delta = empty_stats_delta()
+    delta['total_emails'] = 1
+    delta['total_attachments'] = attachment_count
+    delta['total_bytes'] = raw_size
+    delta['latest_timestamp'] = timestamp
+    delta['daily'][timestamp] = [1, attachment_count, raw_size]
+    delta['recipients'] = {recipient: 1 for recipient in recipients}
+    delta['domains'] = {domain: 1 for domain in {r.split('@')[-1].lower() for r in recipients}}
+    return delta
+
+
+def save_email_statements(email_data: Dict[str, Any], partition_by: Optional[str] = None):
+    """
+    生成保存一封邮件所需的SQL语句（含统计计数），生成器返回新邮件ID
+    
+    协议同 stats_statements：调用方执行每条语句后通过 send() 回传游标。
+    """
+    # 分区表需要额外写入分区键
+    day_column = ", received_day" if partition_by else ""
+    day_placeholder = ", %s" if partition_by else ""
+    day_value = (day_number(email_data.get('timestamp')),) if partition_by else ()
+    
+    # 插入邮件主记录
+    cursor = yield f"""
+        INSERT INTO emails (
+            timestamp, datetime, sender_ip, mail_from, subject,
+            plaintext_body, html_body, raw_content, raw_size{day_column}
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s{day_placeholder})
+    """, (
+        email_data.get('timestamp'),
+        email_data.get('datetime'),
+        email_data.get('sender_ip'),
+        email_data.get('from'),
+        email_data.get('subject'),
+        email_data.get('plaintext_body'),
+        email_data.get('html_body'),
+        email_data.get('raw_content'),  # 原始邮件内容
+        email_data.get('raw_size', 0)
+    ) + day_value
+    
+    email_id = cursor.lastrowid
+    
+    # 插入收件人记录
+    recipients = email_data.get('to', [])
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    
+    for recipient in recipients:
+        yield f"""
+            INSERT INTO email_recipients (email_id, recipient_email{day_column})
+            VALUES (%s, %s{day_placeholder})
+        """, (email_id, recipient) + day_value
+    
+    # 插入附件记录
+    for attachment in email_data.get('attachments', []):
+        yield f"""
+            INSERT INTO email_attachments (
+                email_id, filename, content_type, file_size{day_column}
+            ) VALUES (%s, %s, %s, %s{day_placeholder})
+        """, (
+            email_id,
+            attachment.get('filename'),
+            attachment.get('content_type'),
+            attachment.get('size', 0)
+        ) + day_value
+    
+    # 同一事务内更新统计计数
+    yield from stats_statements(stats_delta_from_email_data(email_data), 1)
+    return email_id
+
+
+def save_failed_email_statements(sender_ip: str, mail_from: str,
+                                 raw_content: bytes, error_message: str):
+    """生成保存解析失败邮件所需的SQL语句，生成器返回记录ID"""
+    now = datetime.now()
+    
+    cursor = yield """
+        INSERT INTO failed_emails (
+            timestamp, datetime, sender_ip, mail_from, 
+            raw_content, error_message
+        ) VALUES (%s, %s, %s, %s, %s, %s)
+    """, (
+        now.timestamp(),
+        now.isoformat(),
+        sender_ip,
+        mail_from,
+        raw_content,
+        error_message
+    )
+    
+    record_id = cursor.lastrowid
+    yield from stats_statements({'failed_emails': 1}, 1)
+    return record_id
+
+
+def stats_statements(delta: Dict[str, Any], sign: int):
+    """
+    生成应用统计增量所需的SQL语句
+    
+    这是一个生成器：每次产出 (sql, params)，调用方执行后通过 send()
+    回传游标（用于读取影响行数）。同步与异步数据库类共用同一套语句。
+    扣减时须在邮件行删除之后执行，latest_timestamp 按剩余邮件重新计算。
+    
+    注意：计数器是少数几行热点行（email_stats 的各个键和当天的 email_stats_daily），
+    每次保存都要更新它们并持有行锁直到提交，所以并发的保存在这一步是串行的，
+    AsyncEmailDatabase 加大连接池也无法突破这个上限。为缩短持锁时间，
+    这些语句总是放在事务的最后执行。
+    
+    Args:
+        delta: 统计增量
+        sign: 1 表示新增邮件，-1 表示删除邮件
+    """
+    counter_sql = """
+        INSERT INTO email_stats (stat_key, stat_value) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
+    """
+    for key in ('total_emails', 'failed_emails', 'total_attachments', 'total_bytes'):
+        if delta.get(key):
+            yield counter_sql, (key, sign * delta[key])
+    
+    if sign > 0 and delta.get('latest_timestamp'):
+        yield """
+            INSERT INTO email_stats (stat_key, stat_value) VALUES ('latest_timestamp', %s)
+            ON DUPLICATE KEY UPDATE stat_value = GREATEST(stat_value, VALUES(stat_value))
+        """, (delta['latest_timestamp'],)
+    elif sign < 0 and delta.get('latest_timestamp'):
+        # 删除的邮件包含最新一封时，按剩余邮件重新取最大值（走 idx_timestamp 索引）
+        yield """
+            UPDATE email_stats SET stat_value = (SELECT COALESCE(FLOOR(MAX(timestamp)), 0) FROM emails)
+            WHERE stat_key = 'latest_timestamp' AND stat_value <= %s
+        """, (delta['latest_timestamp'],)
+    
+    # daily 的键是该天内任一时间戳，日期由MySQL按会话时区换算，与重建/分区汇总一致
+    for day_ts, (emails, attachments, size) in delta.get('daily', {}).items():
+        yield """
+            INSERT INTO email_stats_daily (stat_date, emails, attachments, bytes)
+            VALUES (DATE(FROM_UNIXTIME(%s)), %s, %s, %s)
+            ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails),
+                                    attachments = attachments + VALUES(attachments),
+                                    bytes = bytes + VALUES(bytes)
+        """, (day_ts, sign * emails, sign * attachments, sign * size)
+    
+    last_timestamp = delta.get('latest_timestamp', 0)
+    for domain, count in delta.get('domains', {}).items():
+        yield """
+            INSERT INTO email_stats_domains (domain, emails, last_timestamp)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails),
+                                    last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp))
+        """, (domain, sign * count, last_timestamp if sign > 0 else 0)
+    if sign < 0 and delta.get('domains'):
+        yield "DELETE FROM email_stats_domains WHERE emails <= 0", ()
+    
+    new_recipients = 0
+    for recipient, count in delta.get('recipients', {}).items():
+        if sign > 0:
+            # 影响行数为1表示新插入（首次出现的收件人），2表示更新已有行
+            cursor = yield """
+                INSERT INTO email_stats_recipients (recipient_email, domain, emails, last_timestamp)
+                VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE emails = emails + VALUES(emails),
+                                        last_timestamp = GREATEST(last_timestamp, VALUES(last_timestamp))
+            """, (recipient, recipient.split('@')[-1].lower(), count, last_timestamp)
+            if cursor.rowcount == 1:
+                new_recipients += 1
+        else:
+            yield """
+                UPDATE email_stats_recipients SET emails = emails - %s
+                WHERE recipient_email = %s
+            """, (count, recipient)
+            cursor = yield """
+                DELETE FROM email_stats_recipients
+                WHERE recipient_email = %s AND emails <= 0
+            """, (recipient,)
+            new_recipients -= cursor.rowcount
+    
+    if new_recipients:
+        yield counter_sql, ('unique_recipients', new_recipients)
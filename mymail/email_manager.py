@@ -6,56 +6,79 @@
 
 import argparse
 import json
+import re
 import sys
+import time
 from datetime import datetime, timedelta
 from email_database import EmailDatabase
 
 def format_email_summary(email):
     """格式化邮件摘要显示"""
-    timestamp = datetime.fromtimestamp(email['timestamp'])
+    timestamp = datetime.fromtimestamp(float(email['timestamp']))
     
     # 截断长主题和发件人
-    subject = email['subject'][:50] + "..." if len(email['subject']) > 50 else email['subject']
+    subject = email['subject'] or ''
+    subject = subject[:50] + "..." if len(subject) > 50 else subject
     from_addr = email['mail_from'][:30] + "..." if len(email['mail_from']) > 30 else email['mail_from']
     
     return f"{email['id']:>6} | {timestamp.strftime('%Y-%m-%d %H:%M')} | {from_addr:<32} | {subject}"
 
-def list_emails(db, recipient=None, limit=20, offset=0):
-    """列出邮件"""
-    print("="*100)
-    print("邮件列表")
-    print("="*100)
-    print(f"{'ID':<6} | {'时间':<16} | {'发件人':<32} | 主题")
-    print("-"*100)
-    
-    if recipient:
-        emails = db.get_emails_by_recipient(recipient, limit, offset)
-        print(f"收件人: {recipient}")
-    else:
-        # 获取所有邮件
-        conn = db.get_connection()
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("""
-            SELECT e.*, COUNT(ea.id) as attachment_count
-            FROM emails e
-            LEFT JOIN email_attachments ea ON e.id = ea.email_id
-            GROUP BY e.id
-            ORDER BY e.timestamp DESC
-            LIMIT %s OFFSET %s
-        """, (limit, offset))
-        
-        emails = cursor.fetchall()
-        conn.close()
+def summary_to_dict(email):
+    """把邮件摘要转换为可JSON序列化的字典"""
+    return {
+        'id': email['id'],
+        'timestamp': float(email['timestamp']),
+        'datetime': email['datetime'],
+        'sender_ip': email['sender_ip'],
+        'from': email['mail_from'],
+        'subject': email['subject'],
+        'raw_size': email['raw_size'],
+        'attachment_count': email.get('attachment_count')
+    }
+
+def stream_summaries(emails, output=None):
+    """
+    逐行输出邮件摘要，边读取边输出，内存占用恒定
     
-    if not emails:
-        print("没有找到邮件")
-        return
+    Args:
+        emails: 邮件摘要迭代器
+        output: JSONL 输出文件路径，None 表示打印表格到标准输出
+        
+    Returns:
+        输出的邮件数量
+    """
+    count = 0
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            for email in emails:
+                f.write(json.dumps(summary_to_dict(email), ensure_ascii=False) + "\n")
+                count += 1
+        return count
     
     for email in emails:
-        print(format_email_summary(email))
+        if count == 0:
+            print(f"{'ID':<6} | {'时间':<16} | {'发件人':<32} | 主题")
+            print("-"*100)
+        print(format_email_summary(email), flush=(count % 100 == 0))
+        count += 1
+    return count
+
+def list_emails(db, recipient=None, limit=20, offset=0, output=None):
+    """列出邮件"""
+    if not output:
+        print("="*100)
+        print("邮件列表" + (f" - 收件人: {recipient}" if recipient else ""))
+        print("="*100)
     
-    print(f"\n显示 {len(emails)} 封邮件 (偏移: {offset})")
+    emails = db.iter_email_summaries(recipient, limit or None, offset)
+    count = stream_summaries(emails, output)
+    
+    if count == 0:
+        print("没有找到邮件")
+    elif output:
+        print(f"✅ 已输出 {count} 封邮件到: {output}")
+    else:
+        print(f"\n显示 {count} 封邮件 (偏移: {offset})")
 
 def show_email(db, email_id):
     """显示邮件详情"""
@@ -102,6 +125,22 @@ def show_email(db, email_id):
     
     print("="*80)
 
+def email_to_export_dict(email):
+    """把数据库中的邮件记录转换为导出用的字典"""
+    return {
+        'id': email['id'],
+        'timestamp': float(email['timestamp']),
+        'datetime': email['datetime'],
+        'sender_ip': email['sender_ip'],
+        'from': email['mail_from'],
+        'to': email.get('recipients', []),
+        'subject': email['subject'],
+        'plaintext_body': email['plaintext_body'],
+        'html_body': email['html_body'],
+        'attachments': email.get('attachments', []),
+        'raw_size': email['raw_size']
+    }
+
 def export_email(db, email_id, format='json'):
     """导出邮件"""
     email = db.get_email_by_id(email_id)
@@ -112,19 +151,7 @@ def export_email(db, email_id, format='json'):
     
     if format.lower() == 'json':
         # 导出为JSON格式
-        export_data = {
-            'id': email['id'],
-            'timestamp': email['timestamp'],
-            'datetime': email['datetime'],
-            'sender_ip': email['sender_ip'],
-            'from': email['mail_from'],
-            'to': email.get('recipients', []),
-            'subject': email['subject'],
-            'plaintext_body': email['plaintext_body'],
-            'html_body': email['html_body'],
-            'attachments': email.get('attachments', []),
-            'raw_size': email['raw_size']
-        }
+        export_data = email_to_export_dict(email)
         
         filename = f"email_{email_id}_{int(email['timestamp'])}.json"
         with open(filename, 'w', encoding='utf-8') as f:
@@ -142,7 +169,54 @@ def export_email(db, email_id, format='json'):
         else:
             print("❌ 该邮件没有原始内容数据")
 
-def show_stats(db):
+def mbox_entry(email):
+    """生成单封邮件的 mboxrd 格式内容"""
+    sender = (email['mail_from'] or 'MAILER-DAEMON').split()[-1].strip('<>') or 'MAILER-DAEMON'
+    received = time.asctime(time.gmtime(float(email['timestamp'])))
+    raw = bytes(email['raw_content']).replace(b'\r\n', b'\n')
+    # mboxrd：正文中以 "From " 开头（含已转义的 ">From "）的行再加一个 ">"
+    raw = re.sub(rb'^(>*From )', rb'>\1', raw, flags=re.MULTILINE)
+    if not raw.endswith(b'\n'):
+        raw += b'\n'
+    return f"From {sender} {received}\n".encode('utf-8') + raw + b'\n'
+
+def export_emails(db, output, format='jsonl', ids=None, recipient=None, before_ts=None, after_ts=None):
+    """批量导出邮件到单个 mbox 或 JSONL 文件（流式写入）"""
+    exported = 0
+    skipped = 0
+    
+    with open(output, 'wb') as f:
+        for email in db.iter_emails(ids=ids, recipient=recipient, before_ts=before_ts, after_ts=after_ts):
+            if format == 'mbox':
+                if not email['raw_content']:
+                    skipped += 1
+                    continue
+                f.write(mbox_entry(email))
+            else:
+                line = json.dumps(email_to_export_dict(email), ensure_ascii=False)
+                f.write(line.encode('utf-8') + b'\n')
+            exported += 1
+    
+    print(f"✅ 已导出 {exported} 封邮件到: {output}")
+    if skipped:
+        print(f"⚠️ {skipped} 封邮件没有原始内容数据，已跳过")
+
+def delete_emails(db, ids=None, recipient=None, before_ts=None):
+    """批量删除邮件"""
+    if not ids and recipient is None and before_ts is None:
+        print("❌ 请至少指定邮件ID、--recipient 或 --before 中的一个")
+        return
+    
+    deleted = db.delete_emails(ids=ids or None, recipient=recipient, before_ts=before_ts)
+    print(f"✅ 已删除 {deleted} 封邮件")
+
+def parse_time_arg(value):
+    """解析命令行时间参数（YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS）为时间戳"""
+    if value is None:
+        return None
+    return datetime.fromisoformat(value).timestamp()
+
+def show_stats(db, days=7, top=10, domain=None):
     """显示统计信息"""
     stats = db.get_stats()
     
@@ -153,81 +227,72 @@ def show_stats(db):
     print(f"失败邮件数: {stats.get('failed_emails', 0)}")
     print(f"总附件数: {stats.get('total_attachments', 0)}")
     print(f"唯一收件人数: {stats.get('unique_recipients', 0)}")
+    print(f"邮件总大小: {stats.get('total_bytes', 0)} 字节")
     
-    # 获取最近的邮件
-    try:
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # 最近一封邮件时间
-        cursor.execute("SELECT MAX(timestamp) FROM emails")
-        latest = cursor.fetchone()[0]
-        if latest:
-            latest_time = datetime.fromtimestamp(latest)
-            print(f"最新邮件: {latest_time.strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        # 今天的邮件数量
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        cursor.execute("SELECT COUNT(*) FROM emails WHERE timestamp >= %s", (today_start.timestamp(),))
-        today_count = cursor.fetchone()[0]
-        print(f"今天收到: {today_count} 封邮件")
-        
-        conn.close()
-    except Exception as e:
-        print(f"获取额外统计信息失败: {e}")
+    latest = stats.get('latest_timestamp')
+    if latest:
+        latest_time = datetime.fromtimestamp(latest)
+        print(f"最新邮件: {latest_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    # 按天统计（第一行为今天）
+    daily = db.get_daily_stats(days)
+    today = datetime.now().date()
+    today_count = daily[0]['emails'] if daily and daily[0]['stat_date'] == today else 0
+    print(f"今天收到: {today_count} 封邮件")
+    
+    if daily:
+        print("\n" + "-"*50)
+        print(f"最近 {days} 天:")
+        for row in daily:
+            print(f"  {row['stat_date']} | {row['emails']:>8} 封 | {row['attachments']:>6} 附件 | {row['bytes']} 字节")
+    
+    domains = db.get_domain_stats(top)
+    if domains:
+        print("\n" + "-"*50)
+        print(f"收件域名 Top {top}:")
+        for row in domains:
+            print(f"  {row['domain']:<40} {row['emails']:>8} 封")
+    
+    recipients = db.get_recipient_stats(top, domain)
+    if recipients:
+        print("\n" + "-"*50)
+        print(f"收件人 Top {top}" + (f" ({domain})" if domain else "") + ":")
+        for row in recipients:
+            print(f"  {row['recipient_email']:<40} {row['emails']:>8} 封")
     
     print("="*50)
 
-def search_emails(db, query, field='all'):
+def purge_emails(db, days):
+    """删除早于指定天数的邮件（按分区整体删除）"""
+    if not db.partition_by:
+        # 未分区时退化为分批删除
+        before_ts = (datetime.now() - timedelta(days=days)).timestamp()
+        deleted = db.delete_emails(before_ts=before_ts)
+        print(f"✅ 已删除 {deleted} 封早于 {days} 天的邮件")
+        return
+    
+    dropped = db.maintain_partitions(days)
+    
+    if dropped:
+        print(f"✅ 已删除 {len(dropped)} 个过期分区: {', '.join(dropped)}")
+    else:
+        print(f"没有早于 {days} 天的完整分区")
+
+def search_emails(db, query, field='all', limit=50, output=None):
     """搜索邮件"""
     try:
-        conn = db.get_connection()
-        cursor = conn.cursor(dictionary=True)
+        if not output:
+            print(f"搜索结果: '{query}' (字段: {field})")
+            print("="*100)
         
-        if field == 'all':
-            sql = """
-                SELECT e.* FROM emails e
-                WHERE e.mail_from LIKE %s OR e.subject LIKE %s 
-                OR e.plaintext_body LIKE %s OR e.html_body LIKE %s
-                ORDER BY e.timestamp DESC
-                LIMIT 50
-            """
-            params = [f"%{query}%"] * 4
-        elif field == 'from':
-            sql = "SELECT * FROM emails WHERE mail_from LIKE %s ORDER BY timestamp DESC LIMIT 50"
-            params = [f"%{query}%"]
-        elif field == 'subject':
-            sql = "SELECT * FROM emails WHERE subject LIKE %s ORDER BY timestamp DESC LIMIT 50"
-            params = [f"%{query}%"]
-        elif field == 'recipient':
-            sql = """
-                SELECT e.* FROM emails e
-                JOIN email_recipients er ON e.id = er.email_id
-                WHERE er.recipient_email LIKE %s
-                ORDER BY e.timestamp DESC LIMIT 50
-            """
-            params = [f"%{query}%"]
-        else:
-            print(f"❌ 不支持的搜索字段: {field}")
-            return
+        count = stream_summaries(db.iter_search(query, field, limit or None), output)
         
-        cursor.execute(sql, params)
-        emails = cursor.fetchall()
-        conn.close()
-        
-        if not emails:
+        if count == 0:
             print(f"没有找到匹配 '{query}' 的邮件")
-            return
-        
-        print(f"搜索结果: '{query}' (字段: {field})")
-        print("="*100)
-        print(f"{'ID':<6} | {'时间':<16} | {'发件人':<32} | 主题")
-        print("-"*100)
-        
-        for email in emails:
-            print(format_email_summary(email))
-        
-        print(f"\n找到 {len(emails)} 封匹配的邮件")
+        elif output:
+            print(f"✅ 已输出 {count} 封匹配的邮件到: {output}")
+        else:
+            print(f"\n找到 {count} 封匹配的邮件")
         
     except Exception as e:
         print(f"❌ 搜索失败: {e}")
@@ -235,14 +300,16 @@ def search_emails(db, query, field='all'):
 def main():
     parser = argparse.ArgumentParser(description='邮件数据库管理工具')
     parser.add_argument('--db', default='./emails.db', help='数据库文件路径')
+    parser.add_argument('--partition-by', choices=['day', 'week'], help='邮件表的分区方式（按天或按周）')
     
     subparsers = parser.add_subparsers(dest='command', help='可用命令')
     
     # list 命令
     list_parser = subparsers.add_parser('list', help='列出邮件')
     list_parser.add_argument('--recipient', '-r', help='按收件人筛选')
-    list_parser.add_argument('--limit', '-l', type=int, default=20, help='显示数量')
+    list_parser.add_argument('--limit', '-l', type=int, default=20, help='显示数量（0 表示不限制）')
     list_parser.add_argument('--offset', '-o', type=int, default=0, help='偏移量')
+    list_parser.add_argument('--output', '-O', help='以 JSONL 格式流式写入该文件')
     
     # show 命令
     show_parser = subparsers.add_parser('show', help='显示邮件详情')
@@ -253,14 +320,39 @@ def main():
     export_parser.add_argument('id', type=int, help='邮件ID')
     export_parser.add_argument('--format', '-f', choices=['json', 'eml'], default='json', help='导出格式')
     
+    # bulk-export 命令
+    bulk_export_parser = subparsers.add_parser('bulk-export', help='批量导出邮件到单个文件')
+    bulk_export_parser.add_argument('output', help='输出文件路径')
+    bulk_export_parser.add_argument('--format', '-f', choices=['jsonl', 'mbox'], default='jsonl', help='导出格式')
+    bulk_export_parser.add_argument('--ids', type=int, nargs='+', help='邮件ID列表')
+    bulk_export_parser.add_argument('--recipient', '-r', help='按收件人筛选')
+    bulk_export_parser.add_argument('--after', help='起始时间（YYYY-MM-DD[ HH:MM:SS]）')
+    bulk_export_parser.add_argument('--before', help='截止时间（YYYY-MM-DD[ HH:MM:SS]）')
+    
+    # delete 命令
+    delete_parser = subparsers.add_parser('delete', help='批量删除邮件')
+    delete_parser.add_argument('ids', type=int, nargs='*', help='邮件ID列表')
+    delete_parser.add_argument('--recipient', '-r', help='删除该收件人的全部邮件')
+    delete_parser.add_argument('--before', help='删除早于该时间的邮件（YYYY-MM-DD[ HH:MM:SS]）')
+    
     # stats 命令
     stats_parser = subparsers.add_parser('stats', help='显示统计信息')
+    stats_parser.add_argument('--days', '-d', type=int, default=7, help='按天统计的天数')
+    stats_parser.add_argument('--top', '-t', type=int, default=10, help='域名/收件人排行数量')
+    stats_parser.add_argument('--domain', help='只显示该域名下的收件人排行')
+    stats_parser.add_argument('--rebuild', action='store_true', help='根据现有数据全量重建统计表')
+    
+    # purge 命令
+    purge_parser = subparsers.add_parser('purge', help='删除过期邮件')
+    purge_parser.add_argument('--days', '-d', type=float, required=True, help='保留天数')
     
     # search 命令
     search_parser = subparsers.add_parser('search', help='搜索邮件')
     search_parser.add_argument('query', help='搜索关键词')
     search_parser.add_argument('--field', '-f', choices=['all', 'from', 'subject', 'recipient'], 
                               default='all', help='搜索字段')
+    search_parser.add_argument('--limit', '-l', type=int, default=50, help='最多返回数量（0 表示不限制）')
+    search_parser.add_argument('--output', '-O', help='以 JSONL 格式流式写入该文件')
     
     args = parser.parse_args()
     
@@ -270,22 +362,31 @@ def main():
     
     # 初始化数据库连接
     try:
-        db = EmailDatabase(args.db)
+        db = EmailDatabase(args.db, partition_by=args.partition_by)
     except Exception as e:
         print(f"❌ 数据库连接失败: {e}")
         sys.exit(1)
     
     # 执行命令
     if args.command == 'list':
-        list_emails(db, args.recipient, args.limit, args.offset)
+        list_emails(db, args.recipient, args.limit, args.offset, args.output)
     elif args.command == 'show':
         show_email(db, args.id)
     elif args.command == 'export':
         export_email(db, args.id, args.format)
+    elif args.command == 'bulk-export':
+        export_emails(db, args.output, args.format, args.ids, args.recipient,
+                      parse_time_arg(args.before), parse_time_arg(args.after))
+    elif args.command == 'delete':
+        delete_emails(db, args.ids, args.recipient, parse_time_arg(args.before))
     elif args.command == 'stats':
-        show_stats(db)
+        if args.rebuild:
+            db.rebuild_stats()
+        show_stats(db, args.days, args.top, args.domain)
+    elif args.command == 'purge':
+        purge_emails(db, args.days)
     elif args.command == 'search':
-        search_emails(db, args.query, args.field)
+        search_emails(db, args.query, args.field, args.limit, args.output)
 
 if __name__ == '__main__':
     main()
@@ -16,6 +16,11 @@ from email.header import decode_header, make_header
 from email import policy
 from email_database import EmailDatabase
 
+try:
+    from async_email_database import AsyncEmailDatabase
+except ImportError:  # 未安装 aiomysql 时退回同步数据库
+    AsyncEmailDatabase = None
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -41,7 +46,12 @@ MYSQL_USER = "tempmail"
 MYSQL_PASSWORD = "tempmail"
 
 ENABLE_DATABASE = True  # 是否启用数据库存储
+ENABLE_ASYNC_DATABASE = True  # 是否使用异步连接池写入数据库（需要 aiomysql）
+ASYNC_POOL_SIZE = 10  # 异步连接池最大连接数
 ENABLE_JSON_BACKUP = True  # 是否保留JSON文件备份
+PARTITION_BY = None  # 邮件表分区方式：'day'、'week' 或 None（不分区）
+RETENTION_DAYS = None  # 分区表的邮件保留天数，None 表示不自动删除
+MAINTENANCE_INTERVAL = 86400  # 分区维护（预建分区、删除过期分区）的间隔秒数
 
 class SimpleMailHandler:
     """简化的邮件处理器"""
@@ -61,12 +71,29 @@ class SimpleMailHandler:
                     port=MYSQL_PORT,
                     database=MYSQL_DATABASE,
                     user=MYSQL_USER,
-                    password=MYSQL_PASSWORD
+                    password=MYSQL_PASSWORD,
+                    partition_by=PARTITION_BY
                 )
                 logger.info(f"✅ 数据库连接成功: {MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DATABASE}")
             except Exception as e:
                 logger.error(f"❌ 数据库连接失败: {e}")
                 logger.warning("⚠️ 将仅使用JSON文件存储")
+        
+        # 异步连接池（表结构已由上面的同步连接初始化），在SMTP事件循环中首次使用时创建
+        self.async_db = None
+        if self.db and ENABLE_ASYNC_DATABASE:
+            if AsyncEmailDatabase is None:
+                logger.warning("⚠️ 未安装 aiomysql，将使用同步数据库写入: pip install aiomysql")
+            else:
+                self.async_db = AsyncEmailDatabase(
+                    host=MYSQL_HOST,
+                    port=MYSQL_PORT,
+                    database=MYSQL_DATABASE,
+                    user=MYSQL_USER,
+                    password=MYSQL_PASSWORD,
+                    partition_by=PARTITION_BY,
+                    maxsize=ASYNC_POOL_SIZE
+                )
     
     async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
         """处理收件人验证"""
@@ -130,7 +157,7 @@ class SimpleMailHandler:
             except Exception as e:
                 logger.error(f"❌ 邮件解析失败: {e}")
                 # 即使解析失败也要保存原始数据
-                self.save_raw_email_data(peer_ip, envelope, str(e))
+                await self.save_raw_email_data(peer_ip, envelope, str(e))
                 return '250 Message accepted (parsing failed but saved)'
             
             # 提取邮件信息
@@ -193,7 +220,7 @@ class SimpleMailHandler:
             }
             
             # 保存邮件数据
-            self.save_email_data(email_data)
+            await self.save_email_data(email_data)
             
             # 构建用于JSON备份的数据（截断长文本）
             if ENABLE_JSON_BACKUP:
@@ -213,14 +240,17 @@ class SimpleMailHandler:
             logger.error(f"❌ 处理邮件时出错: {e}")
             return '451 Requested action aborted: local error in processing'
     
-    def save_email_data(self, email_data):
+    async def save_email_data(self, email_data):
         """保存邮件数据到数据库和/或文件"""
         saved_to_db = False
         
         # 尝试保存到数据库
         if ENABLE_DATABASE and self.db:
             try:
-                email_id = self.db.save_email(email_data)
+                if self.async_db:
+                    email_id = await self.async_db.save_email(email_data)
+                else:
+                    email_id = self.db.save_email(email_data)
                 if email_id:
                     logger.info(f"💾 邮件已保存到数据库，ID: {email_id}")
                     saved_to_db = True
@@ -252,19 +282,27 @@ class SimpleMailHandler:
         except Exception as e:
             logger.error(f"保存邮件JSON备份失败: {e}")
     
-    def save_raw_email_data(self, peer_ip, envelope, error_message):
+    async def save_raw_email_data(self, peer_ip, envelope, error_message):
         """保存原始邮件数据（当解析失败时）"""
         saved_to_db = False
         
         # 尝试保存到数据库
         if ENABLE_DATABASE and self.db:
             try:
-                record_id = self.db.save_failed_email(
-                    peer_ip, 
-                    envelope.mail_from, 
-                    envelope.content, 
-                    error_message
-                )
+                if self.async_db:
+                    record_id = await self.async_db.save_failed_email(
+                        peer_ip, 
+                        envelope.mail_from, 
+                        envelope.content, 
+                        error_message
+                    )
+                else:
+                    record_id = self.db.save_failed_email(
+                        peer_ip, 
+                        envelope.mail_from, 
+                        envelope.content, 
+                        error_message
+                    )
                 if record_id:
                     logger.info(f"💾 失败邮件已保存到数据库，ID: {record_id}")
                     saved_to_db = True
@@ -296,6 +334,14 @@ class SimpleMailHandler:
             except Exception as e:
                 logger.error(f"保存原始邮件JSON备份失败: {e}")
     
+    def run_maintenance(self):
+        """定期维护分区表：预建未来分区，按 RETENTION_DAYS 删除过期分区"""
+        if not self.db or not PARTITION_BY:
+            return
+        dropped = self.db.maintain_partitions(RETENTION_DAYS)
+        if dropped:
+            logger.info(f"🧹 已删除过期分区: {', '.join(dropped)}")
+    
     def print_email_summary(self, email_data):
         """在控制台打印邮件摘要"""
         print("\n" + "="*60)
@@ -345,9 +391,13 @@ def main():
         print(f"   按 Ctrl+C 停止服务")
         print("\n🔍 等待邮件...")
         
-        # 保持运行
+        # 保持运行，并定期维护分区
+        last_maintenance = 0
         try:
             while True:
+                if time.time() - last_maintenance >= MAINTENANCE_INTERVAL:
+                    last_maintenance = time.time()
+                    handler.run_maintenance()
                 time.sleep(1)
         except KeyboardInterrupt:
             print("\n🛑 收到停止信号")
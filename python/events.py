@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import socket
+
+logger = logging.getLogger(__name__)
+
+# New-message events for /events/<email> and /wait/<email> of the read API
+#
+# Subscribers are queues in one dict keyed by address ('*' gets every mailbox), so an idle
+# subscriber costs nothing until mail arrives. Mail is stored in the SMTP controller threads,
+# publish() hands the event to the loop of the read API.
+# With WORKERS every worker has its own subscribers, events are forwarded to the others as UDP
+# datagrams on 127.0.0.1, worker N listening on READAPI_PORT+N
+
+QUEUE_SIZE = 100
+ALL = '*'
+
+class MessageEvents:
+    def __init__(self):
+        self.subscribers = {}
+        self.loop = None
+        self.sock = None
+        self.transport = None
+        self.peers = ()
+
+    async def start(self, port=0, index=0, workers=1):
+        self.loop = asyncio.get_running_loop()
+        if workers > 1 and port > 0:
+            self.peers = tuple(('127.0.0.1', port + i) for i in range(workers) if i != index)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+            self.transport, _ = await self.loop.create_datagram_endpoint(lambda: BridgeProtocol(self), local_addr=('127.0.0.1', port + index))
+
+    def subscribe(self, email):
+        queue = asyncio.Queue(QUEUE_SIZE)
+        self.subscribers.setdefault(email, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, email, queue):
+        queues = self.subscribers.get(email)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[email]
+
+    def __len__(self):
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    def publish(self, email, event):
+        # thread safe, a no-op while the read API isn't running
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.dispatch, email, event)
+        if self.peers:
+            data = json.dumps(event).encode('utf-8')
+            for peer in self.peers:
+                try:
+                    self.sock.sendto(data, peer)
+                except OSError as e:
+                    logger.debug("Could not forward event to %s: %s" % (peer, e))
+
+    def dispatch(self, email, event):
+        for key in (email, ALL):
+            for queue in list(self.subscribers.get(key, ())):
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    # a subscriber that doesn't read is dropped, it can reconnect with Last-Event-ID
+                    self.close_queue(queue)
+                    self.unsubscribe(key, queue)
+
+    def close(self):
+        # ends all subscriptions on shutdown
+        for queues in list(self.subscribers.values()):
+            for queue in list(queues):
+                self.close_queue(queue)
+        self.subscribers = {}
+        self.loop = None
+        if self.transport is not None:
+            self.transport.close()
+            self.sock.close()
+
+    def close_queue(self, queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+class BridgeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, events):
+        self.events = events
+
+    def datagram_received(self, data, addr):
+        try:
+            event = json.loads(data)
+            self.events.dispatch(event['email'], event)
+        except (ValueError, KeyError, TypeError):
+            pass
@@ -0,0 +1,179 @@
+import fcntl
+import html
+import json
+import os
+import re
+import shutil
+import time
+from email.utils import formatdate
+
+from listing import listing_of
+from messageid import received_ms
+from storage import write_file
+
+# Per mailbox feeds in data/<email>/feed/, rewritten by mailserver3.py whenever it stores or
+# deletes a message, so web/ can serve them as static files
+#
+#   rss.xml     what web/templates/rss.xml.php renders, for the newest FEED_ITEMS messages
+#   list.json   the /json/<email> list, only while the mailbox has no more than FEED_ITEMS messages
+#   state.json  the listing fields of the items both are rendered from, so a new message doesn't mean
+#               listing the mailbox. It's rewritten every time, the bodies are read from the messages
+#
+# web/ removes the directory when it deletes a message, the next write rebuilds it from the messages
+
+FEED_DIR = 'feed'
+
+def feed_item(message_id, data):
+    parsed = data.get('parsed') or {}
+    listing = listing_of(message_id, data)
+    return {
+        'id': str(message_id),
+        'from': parsed.get('from'),
+        'subject': parsed.get('subject'),
+        'rcpts': data.get('rcpts') or [],
+        'attachments': parsed.get('attachments'),
+        'md5': listing['md5'],
+        'maillen': listing['maillen'],
+        'preview': listing['preview'],
+        'attachment_count': listing['attachment_count'],
+    }
+
+def message_ids(mailbox):
+    return [int(name[:-5]) for name in os.listdir(mailbox) if name.endswith('.json') and name[:-5].isdigit()]
+
+def scan_state(mailbox, limit):
+    ids = sorted(message_ids(mailbox), reverse=True)
+    items = []
+    for message_id in ids[:limit]:
+        try:
+            with open(os.path.join(mailbox, '%d.json' % message_id)) as f:
+                items.append(feed_item(message_id, json.load(f)))
+        except (OSError, ValueError):
+            pass
+    return {'total': len(ids), 'items': items}
+
+def with_bodies(mailbox, items):
+    out = []
+    for item in items:
+        try:
+            with open(os.path.join(mailbox, '%s.json' % item['id'])) as f:
+                parsed = json.load(f).get('parsed') or {}
+        except (OSError, ValueError):
+            parsed = {}
+        out.append(dict(item, body=parsed.get('body'), htmlbody=parsed.get('htmlbody')))
+    return out
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class FeedLock:
+    # serializes feed updates of one mailbox across threads and workers
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.lock')
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+def add_message(mailbox, email, message_id, data, url, limit):
+    directory = os.path.join(mailbox, FEED_DIR)
+    os.makedirs(directory, exist_ok=True)
+    with FeedLock(directory):
+        state = load_state(os.path.join(directory, 'state.json'))
+        if state is None:
+            # also covers the message that was just written
+            state = scan_state(mailbox, limit)
+        elif not any(item['id'] == str(message_id) for item in state['items']):
+            state['total'] += 1
+            state['items'].insert(0, feed_item(message_id, data))
+            state['items'].sort(key=lambda item: int(item['id']), reverse=True)
+            del state['items'][limit:]
+        write_feeds(directory, email, state, url, limit)
+
+def rebuild(mailbox, email, url, limit):
+    # after deleting messages, returns False if the mailbox has none left (and no feed)
+    directory = os.path.join(mailbox, FEED_DIR)
+    if not message_ids(mailbox):
+        shutil.rmtree(directory, ignore_errors=True)
+        return False
+    os.makedirs(directory, exist_ok=True)
+    with FeedLock(directory):
+        write_feeds(directory, email, scan_state(mailbox, limit), url, limit)
+    return True
+
+def write_feeds(directory, email, state, url, limit):
+    # oldest first like rss.xml.php and getEmailsOfEmail
+    items = with_bodies(os.path.dirname(directory), sorted(state['items'], key=lambda item: int(item['id'])))
+    write_file(os.path.join(directory, 'rss.xml'), render_rss(email, items, url).encode('utf-8'))
+    if state['total'] <= limit:
+        write_file(os.path.join(directory, 'list.json'), json.dumps(render_list(email, items, url) or []).encode('utf-8'))
+    else:
+        try:
+            os.remove(os.path.join(directory, 'list.json'))
+        except FileNotFoundError:
+            pass
+    write_file(os.path.join(directory, 'state.json'), json.dumps(state).encode('utf-8'))
+
+def render_list(email, items, url):
+    o = {}
+    for item in items:
+        attachments = item['attachments']
+        if isinstance(attachments, list):
+            attachments = [url + '/api/attachment/' + email + '/' + a for a in attachments]
+        o[item['id']] = {'email': email, 'id': item['id'], 'from': item['from'], 'subject': item['subject'],
+                         'md5': item['md5'], 'maillen': item['maillen'], 'preview': item.get('preview'),
+                         'attachment_count': item.get('attachment_count', len(item['attachments'] or [])),
+                         'body': item['body'], 'attachments': attachments}
+    return o
+
+def render_rss(email, items, url):
+    escape = lambda value: html.escape(value or '', quote=True)
+    out = ['<?xml version="1.0" ?>',
+           '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">',
+           '<channel>',
+           '  <atom:link href="%s/rss/%s" rel="self" type="application/rss+xml" />' % (url, email),
+           '  <title>RSS for %s</title>' % email,
+           '  <link>%s/eml/%s</link>' % (url, email),
+           '  <description>RSS Feed for email address %s</description>' % email,
+           '  <lastBuildDate>%s</lastBuildDate>' % formatdate(time.time(), usegmt=True),
+           '  <image>',
+           '      <title>RSS for %s</title>' % email,
+           '      <url>https://raw.githubusercontent.com/HaschekSolutions/opentrashmail/master/web/imgs/logo_300.png</url>',
+           '      <link>https://github.com/HaschekSolutions/opentrashmail</link>',
+           '  </image>']
+    for item in items:
+        attachments = []
+        for filename in item['attachments'] or []:
+            name = filename.split('-')[1] if '-' in filename else filename
+            attachments.append("<a href='%s/api/attachment/%s/%s' target='_blank'>%s</a>" % (url, email, filename, name))
+        if item['htmlbody']:
+            body = item['htmlbody']
+        else:
+            # nl2br()
+            body = re.sub(r'(\r\n|\n|\r)', r'<br />\1', escape(item['body']))
+        out += ['    <item>',
+                '        <title><![CDATA[%s]]></title>' % (item['subject'] or ''),
+                '        <pubDate>%s</pubDate>' % formatdate(received_ms(item['id']) // 1000, usegmt=True),
+                '        <link>%s/eml/%s/%s</link>' % (url, email, item['id']),
+                '        <description>',
+                '            <![CDATA[',
+                '            Email from: %s<br/>' % escape(item['from']),
+                '            Email to: %s<br/>' % escape(';'.join(item['rcpts'])),
+                '            %s' % ('Attachments:<br/><ul>' + ''.join('<li>%s</li>' % a for a in attachments) + '</ul><br/>' if attachments else ''),
+                '            <a href="%s/api/raw/%s/%s">View raw email</a> <br/>' % (url, email, item['id']),
+                '            <br/>---------<br/><br/>',
+                '            %s' % body,
+                '            ]]>',
+                '        </description>',
+                '    </item>']
+    out += ['</channel>', '</rss>', '']
+    return '\n'.join(out)
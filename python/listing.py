@@ -0,0 +1,71 @@
+import hashlib
+from html.parser import HTMLParser
+
+# The fields mailbox listings show, computed once when a message is received and stored with
+# it as 'listing' in data/<email>/<id>.json and in the messages table of the registry
+#
+#   md5               md5 of id + raw message, what web/ always sent as 'md5'
+#   maillen           size of the raw message in bytes
+#   preview           the start of the text, tags stripped if the mail only has HTML
+#   attachment_count  number of attachments
+#
+# listing_of() computes them for messages stored before, so nothing needs to be migrated
+
+PREVIEW_LENGTH = 200
+
+class TextExtractor(HTMLParser):
+    # collects the text of an HTML body, without scripts, styles and the head
+    SKIP = ('script', 'style', 'head', 'title')
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+def html_text(html):
+    parser = TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # HTMLParser is lenient, anything it chokes on just ends the preview
+        pass
+    return ' '.join(parser.parts)
+
+def preview(plaintext, html, length=PREVIEW_LENGTH):
+    text = plaintext if plaintext and plaintext.strip() else html_text(html or '')
+    text = ' '.join(text.split())
+    if len(text) > length:
+        text = text[:length - 1].rstrip() + '…'
+    return text
+
+def message_listing(message_id, raw, plaintext, html, attachment_count):
+    # raw as received (bytes) or as stored (str)
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+    return {
+        'md5': hashlib.md5(str(message_id).encode('utf-8') + raw).hexdigest(),
+        'maillen': len(raw),
+        'preview': preview(plaintext, html),
+        'attachment_count': attachment_count,
+    }
+
+def listing_of(message_id, data):
+    listing = data.get('listing')
+    if isinstance(listing, dict):
+        return listing
+    parsed = data.get('parsed') or {}
+    return message_listing(message_id, data.get('raw') or '', parsed.get('body'), parsed.get('htmlbody'),
+                           len(parsed.get('attachments') or []))
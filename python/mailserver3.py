@@ -2,6 +2,8 @@ import aiohttp
 import asyncio
 import ssl
 from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP, MISSING, syntax
+from aiohttp import web
 from email.parser import BytesParser
 from email.header import decode_header, make_header
 from email import policy
@@ -12,31 +14,305 @@ import json
 import hashlib
 import hmac
 import configparser
+import sqlite3
+import shutil
+import signal
+import multiprocessing
+import logging.handlers
+from collections import namedtuple
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import logging
 from pprint import pprint
+from metrics import REGISTRY
+from ratelimit import SenderLimits, parse_networks
+from storage import DURABILITY, LAYOUTS, GroupCommit, ensure_mailbox, iter_mailboxes, mailbox_path, prune_shards, write_file
+from registry import MailboxRegistry, SCHEMA_VERSION
+from messageid import NODES, MessageIds, received_ms
+from listing import message_listing
+from readapi import ReadAPI, message_event, start_readapi_server
+import feeds
+import render
 
 logger = logging.getLogger(__name__)
 
-# globals for settings
-DISCARD_UNKNOWN = False
-DELETE_OLDER_THAN_DAYS = False
-ATTACHMENTS_MAX_SIZE = 0
-DOMAINS = []
+CONFIG_PATH = "../config.ini"
+CONFIG_POLL_INTERVAL = 2
 LAST_CLEANUP = 0
-URL = ""
-MAILPORT_TLS = 0
-TLS_CERTIFICATE = ""
-TLS_PRIVATE_KEY = ""
-WEBHOOK_URL = ""
+WORKER_INDEX = 0
+STOPPING = False
+# the TLS context shared by all listeners, certificates are reloaded into it
+TLS_CONTEXT = None
+# per sender IP buckets, kept across reloads and shared by the listeners of this process
+SENDER_LIMITS = SenderLimits()
+# data/registry.sqlite, per mailbox counters for listing accounts
+MAILBOXES = MailboxRegistry()
+# worker index is the node part of the ids, see messageid.py
+MESSAGE_IDS = MessageIds()
+# batches the fsyncs of DURABILITY=group
+GROUP_COMMIT = GroupCommit()
+
+class DomainMatcher:
+    # DOMAINS precomputed into exact names and wildcard suffixes ("*.mydom.com" -> ".mydom.com")
+    def __init__(self, domains):
+        self.exact = frozenset(x for x in domains if "*" not in x)
+        self.suffixes = tuple(x.replace('*', '') for x in domains if "*" in x)
+
+    def __contains__(self, domain):
+        return domain in self.exact or domain.endswith(self.suffixes)
+
+# Immutable snapshot of config.ini. Reloads build a new one and swap SETTINGS,
+# so a message is always handled with one consistent set of values
+Settings = namedtuple('Settings', [
+    'port', 'discard_unknown', 'domains', 'domain_matcher', 'url', 'attachments_max_size',
+    'delete_older_than_days', 'mailport_tls', 'tls_certificate', 'tls_private_key',
+    'webhook_url', 'metrics_port', 'metrics_host', 'workers', 'shutdown_timeout',
+    'tls_session_tickets', 'tls_num_tickets', 'tls_ciphers', 'tls_prefer_server_ciphers',
+    'tls_ecdh_curve', 'tls_minimum_version', 'ratelimit_max_connections', 'ratelimit_connections',
+    'ratelimit_messages', 'ratelimit_prefix_messages', 'ratelimit_recipients', 'ratelimit_max_tracked',
+    'ratelimit_exempt', 'data_layout', 'durability', 'group_commit_ms', 'readapi_port', 'readapi_host',
+    'readapi_cache_size', 'password', 'allowed_ips', 'admin', 'feed_items', 'html_cache_size',
+], defaults=[25, False, (), DomainMatcher(()), "", 0, 0, 0, "", "", "", 0, "127.0.0.1", 1, 8,
+             True, 2, "", True, "", "", 0, 0, 0, 0, 0, 10000, (), 'flat', 'none', 10, 0, "127.0.0.1",
+             1000, "", "", "", 0, 0])
+
+SETTINGS = Settings()
+# JSON API on READAPI_PORT, its cache is updated by process_message
+READ_API = ReadAPI(MAILBOXES, lambda: SETTINGS)
+
+STAGE_SECONDS = REGISTRY.histogram('opentrashmail_stage_seconds', 'Time spent in each stage of handling a message', ['stage'])
+MESSAGES = REGISTRY.counter('opentrashmail_messages_total', 'Messages received by result', ['result'])
+MAILS = REGISTRY.counter('opentrashmail_mails_total', 'Recipients of received messages by outcome', ['outcome'])
+WEBHOOKS = REGISTRY.counter('opentrashmail_webhooks_total', 'Webhook deliveries by kind and result', ['kind', 'result'])
+OPEN_SESSIONS = REGISTRY.gauge('opentrashmail_open_sessions', 'Open SMTP sessions', ['listener'])
+MESSAGES_IN_FLIGHT = REGISTRY.gauge('opentrashmail_messages_in_flight', 'Messages currently being processed')
+WEBHOOKS_IN_FLIGHT = REGISTRY.gauge('opentrashmail_webhooks_in_flight', 'Webhook deliveries currently in progress')
+TLS_HANDSHAKE_SECONDS = REGISTRY.histogram('opentrashmail_tls_handshake_seconds', 'TLS handshake time from the start of the TLS wrap (accept or STARTTLS) to established', ['listener'])
+TLS_HANDSHAKES = REGISTRY.counter('opentrashmail_tls_handshakes_total', 'Completed TLS handshakes by whether the session was resumed', ['listener', 'resumed'])
+TLS_SESSION_CACHE = REGISTRY.gauge('opentrashmail_tls_session_cache', 'OpenSSL server session cache statistics', ['stat'])
+SESSION_MESSAGES = REGISTRY.histogram('opentrashmail_session_messages', 'Messages received per SMTP session', ['listener'],
+                                      buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 1000))
+MESSAGE_SECONDS = REGISTRY.histogram('opentrashmail_message_seconds', 'Time to handle a message by whether it is the first of its SMTP session', ['session'])
+TRANSFERS = REGISTRY.counter('opentrashmail_transfers_total', 'Messages received by SMTP command', ['command'])
+SESSION_CACHE = REGISTRY.counter('opentrashmail_session_cache_total', 'Lookups served from the per-session cache', ['cache', 'result'])
+RATE_LIMITED = REGISTRY.counter('opentrashmail_rate_limited_total', 'Connections and commands deferred by the sender rate limits', ['stage'])
+
+class SessionCache:
+    # Lookups and counters kept for the life of one SMTP session, so bulk senders
+    # delivering many messages per connection don't repeat them for every message.
+    # Webhook configs saved in the web UI apply from the sender's next connection
+    def __init__(self, settings):
+        self.messages = 0
+        self.bytes = 0
+        self.reset(settings)
+
+    def reset(self, settings):
+        # verdicts depend on DOMAINS/DISCARD_UNKNOWN, start over after a reload
+        self.settings = settings
+        self.verdicts = {}
+        self.dirs = set()
+        self.webhooks = {}
+
+def session_cache(session, settings):
+    cache = getattr(session, 'cache', None)
+    if cache is None:
+        cache = session.cache = SessionCache(settings)
+    elif cache.settings is not settings:
+        cache.reset(settings)
+    return cache
+
+class InstrumentedSMTP(SMTP):
+    # connection_made runs again after STARTTLS, so only count the first call
+    def __init__(self, handler, listener, **kwargs):
+        super().__init__(handler, **kwargs)
+        self.listener = listener
+        self.counted = False
+        self.refused = None
+        # with TLS on connect the protocol is created when the connection is accepted,
+        # before the handshake. STARTTLS sets it again
+        self.tls_started = time.perf_counter()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if not self.counted and self.refused is None:
+            refusal = SENDER_LIMITS.connect(self.session.peer[0])
+            if refusal is not None:
+                RATE_LIMITED.inc(stage='connect')
+                logger.debug('Refusing connection from %s: %s limit' % (self.session.peer[0], refusal))
+                self.refused = '421 4.7.0 Too many connections from your host, try again later'
+                return
+            self.counted = True
+            OPEN_SESSIONS.inc(listener=self.listener)
+        # set for TLS on connect right away and for STARTTLS on the second call
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            record_tls_handshake(self.listener, ssl_object, self.tls_started)
+
+    def connection_lost(self, error):
+        if self.counted:
+            self.counted = False
+            OPEN_SESSIONS.dec(listener=self.listener)
+            SENDER_LIMITS.disconnect(self.session.peer[0])
+            cache = getattr(self.session, 'cache', None)
+            SESSION_MESSAGES.observe(cache.messages if cache else 0, listener=self.listener)
+            if cache and cache.messages > 1:
+                logger.debug('Session from %s delivered %d messages (%d bytes)', self.session.peer, cache.messages, cache.bytes)
+        super().connection_lost(error)
+
+    async def _handle_client(self):
+        # a refused client gets the 421 instead of the greeting
+        if self.refused is not None:
+            await self.push(self.refused)
+            self.transport.close()
+            return
+        await super()._handle_client()
+
+    async def smtp_EHLO(self, hostname):
+        # advertise CHUNKING (smtp_BDAT below) in front of the final "250 HELP"
+        push = self.push
+        async def push_with_chunking(status):
+            if status == '250 HELP':
+                await push('250-CHUNKING')
+            await push(status)
+        self.push = push_with_chunking
+        try:
+            await super().smtp_EHLO(hostname)
+        finally:
+            del self.push
+
+    async def smtp_STARTTLS(self, arg):
+        # the handshake runs inside, connection_made records it once it's done
+        self.tls_started = time.perf_counter()
+        await super().smtp_STARTTLS(arg)
+
+    async def smtp_DATA(self, arg):
+        if getattr(self.envelope, 'chunks', None) is not None:
+            await self.push('503 Error: BDAT transfer in progress')
+            return
+        await super().smtp_DATA(arg)
+
+    @syntax('BDAT <size> [LAST]')
+    async def smtp_BDAT(self, arg):
+        # RFC 3030: exactly <size> octets follow the command, without dot-stuffing.
+        # aiosmtpd has no CHUNKING, so this mirrors the end of SMTP.smtp_DATA
+        match = re.match(r'(\d+)( +LAST)?$', arg or '', re.IGNORECASE)
+        if not match:
+            await self.push('501 Syntax: BDAT <size> [LAST]')
+            return
+        size = int(match.group(1))
+        # the chunk is already on its way, read it even if it gets refused
+        chunk = await self._reader.readexactly(size)
+        if await self.check_helo_needed() or await self.check_auth_needed('DATA'):
+            return
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if getattr(self.envelope, 'chunks', None) is None:
+            self.envelope.chunks = bytearray()
+        chunks = self.envelope.chunks
+        if self.data_size_limit and len(chunks) + size > self.data_size_limit:
+            self._set_post_data_state()
+            await self.push('552 Error: Too much mail data')
+            return
+        chunks += chunk
+        if match.group(2) is None:
+            await self.push('250 %d octets received' % size)
+            return
+
+        self.envelope.original_content = bytes(chunks)
+        if self._decode_data:
+            self.envelope.content = self.envelope.original_content.decode('utf-8', errors='surrogateescape')
+        else:
+            self.envelope.content = self.envelope.original_content
+        status = await self._call_handler_hook('DATA')
+        self._set_post_data_state()
+        await self.push('250 OK' if status is MISSING else status)
+
+def record_tls_handshake(listener, ssl_object, started):
+    TLS_HANDSHAKE_SECONDS.observe(time.perf_counter() - started, listener=listener)
+    TLS_HANDSHAKES.inc(listener=listener, resumed=str(ssl_object.session_reused).lower())
+
+def apply_tls_settings(context, settings):
+    # TLS tuning from [MAILSERVER]. Only affects handshakes that start afterwards
+    if settings.tls_session_tickets:
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = settings.tls_num_tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    if settings.tls_prefer_server_ciphers:
+        context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    else:
+        context.options &= ~ssl.OP_CIPHER_SERVER_PREFERENCE
+    if settings.tls_ciphers != "":
+        context.set_ciphers(settings.tls_ciphers)
+    if settings.tls_ecdh_curve != "":
+        context.set_ecdh_curve(settings.tls_ecdh_curve)
+    if settings.tls_minimum_version != "":
+        context.minimum_version = ssl.TLSVersion[settings.tls_minimum_version.replace('.', '_')]
+
+def create_tls_context(settings):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    apply_tls_settings(context, settings)
+    context.load_cert_chain(settings.tls_certificate, settings.tls_private_key)
+    return context
+
+class MailController(Controller):
+    def __init__(self, handler, reuse_port=False, **kwargs):
+        self.reuse_port = reuse_port
+        super().__init__(handler, **kwargs)
+
+    def factory(self):
+        return InstrumentedSMTP(self.handler, self.handler.connection_type, **self.SMTP_kwargs)
+
+    def _create_server(self):
+        return self.loop.create_server(self._factory_invoker, host=self.hostname, port=self.port,
+                                       ssl=self.ssl_context, reuse_port=self.reuse_port)
+
+    def _trigger_server(self):
+        # With SO_REUSEPORT the test connection may be accepted by another worker,
+        # so create the protocol once in our own loop instead
+        if self.reuse_port:
+            self.loop.call_soon_threadsafe(self._factory_invoker)
+        else:
+            super()._trigger_server()
 
 class CustomHandler:
     connection_type = ''
     def __init__(self,conntype='Plaintext'):
         self.connection_type = conntype
 
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        # no new transactions while draining for shutdown
+        if STOPPING:
+            return '421 4.3.2 Service shutting down, try again later'
+        if not SENDER_LIMITS.mail(session.peer[0]):
+            RATE_LIMITED.inc(stage='mail')
+            return '451 4.7.1 Too many messages from your host, try again later'
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if not SENDER_LIMITS.rcpt(session.peer[0]):
+            RATE_LIMITED.inc(stage='rcpt')
+            return '451 4.7.1 Too many recipients from your host, try again later'
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
+        return '250 OK'
+
     async def handle_DATA(self, server, session, envelope):
+        TRANSFERS.inc(command='DATA' if getattr(envelope, 'chunks', None) is None else 'BDAT')
+        cache = session_cache(session, SETTINGS)
+        timer = MESSAGE_SECONDS.time(session='reused' if cache.messages else 'first')
+        with MESSAGES_IN_FLIGHT.track(), STAGE_SECONDS.time(stage='total'), timer:
+            return await self.process_message(session, envelope)
+
+    async def process_message(self, session, envelope):
+        settings = SETTINGS
+        cache = session_cache(session, settings)
+        cache.messages += 1
+        cache.bytes += len(envelope.content)
         peer = session.peer
         rcpts = []
         for rcpt in envelope.rcpt_tos:
@@ -47,132 +323,241 @@ class CustomHandler:
         logger.debug('Message addressed from: %s' % envelope.mail_from)
         logger.debug('Message addressed to: %s' % str(rcpts))
 
-        filenamebase = str(int(round(time.time() * 1000)))
+        filenamebase = str(MESSAGE_IDS.next())
 
         # Get the raw email data
         raw_email = envelope.content.decode('utf-8')
 
-        # Parse the email
-        message = BytesParser(policy=policy.default).parsebytes(envelope.content)
+        with STAGE_SECONDS.time(stage='parse'):
+            message, subject = self.parse_message(envelope.content)
+
+        with STAGE_SECONDS.time(stage='decode'):
+            parts = self.extract_parts(message, settings)
+        if parts is None:
+            MESSAGES.inc(result='rejected')
+            return '500 Attachment too large. Max size: ' + str(settings.attachments_max_size/1000000)+"MB"
+        plaintext, html, attachments = parts
+
+        # the same for every recipient, listings read it instead of the raw message
+        with STAGE_SECONDS.time(stage='listing'):
+            listing = self.build_listing(filenamebase, envelope.content, plaintext, html, attachments)
+
+        for em in rcpts:
+                em = em.lower()
+                if not self.accept_recipient(em, settings, cache):
+                    continue
+
+                mailbox = self.mailbox_dir(em, settings, cache)
+
+                with STAGE_SECONDS.time(stage='build'):
+                    savedata = self.build_email_data(em, peer, rcpts, raw_email, message, subject, plaintext, html, attachments, filenamebase, listing)
+                commits = []
+                with STAGE_SECONDS.time(stage='attachments'):
+                    self.save_attachments(em, mailbox, attachments, savedata['parsed'], settings, cache, commits)
+
+                # save actual json data
+                with STAGE_SECONDS.time(stage='serialize'):
+                    payload = self.serialize_email(savedata)
+                with STAGE_SECONDS.time(stage='write'):
+                    self.write_email(mailbox, filenamebase, payload, settings, commits)
+                    # with DURABILITY=group the mail is only acknowledged once it is on disk
+                    for commit in commits:
+                        await asyncio.wrap_future(commit)
+                with STAGE_SECONDS.time(stage='registry'):
+                    seq = update_registry('record_message', em, int(filenamebase), received_ms(filenamebase), len(payload),
+                                          sum(len(a[1]) for a in attachments.values()), savedata['parsed']['from'], subject, listing)
+                READ_API.cache.add_message(em, filenamebase, savedata)
+                READ_API.events.publish(em, message_event(em, filenamebase, savedata['parsed']['from'], subject, received_ms(filenamebase), seq))
+                if settings.html_cache_size > 0 and html:
+                    with STAGE_SECONDS.time(stage='render'):
+                        self.cache_html(em, mailbox, filenamebase, savedata, settings)
+                if settings.feed_items > 0:
+                    with STAGE_SECONDS.time(stage='feed'):
+                        update_feed('add_message', mailbox, em, filenamebase, savedata, settings.url, settings.feed_items)
+                MAILS.inc(outcome='accepted')
+
+                with STAGE_SECONDS.time(stage='webhook'), WEBHOOKS_IN_FLIGHT.track():
+                    await self.send_to_webhook(em, mailbox, savedata, settings, cache)
+
+        with STAGE_SECONDS.time(stage='cleanup'):
+            cleanup(settings)
+
+        MESSAGES.inc(result='accepted')
+        return '250 OK'
+
+    # The stages of handle_DATA are separate methods so they can be
+    # benchmarked without sockets (see tools/bench_handler.py)
+
+    def parse_message(self, content):
+        message = BytesParser(policy=policy.default).parsebytes(content)
         subject = str(make_header(decode_header(message['subject']))) if message['subject'] else "(No Subject)"
+        return message, subject
 
+    def decode_part(self, part):
+        try:
+            text = part.get_payload(decode=True).decode('utf-8')
+            logger.debug('UTF-8 received')
+            return text
+        except UnicodeDecodeError:
+            text = part.get_payload(decode=True).decode('latin1')
+            logger.debug('latin1 received')
+            return text
+        except Exception as e:
+            logger.warning("Error decoding payload: %s" % str(e))
+            return ''
 
+    def extract_parts(self, message, settings):
         # Separate HTML and plaintext parts
+        # returns (plaintext, html, attachments) or None if an attachment is too large
         plaintext = ''
         html = ''
         attachments = {}
         for part in message.walk():
             if part.get_content_maintype() == 'multipart':
                 continue
-            if part.get_content_type() == 'text/plain':
+            if part.get_content_type() == 'text/plain' and part.get_filename() is None:
+                plaintext += self.decode_part(part)
+            elif part.get_content_type() == 'text/html':
+                html += self.decode_part(part)
+            else:
                 #if it's a file
-                if part.get_filename() is not None:
-                    att = self.handleAttachment(part)
-                    if(att == False):
-                        return '500 Attachment too large. Max size: ' + str(ATTACHMENTS_MAX_SIZE/1000000)+"MB"
-                    attachments['file%d' % len(attachments)] = att                                            
-                else:                                                                                         
-                    try:                                                                                      
-                        plaintext += part.get_payload(decode=True).decode('utf-8')                            
-                        logger.debug('UTF-8 received')                                                        
-                    except UnicodeDecodeError:                                                                
-                        plaintext += part.get_payload(decode=True).decode('latin1')                           
-                        logger.debug('latin1 received')                                                       
-                    except Exception as e:                                                                    
-                        print(f"Error decoding payload: {e}")                                                 
-                        logger.debug(e)                                                                       
-            elif part.get_content_type() == 'text/html':                                                      
-                try:                                                                                          
-                    html += part.get_payload(decode=True).decode('utf-8')
-                    logger.debug('UTF-8 received')
-                except UnicodeDecodeError:                                                                    
-                    html += part.get_payload(decode=True).decode('latin1')
-                    logger.debug('latin1 received')                                                       
-                except Exception as e:                                                                        
-                    print(f"Error decoding payload: {e}")                                                     
-                    logger.debug(e)                                                                           
-            else:                                                                                             
-                att = self.handleAttachment(part)  
+                att = self.handleAttachment(part, settings)
                 if(att == False):
-                    return '500 Attachment too large. Max size: ' + str(ATTACHMENTS_MAX_SIZE/1000000)+"MB"
+                    return None
                 attachments['file%d' % len(attachments)] = att
+        return plaintext, html, attachments
 
-        for em in rcpts:
-                em = em.lower()
-                if not re.match(r"[^@\s]+@[^@\s]+\.[a-zA-Z0-9]+$", em):
-                    logger.exception('Invalid recipient: %s' % em)
-                    continue
+    def accept_recipient(self, em, settings, cache=None):
+        if cache is not None and em in cache.verdicts:
+            SESSION_CACHE.inc(cache='verdict', result='hit')
+            verdict = cache.verdicts[em]
+        else:
+            verdict = self.recipient_verdict(em, settings)
+            if cache is not None:
+                SESSION_CACHE.inc(cache='verdict', result='miss')
+                cache.verdicts[em] = verdict
 
-                domain = em.split('@')[1]
-                found = False
-                for x in DOMAINS:
-                    if  "*" in x and domain.endswith(x.replace('*', '')):
-                        found = True
-                    elif domain == x:
-                        found = True
-                if(DISCARD_UNKNOWN and found==False):
-                    logger.info('Discarding email for unknown domain: %s' % domain)
-                    continue
+        if verdict == 'invalid':
+            logger.exception('Invalid recipient: %s' % em)
+        elif verdict == 'discarded':
+            logger.info('Discarding email for unknown domain: %s' % em.split('@')[1])
+        if verdict != 'accepted':
+            MAILS.inc(outcome=verdict)
+            return False
+        return True
 
-                if not os.path.exists("../data/"+em):
-                    os.mkdir( "../data/"+em, 0o755 )
-
-
-                edata = {
-                    'subject': subject,
-                    'body': plaintext,
-                    'htmlbody': self.replace_cid_with_attachment_id(html, attachments,filenamebase,em),
-                    'from': message['from'],
-                    'attachments':[],
-                    'attachments_details':[]
-                }
-                savedata = {'sender_ip':peer[0],
-                    'from':message['from'],
-                    'rcpts':rcpts,
-                    'raw':raw_email,
-                    'parsed':edata
-                }
-
-                #same attachments if any
-                for att in attachments:
-                    if not os.path.exists("../data/"+em+"/attachments"):
-                        os.mkdir( "../data/"+em+"/attachments", 0o755 )
-                    attd = attachments[att]
-                    file_id = attd[3]
-                    file = open("../data/"+em+"/attachments/"+file_id, 'wb')
-                    file.write(attd[1])
-                    file.close()
-                    edata["attachments"].append(file_id)
-                    edata["attachments_details"].append({
-                            "filename":attd[0],
-                            "cid":attd[2],
-                            "id":attd[3],
-                            "download_url":URL+"/api/attachment/"+em+"/"+file_id,
-                            "size":len(attd[1])
-                        })
+    def recipient_verdict(self, em, settings):
+        if not re.match(r"[^@\s]+@[^@\s]+\.[a-zA-Z0-9]+$", em):
+            return 'invalid'
 
-                # save actual json data
-                with open("../data/"+em+"/"+filenamebase+".json", "w") as outfile:
-                    json.dump(savedata, outfile)
+        domain = em.split('@')[1]
+        if(settings.discard_unknown and domain not in settings.domain_matcher):
+            return 'discarded'
+        return 'accepted'
 
-                await self.send_to_webhook(em, savedata)
+    def mailbox_dir(self, em, settings, cache=None):
+        # data/ path of the mailbox in the configured layout, created (or moved over) if needed
+        path = mailbox_path(em, settings.data_layout)
+        if cache is not None and path in cache.dirs:
+            SESSION_CACHE.inc(cache='dir', result='hit')
+            return path
+        ensure_mailbox(em, settings.data_layout)
+        if cache is not None:
+            SESSION_CACHE.inc(cache='dir', result='miss')
+            cache.dirs.add(path)
+        return path
 
-        cleanup()
+    def ensure_dir(self, path, cache=None):
+        if cache is not None and path in cache.dirs:
+            SESSION_CACHE.inc(cache='dir', result='hit')
+            return
+        if not os.path.exists(path):
+            os.mkdir(path, 0o755)
+        if cache is not None:
+            SESSION_CACHE.inc(cache='dir', result='miss')
+            cache.dirs.add(path)
 
-        return '250 OK'
+    def build_listing(self, filenamebase, content, plaintext, html, attachments):
+        return message_listing(filenamebase, content, plaintext, html, len(attachments))
+
+    def build_email_data(self, em, peer, rcpts, raw_email, message, subject, plaintext, html, attachments, filenamebase, listing=None):
+        edata = {
+            'subject': subject,
+            'body': plaintext,
+            'htmlbody': self.replace_cid_with_attachment_id(html, attachments,filenamebase,em),
+            'from': message['from'],
+            'attachments':[],
+            'attachments_details':[]
+        }
+        savedata = {'sender_ip':peer[0],
+            'from':message['from'],
+            'rcpts':rcpts,
+            'raw':raw_email,
+            'parsed':edata
+        }
+        if listing is not None:
+            savedata['listing'] = listing
+        return savedata
+
+    def save_attachments(self, em, mailbox, attachments, edata, settings, cache=None, commits=None):
+        #same attachments if any
+        for att in attachments:
+            self.ensure_dir(mailbox+"/attachments", cache)
+            attd = attachments[att]
+            file_id = attd[3]
+            self.store_file(mailbox+"/attachments/"+file_id, attd[1], settings, commits)
+            edata["attachments"].append(file_id)
+            edata["attachments_details"].append({
+                    "filename":attd[0],
+                    "cid":attd[2],
+                    "id":attd[3],
+                    "download_url":settings.url+"/api/attachment/"+em+"/"+file_id,
+                    "size":len(attd[1])
+                })
+
+    def serialize_email(self, savedata):
+        return json.dumps(savedata)
+
+    def write_email(self, mailbox, filenamebase, payload, settings=None, commits=None):
+        self.store_file(mailbox+"/"+filenamebase+".json", payload.encode('utf-8'), settings, commits)
 
-    async def send_to_webhook(self, email, data):
+    def store_file(self, path, data, settings=None, commits=None):
+        # atomic write, see storage.py. Group commits are collected in `commits`
+        # to be awaited, without a list the write blocks until it is committed
+        durability = settings.durability if settings is not None else 'none'
+        if durability != 'group':
+            write_file(path, data, durability)
+        elif commits is not None:
+            commits.append(GROUP_COMMIT.write(path, data))
+        else:
+            GROUP_COMMIT.write(path, data).result()
+
+    def cache_html(self, em, mailbox, filenamebase, savedata, settings):
+        # what /api/raw-html serves, see render.py. Failing to render must not lose the mail
+        try:
+            return render.cache_html(MAILBOXES, mailbox, em, filenamebase, savedata, settings.html_cache_size, settings.data_layout)
+        except OSError as e:
+            logger.error("Could not store the rendered HTML: %s" % str(e))
+
+    async def send_to_webhook(self, email, mailbox, data, settings, cache=None):
         # Try per-email webhook first
-        webhook_config = self.load_webhook_config(email)
+        if cache is not None and email in cache.webhooks:
+            SESSION_CACHE.inc(cache='webhook', result='hit')
+            webhook_config = cache.webhooks[email]
+        else:
+            webhook_config = self.load_webhook_config(email, mailbox)
+            if cache is not None:
+                SESSION_CACHE.inc(cache='webhook', result='miss')
+                cache.webhooks[email] = webhook_config
         
         if webhook_config and webhook_config.get('enabled'):
             await self.send_configured_webhook(email, data, webhook_config)
-        elif WEBHOOK_URL != "":
+        elif settings.webhook_url != "":
             # Fallback to global webhook
-            await self.send_global_webhook(data)
+            await self.send_global_webhook(settings.webhook_url, data)
     
-    def load_webhook_config(self, email):
-        webhook_file = "../data/" + email + "/webhook.json"
+    def load_webhook_config(self, email, mailbox):
+        webhook_file = mailbox + "/webhook.json"
         if os.path.exists(webhook_file):
             try:
                 with open(webhook_file, 'r') as f:
@@ -241,6 +626,7 @@ class CustomHandler:
         webhook_url = config.get('webhook_url')
         if not webhook_url:
             logger.error("No webhook URL configured for %s" % email)
+            WEBHOOKS.inc(kind='mailbox', result='invalid')
             return
         
         # Prepare payload from template
@@ -253,6 +639,7 @@ class CustomHandler:
             logger.error("Invalid JSON in webhook payload template for %s: %s" % (email, str(e)))
             logger.error("Template: %s" % template)
             logger.error("Payload string: %s" % payload_str)
+            WEBHOOKS.inc(kind='mailbox', result='invalid')
             return
         
         # Retry configuration
@@ -276,6 +663,7 @@ class CustomHandler:
                     async with session.post(webhook_url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
                         if response.status >= 200 and response.status < 300:
                             logger.info("Webhook sent successfully to %s for %s (attempt %d)" % (webhook_url, email, attempt + 1))
+                            WEBHOOKS.inc(kind='mailbox', result='success')
                             return
                         else:
                             logger.warning("Webhook failed with status %d for %s (attempt %d)" % (response.status, email, attempt + 1))
@@ -286,20 +674,24 @@ class CustomHandler:
             if attempt < max_attempts - 1:
                 wait_time = (backoff_multiplier ** attempt) * 1  # Start with 1 second
                 logger.info("Retrying webhook for %s in %d seconds..." % (email, wait_time))
+                WEBHOOKS.inc(kind='mailbox', result='retry')
                 await asyncio.sleep(wait_time)
         
         logger.error("Failed to send webhook for %s after %d attempts" % (email, max_attempts))
+        WEBHOOKS.inc(kind='mailbox', result='failure')
     
-    async def send_global_webhook(self, data):
+    async def send_global_webhook(self, webhook_url, data):
         """Send to global webhook URL (backward compatibility)"""
         try:
             async with aiohttp.ClientSession() as session:
-                await session.post(WEBHOOK_URL, json=data)
+                await session.post(webhook_url, json=data)
                 logger.info("Global webhook sent successfully.")
+                WEBHOOKS.inc(kind='global', result='success')
         except Exception as e:
             logger.error("Error sending global webhook: %s" % str(e))
+            WEBHOOKS.inc(kind='global', result='failure')
 
-    def handleAttachment(self, part):
+    def handleAttachment(self, part, settings):
         filename = part.get_filename()
         if filename is None:
             filename = 'untitled'
@@ -313,7 +705,7 @@ class CustomHandler:
         fid = hashlib.md5(filename.encode('utf-8')).hexdigest()+filename
         logger.debug('Handling attachment: "%s" (ID: "%s") of type "%s" with CID "%s"',filename, fid,part.get_content_type(), cid)
 
-        if(ATTACHMENTS_MAX_SIZE > 0 and len(part.get_payload(decode=True)) > ATTACHMENTS_MAX_SIZE):
+        if(settings.attachments_max_size > 0 and len(part.get_payload(decode=True)) > settings.attachments_max_size):
             logger.info("Attachment too large: " + filename)
             return False
 
@@ -332,57 +724,440 @@ class CustomHandler:
                 html_content = html_content.replace('cid:' + cid, "/api/attachment/"+email+"/"+filenamebase+"-"+filename)
         return html_content
 
-def cleanup():
+def update_registry(action, *args):
+    # the registry is only an index, a failed update must not lose the mail
+    try:
+        return getattr(MAILBOXES, action)(*args)
+    except sqlite3.Error as e:
+        logger.error("Could not update the mailbox registry: %s" % str(e))
+
+def update_feed(action, *args):
+    # feeds are rebuilt from the messages when they're missing, a failed update must not lose the mail
+    try:
+        return getattr(feeds, action)(*args)
+    except (OSError, ValueError, KeyError) as e:
+        logger.error("Could not update the feed: %s" % str(e))
+
+def init_registry():
+    # builds data/registry.sqlite from the existing mailboxes on the first start
+    try:
+        if MAILBOXES.exists() and MAILBOXES.version() >= SCHEMA_VERSION:
+            return
+        logger.info("[i] Building mailbox registry, this can take a while with many mailboxes")
+        count = MAILBOXES.rebuild()
+        logger.info("[i] Mailbox registry built with %d mailboxes" % count)
+    except (sqlite3.Error, OSError) as e:
+        logger.error("[ERR] Could not build the mailbox registry: %s" % str(e))
+    finally:
+        # workers are forked and open their own connections
+        MAILBOXES.close()
+
+def cleanup(settings):
     global LAST_CLEANUP
-    if(DELETE_OLDER_THAN_DAYS == False or time.time() - LAST_CLEANUP < 86400):
+    # with multiple workers only the first one cleans up
+    if(settings.delete_older_than_days == False or WORKER_INDEX != 0 or time.time() - LAST_CLEANUP < 86400):
         return
     logger.info("Cleaning up")
     LAST_CLEANUP = time.time()
     rootdir = '../data/'
+    # mailboxes that lost messages, their feeds are rebuilt below
+    changed = {}
+    # covers both data layouts
     for subdir, dirs, files in os.walk(rootdir):
+        if '@' in os.path.basename(subdir) and feeds.FEED_DIR in dirs:
+            dirs.remove(feeds.FEED_DIR)
         for file in files:
             if(file.endswith(".json")):
                 filepath = os.path.join(subdir, file)
                 file_modified = os.path.getmtime(filepath)
-                if(time.time() - file_modified > (DELETE_OLDER_THAN_DAYS * 86400)):
+                if(time.time() - file_modified > (settings.delete_older_than_days * 86400)):
+                    size = os.path.getsize(filepath)
                     os.remove(filepath)
                     logger.info("Deleted file: " + filepath)
+                    email = os.path.basename(subdir)
+                    if file == "webhook.json":
+                        update_registry('set_webhook', email, False)
+                    elif '@' in email and file[:-5].isdigit():
+                        update_registry('remove_message', email, int(file[:-5]), size)
+                        try:
+                            os.remove(render.rendered_path(subdir, file[:-5]))
+                        except FileNotFoundError:
+                            pass
+                        changed[email] = subdir
                         # delete empty folders now
-    for entry in os.scandir(rootdir):
-        if entry.is_dir() and not os.listdir(entry.path) :
-            os.rmdir(entry.path)
-            logger.info("Deleted folder: " + entry.path)
-async def run(port):
-
-    if TLS_CERTIFICATE != "" and TLS_PRIVATE_KEY != "":
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(TLS_CERTIFICATE, TLS_PRIVATE_KEY)
-        if MAILPORT_TLS > 0:
-            controller_tls = Controller(CustomHandler("TLS"), hostname='0.0.0.0', port=MAILPORT_TLS, ssl_context=context)
+            elif(file.endswith(".tmp")):
+                # left behind by a crash while writing
+                filepath = os.path.join(subdir, file)
+                if(time.time() - os.path.getmtime(filepath) > 3600):
+                    os.remove(filepath)
+                    logger.info("Deleted file: " + filepath)
+    for email, path in changed.items():
+        if settings.feed_items > 0:
+            update_feed('rebuild', path, email, settings.url, settings.feed_items)
+        else:
+            shutil.rmtree(os.path.join(path, feeds.FEED_DIR), ignore_errors=True)
+    for email, path in iter_mailboxes(rootdir):
+        if not os.listdir(path):
+            os.rmdir(path)
+            update_registry('remove_mailbox', email)
+            logger.info("Deleted folder: " + path)
+    for path in prune_shards(rootdir):
+        logger.info("Deleted folder: " + path)
+async def metrics_handler(request):
+    if TLS_CONTEXT is not None:
+        for stat, value in TLS_CONTEXT.session_stats().items():
+            TLS_SESSION_CACHE.set(value, stat=stat)
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server(host, port):
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("[i] Serving metrics on http://%s:%d/metrics" % (host, port))
+    return runner
+
+async def run(port, reuse_port=False):
+    global TLS_CONTEXT
+    settings = SETTINGS
+    controllers = []
+    SENDER_LIMITS.configure(settings)
+    GROUP_COMMIT.interval = settings.group_commit_ms / 1000
+    newest = update_registry('latest_message_id')
+    if newest:
+        MESSAGE_IDS.seed(newest)
+
+    if settings.tls_certificate != "" and settings.tls_private_key != "":
+        context = create_tls_context(settings)
+        TLS_CONTEXT = context
+        if settings.mailport_tls > 0:
+            controller_tls = MailController(CustomHandler("TLS"), hostname='0.0.0.0', port=settings.mailport_tls, ssl_context=context, reuse_port=reuse_port)
             controller_tls.start()
+            controllers.append(controller_tls)
 
-        controller_plaintext = Controller(CustomHandler("Plaintext or STARTTLS"), hostname='0.0.0.0', port=port,tls_context=context)
+        controller_plaintext = MailController(CustomHandler("Plaintext or STARTTLS"), hostname='0.0.0.0', port=port,tls_context=context, reuse_port=reuse_port)
         controller_plaintext.start()
+        controllers.append(controller_plaintext)
 
-        logger.info("[i] Starting TLS only Mailserver on port " + str(MAILPORT_TLS))
+        logger.info("[i] Starting TLS only Mailserver on port " + str(settings.mailport_tls))
         logger.info("[i] Starting plaintext Mailserver (with STARTTLS support) on port " + str(port))
     else:
-        controller_plaintext = Controller(CustomHandler("Plaintext"), hostname='0.0.0.0', port=port)
+        controller_plaintext = MailController(CustomHandler("Plaintext"), hostname='0.0.0.0', port=port, reuse_port=reuse_port)
         controller_plaintext.start()
+        controllers.append(controller_plaintext)
 
         logger.info("[i] Starting plaintext Mailserver on port " + str(port))
 
+    # worker N serves its metrics on METRICS_PORT+N
+    metrics_runner = None
+    if settings.metrics_port > 0:
+        metrics_runner = await start_metrics_server(settings.metrics_host, settings.metrics_port + WORKER_INDEX)
+    readapi_runner = None
+    if settings.readapi_port > 0:
+        READ_API.cache.max_entries = settings.readapi_cache_size
+        readapi_runner = await start_readapi_server(READ_API, settings.readapi_host, settings.readapi_port, reuse_port=reuse_port)
+        # workers forward new-message events to each other on UDP READAPI_PORT+N
+        await READ_API.events.start(settings.readapi_port, WORKER_INDEX, settings.workers)
+        logger.info("[i] Serving the JSON API on %s:%d" % (settings.readapi_host, settings.readapi_port))
+
+    # workers leave SIGINT to the supervisor which stops them with SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+    if settings.workers == 1:
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+    loop.add_signal_handler(signal.SIGHUP, reload_settings)
+    watcher = asyncio.ensure_future(watch_config())
 
     logger.info("[i] Ready to receive Emails")
     logger.info("")
 
+    await stop_event.wait()
+    watcher.cancel()
+    await shutdown(controllers)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    if readapi_runner is not None:
+        READ_API.events.close()
+        await readapi_runner.cleanup()
+
+async def shutdown(controllers):
+    # Stop accepting, let running transactions finish (up to SHUTDOWN_TIMEOUT), then stop.
+    # Mail is only acknowledged with 250 after it is written, so anything cut off
+    # here is retried by the sender instead of being lost or stored twice
+    global STOPPING
+    STOPPING = True
+    logger.info("[i] Shutting down, no longer accepting connections")
+    for controller in controllers:
+        controller.loop.call_soon_threadsafe(controller.server.close)
+
+    timeout = SETTINGS.shutdown_timeout
+    deadline = time.time() + timeout
+    while MESSAGES_IN_FLIGHT.get() > 0 and time.time() < deadline:
+        await asyncio.sleep(0.05)
+    if MESSAGES_IN_FLIGHT.get() > 0:
+        logger.warning("[!] %d messages still in flight after %ds, stopping anyway" % (MESSAGES_IN_FLIGHT.get(), timeout))
+    else:
+        logger.info("[i] All in-flight messages finished")
+
+    for controller in controllers:
+        controller.stop()
+    logger.info("[i] Mailserver stopped")
+
+def load_config(path=CONFIG_PATH):
+    # reads config.ini into a new Settings object
+    if not os.path.isfile(path):
+        logger.info("[ERR] Config.ini not found. Rename example.config.ini to config.ini. Defaulting to port 25")
+        return Settings()
+
+    Config = configparser.ConfigParser(allow_no_value=True)
+    Config.read(path)
+    values = {}
+    values['port'] = int(Config.get("MAILSERVER", "MAILPORT"))
+    if("discard_unknown" in Config.options("MAILSERVER")):
+        values['discard_unknown'] = (Config.get("MAILSERVER", "DISCARD_UNKNOWN").lower() == "true")
+    values['domains'] = tuple(Config.get("GENERAL", "DOMAINS").lower().split(","))
+    values['domain_matcher'] = DomainMatcher(values['domains'])
+    values['url'] = Config.get("GENERAL", "URL")
+    if("data_layout" in Config.options("GENERAL")) and Config.get("GENERAL", "DATA_LAYOUT"):
+        layout = Config.get("GENERAL", "DATA_LAYOUT").strip().lower()
+        if layout in LAYOUTS:
+            values['data_layout'] = layout
+        else:
+            logger.warning("Invalid value for DATA_LAYOUT: %s. Defaulting to flat." % layout)
+    if("password" in Config.options("GENERAL")):
+        values['password'] = Config.get("GENERAL", "PASSWORD") or ""
+    if("allowed_ips" in Config.options("GENERAL")):
+        values['allowed_ips'] = Config.get("GENERAL", "ALLOWED_IPS") or ""
+    if "ADMIN" in Config.sections() and "admin" in Config.options("ADMIN"):
+        values['admin'] = Config.get("ADMIN", "ADMIN") or ""
+    if("feed_items" in Config.options("GENERAL")) and Config.get("GENERAL", "FEED_ITEMS"):
+        values['feed_items'] = int(Config.get("GENERAL", "FEED_ITEMS"))
+    if("html_cache_size" in Config.options("GENERAL")) and Config.get("GENERAL", "HTML_CACHE_SIZE"):
+        values['html_cache_size'] = int(Config.get("GENERAL", "HTML_CACHE_SIZE"))
+    if("attachments_max_size" in Config.options("MAILSERVER")):
+        values['attachments_max_size'] = int(Config.get("MAILSERVER", "ATTACHMENTS_MAX_SIZE"))
+    if "CLEANUP" in Config.sections() and "delete_older_than_days" in Config.options("CLEANUP"):
+        raw_val = Config.get("CLEANUP", "DELETE_OLDER_THAN_DAYS").strip().lower()
+        try:
+            if raw_val in ["false", "off", "no", "none"]:
+                values['delete_older_than_days'] = 0
+            else:
+                values['delete_older_than_days'] = float(raw_val)
+        except ValueError:
+            logger.warning("Invalid value for DELETE_OLDER_THAN_DAYS: %s. Defaulting to 0." % raw_val)
+            values['delete_older_than_days'] = 0
+    if("mailport_tls" in Config.options("MAILSERVER")):
+        values['mailport_tls'] = int(Config.get("MAILSERVER", "MAILPORT_TLS"))
+    if("tls_certificate" in Config.options("MAILSERVER")):
+        values['tls_certificate'] = Config.get("MAILSERVER", "TLS_CERTIFICATE")
+    if("tls_private_key" in Config.options("MAILSERVER")):
+        values['tls_private_key'] = Config.get("MAILSERVER", "TLS_PRIVATE_KEY")
+
+    if("tls_session_tickets" in Config.options("MAILSERVER")):
+        values['tls_session_tickets'] = (Config.get("MAILSERVER", "TLS_SESSION_TICKETS") or "true").lower() == "true"
+    if("tls_num_tickets" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "TLS_NUM_TICKETS"):
+        values['tls_num_tickets'] = int(Config.get("MAILSERVER", "TLS_NUM_TICKETS"))
+    if("tls_ciphers" in Config.options("MAILSERVER")):
+        values['tls_ciphers'] = Config.get("MAILSERVER", "TLS_CIPHERS") or ""
+    if("tls_prefer_server_ciphers" in Config.options("MAILSERVER")):
+        values['tls_prefer_server_ciphers'] = (Config.get("MAILSERVER", "TLS_PREFER_SERVER_CIPHERS") or "true").lower() == "true"
+    if("tls_ecdh_curve" in Config.options("MAILSERVER")):
+        values['tls_ecdh_curve'] = Config.get("MAILSERVER", "TLS_ECDH_CURVE") or ""
+    if("tls_minimum_version" in Config.options("MAILSERVER")):
+        values['tls_minimum_version'] = Config.get("MAILSERVER", "TLS_MINIMUM_VERSION") or ""
+
+    if("metrics_port" in Config.options("MAILSERVER")):
+        values['metrics_port'] = int(Config.get("MAILSERVER", "METRICS_PORT") or 0)
+    if("metrics_host" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "METRICS_HOST"):
+        values['metrics_host'] = Config.get("MAILSERVER", "METRICS_HOST")
+
+    if("workers" in Config.options("MAILSERVER")):
+        raw_val = (Config.get("MAILSERVER", "WORKERS") or "1").strip().lower()
+        if raw_val in ["auto", "0"]:
+            values['workers'] = os.cpu_count() or 1
+        else:
+            values['workers'] = max(1, int(raw_val))
+        if values['workers'] > NODES:
+            # the worker index is part of the message id
+            logger.error("[ERR] WORKERS can be at most %d, got %d. Using %d." % (NODES, values['workers'], NODES))
+            values['workers'] = NODES
+
+    if("shutdown_timeout" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "SHUTDOWN_TIMEOUT"):
+        values['shutdown_timeout'] = float(Config.get("MAILSERVER", "SHUTDOWN_TIMEOUT"))
+
+    if("readapi_port" in Config.options("MAILSERVER")):
+        values['readapi_port'] = int(Config.get("MAILSERVER", "READAPI_PORT") or 0)
+    if("readapi_host" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "READAPI_HOST"):
+        values['readapi_host'] = Config.get("MAILSERVER", "READAPI_HOST")
+    if("readapi_cache_size" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "READAPI_CACHE_SIZE"):
+        values['readapi_cache_size'] = int(Config.get("MAILSERVER", "READAPI_CACHE_SIZE"))
+
+    if("durability" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "DURABILITY"):
+        durability = Config.get("MAILSERVER", "DURABILITY").strip().lower()
+        if durability in DURABILITY:
+            values['durability'] = durability
+        else:
+            logger.warning("Invalid value for DURABILITY: %s. Defaulting to none." % durability)
+    if("group_commit_ms" in Config.options("MAILSERVER")) and Config.get("MAILSERVER", "GROUP_COMMIT_MS"):
+        values['group_commit_ms'] = max(1, int(Config.get("MAILSERVER", "GROUP_COMMIT_MS")))
+
+    for key in ('ratelimit_max_connections', 'ratelimit_connections', 'ratelimit_messages',
+                'ratelimit_prefix_messages', 'ratelimit_recipients', 'ratelimit_max_tracked'):
+        if(key in Config.options("MAILSERVER")) and Config.get("MAILSERVER", key.upper()):
+            values[key] = int(Config.get("MAILSERVER", key.upper()))
+    if("ratelimit_exempt" in Config.options("MAILSERVER")):
+        values['ratelimit_exempt'] = parse_networks(Config.get("MAILSERVER", "RATELIMIT_EXEMPT") or "")
+
+    if "webhook_url" in Config.options("WEBHOOK"):
+        values['webhook_url'] = Config.get("WEBHOOK", "WEBHOOK_URL")
+
+    return Settings(**values)
+
+# settings that only take effect after a restart
+RESTART_SETTINGS = ('port', 'mailport_tls', 'workers', 'metrics_port', 'metrics_host', 'readapi_port', 'readapi_host')
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def watched_files(settings):
+    return [CONFIG_PATH] + [path for path in (settings.tls_certificate, settings.tls_private_key) if path]
+
+def reload_settings(with_tls=True):
+    # Builds a new Settings object and swaps it in. A broken config keeps the old one
+    global SETTINGS
+    old = SETTINGS
+    try:
+        new = load_config()
+    except Exception as e:
+        logger.error("[ERR] Could not reload config, keeping the current one: %s" % str(e))
+        return False
+
+    for name in RESTART_SETTINGS:
+        if getattr(old, name) != getattr(new, name):
+            logger.warning("[!] %s changed, this needs a restart to take effect" % name.upper())
+    SETTINGS = new
+    SENDER_LIMITS.configure(new)
+    GROUP_COMMIT.interval = new.group_commit_ms / 1000
+    READ_API.cache.max_entries = new.readapi_cache_size
+    logger.info("[i] Config reloaded. Listening for domains: " + str(list(new.domains)))
+
+    if with_tls:
+        reload_tls(new)
+    return True
+
+def reload_tls(settings):
+    # load_cert_chain and the tuning on the live context only affect new handshakes,
+    # established sessions keep going
+    if TLS_CONTEXT is None:
+        if settings.tls_certificate != "" and settings.tls_private_key != "":
+            logger.warning("[!] TLS was not enabled at startup, this needs a restart to take effect")
+        return
+    try:
+        apply_tls_settings(TLS_CONTEXT, settings)
+        TLS_CONTEXT.load_cert_chain(settings.tls_certificate, settings.tls_private_key)
+        logger.info("[i] Reloaded TLS certificate " + settings.tls_certificate)
+    except (OSError, ssl.SSLError, ValueError, KeyError) as e:
+        logger.error("[ERR] Could not reload TLS certificate, keeping the current one: %s" % str(e))
+
+async def watch_config():
+    # polls config.ini and the certificate files for changes (e.g. certbot renewals)
+    signatures = {path: file_signature(path) for path in watched_files(SETTINGS)}
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        current = {path: file_signature(path) for path in watched_files(SETTINGS)}
+        if current == signatures:
+            continue
+        if current.get(CONFIG_PATH) != signatures.get(CONFIG_PATH):
+            reload_settings()
+        else:
+            reload_tls(SETTINGS)
+        signatures = {path: file_signature(path) for path in watched_files(SETTINGS)}
+
+def run_worker(index, port, log_queue):
+    global WORKER_INDEX, MESSAGE_IDS
+    WORKER_INDEX = index
+    MESSAGE_IDS = MessageIds(index)
+
+    # hand all records to the supervisor which writes them out
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run(port, reuse_port=True))
+
+def supervise(port, handler):
+    # Forks WORKERS processes that share the SMTP ports via SO_REUSEPORT,
+    # restarts them when they die and forwards SIGHUP to them
+    ctx = multiprocessing.get_context("fork")
+    log_queue = ctx.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    workers = {}
+    started = {}
+    crashes = {}
+    state = {"running": True}
+
+    def start_worker(index):
+        process = ctx.Process(target=run_worker, args=(index, port, log_queue), name="worker-%d" % index, daemon=True)
+        process.start()
+        workers[index] = process
+        started[index] = time.time()
+        logger.info("[i] Started worker %d (pid %d)" % (index, process.pid))
+
+    def forward_reload(signum, frame):
+        # the workers own the listeners and TLS contexts, they reload those themselves
+        reload_settings(with_tls=False)
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+        logger.info("[i] Forwarded config reload to %d workers" % len(workers))
+
+    def stop(signum, frame):
+        state["running"] = False
+
+    signal.signal(signal.SIGHUP, forward_reload)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(SETTINGS.workers):
+        start_worker(index)
+
+    restart_at = {}
     try:
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        controller_plaintext.stop()
-        if(MAILPORT_TLS > 0 and TLS_CERTIFICATE != "" and TLS_PRIVATE_KEY != ""):
-            controller_tls.stop()
+        while state["running"]:
+            time.sleep(0.5)
+            for index, process in list(workers.items()):
+                if process.is_alive() or index in restart_at:
+                    continue
+                # back off when a worker keeps dying right after it was started
+                crashes[index] = crashes.get(index, 0) + 1 if time.time() - started[index] < 10 else 1
+                delay = min(30, 2 ** (crashes[index] - 1))
+                logger.error("[ERR] Worker %d (pid %d) exited with code %s, restarting in %ds" % (index, process.pid, process.exitcode, delay))
+                restart_at[index] = time.time() + delay
+            for index, when in list(restart_at.items()):
+                if state["running"] and time.time() >= when:
+                    del restart_at[index]
+                    start_worker(index)
+    finally:
+        logger.info("[i] Stopping %d workers" % len(workers))
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in workers.values():
+            process.join(SETTINGS.shutdown_timeout + 5)
+            if process.is_alive():
+                process.kill()
+        listener.stop()
 
 if __name__ == '__main__':
     ch = logging.StreamHandler()
@@ -392,44 +1167,18 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     logger.addHandler(ch)
 
-    if not os.path.isfile("../config.ini"):
-        logger.info("[ERR] Config.ini not found. Rename example.config.ini to config.ini. Defaulting to port 25")
-        port = 25
-    else:
-        Config = configparser.ConfigParser(allow_no_value=True)
-        Config.read("../config.ini")
-        port = int(Config.get("MAILSERVER", "MAILPORT"))
-        if("discard_unknown" in Config.options("MAILSERVER")):
-            DISCARD_UNKNOWN = (Config.get("MAILSERVER", "DISCARD_UNKNOWN").lower() == "true")
-        DOMAINS = Config.get("GENERAL", "DOMAINS").lower().split(",")
-        URL = Config.get("GENERAL", "URL")
-        if("attachments_max_size" in Config.options("MAILSERVER")):
-            ATTACHMENTS_MAX_SIZE = int(Config.get("MAILSERVER", "ATTACHMENTS_MAX_SIZE"))
-        if "CLEANUP" in Config.sections() and "delete_older_than_days" in Config.options("CLEANUP"):
-            raw_val = Config.get("CLEANUP", "DELETE_OLDER_THAN_DAYS").strip().lower()
-            try:
-                if raw_val in ["false", "off", "no", "none"]:
-                    DELETE_OLDER_THAN_DAYS = 0
-                else:
-                    DELETE_OLDER_THAN_DAYS = float(raw_val)
-            except ValueError:
-                logger.warning("Invalid value for DELETE_OLDER_THAN_DAYS: %s. Defaulting to 0." % raw_val)
-                DELETE_OLDER_THAN_DAYS = 0
-        if("mailport_tls" in Config.options("MAILSERVER")):
-            MAILPORT_TLS = int(Config.get("MAILSERVER", "MAILPORT_TLS"))
-        if("tls_certificate" in Config.options("MAILSERVER")):
-            TLS_CERTIFICATE = Config.get("MAILSERVER", "TLS_CERTIFICATE")
-        if("tls_private_key" in Config.options("MAILSERVER")):
-            TLS_PRIVATE_KEY = Config.get("MAILSERVER", "TLS_PRIVATE_KEY")
-
-        if "webhook_url" in Config.options("WEBHOOK"):
-            WEBHOOK_URL = Config.get("WEBHOOK", "WEBHOOK_URL")
-        else:
-            WEBHOOK_URL = ""
+    SETTINGS = load_config()
+    port = SETTINGS.port
+    init_registry()
 
+    logger.info("[i] Discard unknown domains: " + str(SETTINGS.discard_unknown))
+    logger.info("[i] Max size of attachments: " + str(SETTINGS.attachments_max_size))
+    logger.info("[i] Listening for domains: " + str(list(SETTINGS.domains)))
 
-    logger.info("[i] Discard unknown domains: " + str(DISCARD_UNKNOWN))
-    logger.info("[i] Max size of attachments: " + str(ATTACHMENTS_MAX_SIZE))
-    logger.info("[i] Listening for domains: " + str(DOMAINS))
-
-    asyncio.run(run(port))
+    if SETTINGS.workers > 1:
+        logger.info("[i] Starting %d workers" % SETTINGS.workers)
+        ch.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.removeHandler(ch)
+        supervise(port, ch)
+    else:
+        asyncio.run(run(port))
@@ -0,0 +1,52 @@
+import threading
+import time
+
+# Message ids, also the file names in data/<email>/<id>.json
+#
+#   id = milliseconds since the epoch * 10000 + node * 100 + sequence
+#
+# node is the worker index (so WORKERS is at most NODES), sequence counts the messages a worker
+# gets within one millisecond. Ids are unique across workers, increase within a worker and sort by time.
+# Mails stored before had the milliseconds as id, received_ms() handles both.
+# web/inc/core.php has the same rule in mailTime()
+
+NODES = 100
+SEQUENCE = 100
+# millisecond ids stay below this until the year 2286
+LEGACY_MAX = 10 ** 13
+
+class MessageIds:
+    def __init__(self, node=0):
+        self.lock = threading.Lock()
+        self.node = node % NODES
+        self.last = 0
+        self.sequence = 0
+
+    def next(self, now=None):
+        ms = int(time.time() * 1000) if now is None else now
+        with self.lock:
+            if ms <= self.last:
+                # same millisecond, or the clock went back: keep counting from the last id
+                ms = self.last
+                self.sequence += 1
+                if self.sequence >= SEQUENCE:
+                    # borrow the next millisecond
+                    ms += 1
+                    self.sequence = 0
+            else:
+                self.sequence = 0
+            self.last = ms
+            return (ms * NODES + self.node) * SEQUENCE + self.sequence
+
+    def seed(self, newest):
+        # continue after the newest stored id, in case the clock went back across a restart
+        with self.lock:
+            if received_ms(newest) + 1 > self.last:
+                self.last = received_ms(newest) + 1
+                self.sequence = 0
+
+def received_ms(message_id):
+    message_id = int(message_id)
+    if message_id < LEGACY_MAX:
+        return message_id
+    return message_id // (NODES * SEQUENCE)
@@ -0,0 +1,143 @@
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+
+# Per-sender throttling for mailserver3.py
+# Controllers run in their own threads, so every update takes the limiter's lock
+
+class RateLimiter:
+    # Token buckets of `limit` tokens refilled at `limit` per `period` seconds.
+    # Only the `max_entries` most recently used keys are kept; an evicted bucket
+    # has been idle the longest and would mostly be refilled anyway
+    def __init__(self, limit, period=60, max_entries=10000):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.configure(limit, period, max_entries)
+
+    def configure(self, limit, period=60, max_entries=10000):
+        # limits can change on reload without forgetting the buckets
+        with self.lock:
+            self.limit = limit
+            self.rate = limit / period if period else 0
+            self.max_entries = max_entries
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+
+    def allow(self, key, now=None):
+        if self.limit <= 0:
+            return True
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # [tokens, last refill]
+                bucket = self.buckets[key] = [self.limit, now]
+                if len(self.buckets) > self.max_entries:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.limit, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.buckets)
+
+class ConnectionLimiter:
+    # open connections per key, entries are dropped when they reach zero
+    def __init__(self, limit):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.open = {}
+
+    def acquire(self, key):
+        with self.lock:
+            count = self.open.get(key, 0)
+            if self.limit > 0 and count >= self.limit:
+                return False
+            self.open[key] = count + 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            count = self.open.get(key, 0) - 1
+            if count > 0:
+                self.open[key] = count
+            else:
+                self.open.pop(key, None)
+
+def prefix_key(ip):
+    # the /24 (IPv4) or /64 (IPv6) network an address belongs to
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    prefix = 24 if address.version == 4 else 64
+    return str(ipaddress.ip_network('%s/%d' % (address, prefix), strict=False))
+
+def parse_networks(value):
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if item != "":
+            networks.append(ipaddress.ip_network(item, strict=False))
+    return tuple(networks)
+
+def is_exempt(ip, networks):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return any(address in network for network in networks)
+
+class SenderLimits:
+    # the limits applied at connect, MAIL and RCPT time, see [MAILSERVER] RATELIMIT_*
+    def __init__(self):
+        self.connections = ConnectionLimiter(0)
+        self.connects = RateLimiter(0)
+        self.messages = RateLimiter(0)
+        self.prefix_messages = RateLimiter(0)
+        self.recipients = RateLimiter(0)
+        self.exempt = ()
+
+    def configure(self, settings):
+        self.connections.limit = settings.ratelimit_max_connections
+        self.connects.configure(settings.ratelimit_connections, 60, settings.ratelimit_max_tracked)
+        self.messages.configure(settings.ratelimit_messages, 60, settings.ratelimit_max_tracked)
+        self.prefix_messages.configure(settings.ratelimit_prefix_messages, 60, settings.ratelimit_max_tracked)
+        self.recipients.configure(settings.ratelimit_recipients, 60, settings.ratelimit_max_tracked)
+        self.exempt = settings.ratelimit_exempt
+
+    def connect(self, ip):
+        # returns a refusal reason or None, a granted connection must be released
+        if is_exempt(ip, self.exempt):
+            return None
+        if not self.connects.allow(ip):
+            return 'rate'
+        if not self.connections.acquire(ip):
+            return 'concurrency'
+        return None
+
+    def disconnect(self, ip):
+        # also fine for exempt addresses, they hold no count to release
+        self.connections.release(ip)
+
+    def mail(self, ip):
+        if is_exempt(ip, self.exempt):
+            return True
+        return self.messages.allow(ip) and self.prefix_messages.allow(prefix_key(ip))
+
+    def rcpt(self, ip):
+        if is_exempt(ip, self.exempt):
+            return True
+        return self.recipients.allow(ip)
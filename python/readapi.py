@@ -0,0 +1,373 @@
+import asyncio
+import functools
+import gzip
+import hashlib
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from events import ALL, MessageEvents
+from listing import listing_of
+from ratelimit import parse_networks
+from render import cache_html, rendered_path
+from storage import resolve_mailbox
+
+# Read-only HTTP API for the endpoints test clients poll, served by mailserver3.py on READAPI_PORT
+#
+#   GET /json/<email>        same JSON as web/ (getEmailsOfEmail with body and attachments)
+#   GET /json/<email>/<id>   the stored message
+#   GET /html/<email>/<id>   the rendered HTML body (see render.py), rendered here on the first view
+#   GET /events/<email>      Server-Sent Events, one per new message (see events.py)
+#   GET /wait/<email>?after=<seq>&timeout=30
+#                            long poll, the messages recorded after <seq> or the next one to arrive
+#
+# Mailboxes are listed from the registry (see registry.py), each message file is read once and
+# its summary kept. Rendered mailboxes stay in an LRU together with the registry row they were
+# rendered from, so mail received by any worker or deleted in the web UI invalidates them.
+# Responses carry an ETag and are gzipped if the client accepts it.
+# Requests it can't authorize like PHP would (session login, IP not allowed) get a 401/403,
+# nginx hands those to PHP
+
+GZIP_MIN_SIZE = 1024
+# seconds between comments on idle event streams, keeps proxies from closing them
+KEEPALIVE = 15
+MAX_WAIT = 300
+
+class MailboxEntry:
+    def __init__(self):
+        self.version = None
+        # message id -> summary, kept when the mailbox changes
+        self.summaries = {}
+        # (body, etag, gzipped body or None)
+        self.response = None
+
+class MailboxCache:
+    def __init__(self, max_entries=1000):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def entry(self, email):
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is None:
+                entry = self.entries[email] = MailboxEntry()
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(email)
+            return entry
+
+    def add_message(self, email, message_id, data):
+        # called on ingest, only mailboxes that are cached are touched
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is not None:
+                entry.summaries[str(message_id)] = summarize(message_id, data)
+                entry.response = None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+def summarize(message_id, data):
+    # the fields of getEmailsOfEmail in web/inc/core.php, attachment urls are added when rendering
+    parsed = data.get('parsed') or {}
+    listing = listing_of(message_id, data)
+    return {
+        'id': str(message_id),
+        'from': parsed.get('from'),
+        'subject': parsed.get('subject'),
+        'md5': listing['md5'],
+        'maillen': listing['maillen'],
+        'preview': listing['preview'],
+        'attachment_count': listing['attachment_count'],
+        'body': parsed.get('body'),
+        'attachments': parsed.get('attachments'),
+    }
+
+def load_summary(path, message_id):
+    try:
+        with open(path) as f:
+            return summarize(message_id, json.load(f))
+    except (OSError, ValueError):
+        return None
+
+def message_event(email, message_id, sender, subject, received, seq):
+    # seq is the registry's (see registry.py), None if it couldn't be updated
+    return {'email': email, 'id': str(message_id), 'from': sender, 'subject': subject, 'received': received, 'seq': seq}
+
+def sse_message(event):
+    # the event id is what the browser sends back as Last-Event-ID
+    if event.get('seq') is None:
+        return ('data: %s\n\n' % json.dumps(event)).encode('utf-8')
+    return ('id: %s\ndata: %s\n\n' % (event['seq'], json.dumps(event))).encode('utf-8')
+
+@functools.lru_cache(maxsize=8)
+def parse_allowed_ips(value):
+    # ALLOWED_IPS as a tuple of networks, None if it can't be parsed (everything goes to PHP)
+    try:
+        return parse_networks(value)
+    except ValueError:
+        return None
+
+def client_ip(request):
+    # same order as getUserIP() in web/inc/core.php
+    if request.headers.get('CF-Connecting-IP'):
+        return request.headers['CF-Connecting-IP']
+    forward = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
+    for candidate in (forward, request.headers.get('Client-IP', '')):
+        try:
+            ipaddress.ip_address(candidate)
+            return candidate
+        except ValueError:
+            pass
+    return request.remote
+
+class ReadAPI:
+    def __init__(self, registry, get_settings, max_entries=1000, events=None):
+        self.registry = registry
+        self.get_settings = get_settings
+        self.cache = MailboxCache(max_entries)
+        self.events = events if events is not None else MessageEvents()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/json/{email}', self.handle_mailbox)
+        app.router.add_get('/json/{email}/{id}', self.handle_message)
+        app.router.add_get('/html/{email}/{id}', self.handle_html)
+        app.router.add_get('/events/{email}', self.handle_events)
+        app.router.add_get('/wait/{email}', self.handle_wait)
+        return app
+
+    def check_access(self, request, settings):
+        if settings.allowed_ips:
+            networks = parse_allowed_ips(settings.allowed_ips)
+            try:
+                address = ipaddress.ip_address(client_ip(request))
+            except ValueError:
+                address = None
+            if not networks or address is None or not any(address in network for network in networks):
+                raise web.HTTPForbidden()
+        if settings.password:
+            password = request.headers.get('PWD') or request.query.get('password')
+            if password != settings.password:
+                raise web.HTTPUnauthorized()
+
+    async def handle_mailbox(self, request):
+        settings = self.get_settings()
+        self.check_access(request, settings)
+        email = request.match_info['email'].lower()
+        if email == 'listaccounts':
+            # listing accounts needs the admin password rules of PHP
+            raise web.HTTPForbidden()
+        if '@' not in email:
+            return self.json_error(404, 'Email not found')
+        if settings.admin and email == settings.admin.lower():
+            rows = self.registry.latest_messages(0, 100)
+            version = tuple((row['email'], row['id']) for row in rows)
+            messages = [(row['email'], row['id']) for row in rows]
+        else:
+            row = self.registry.get(email)
+            version = (row['messages'], row['bytes'], row['last_received']) if row else None
+            messages = None
+        entry = self.cache.entry(email)
+        response = entry.response
+        if response is None or entry.version != version:
+            if messages is None:
+                messages = [(email, message_id) for message_id in self.registry.message_ids(email)] if version else []
+            body = await self.render(entry, messages, settings)
+            response = entry.response = (body, '"%s"' % hashlib.md5(body).hexdigest(), None)
+            entry.version = version
+        return self.respond(request, entry, response)
+
+    async def render(self, entry, messages, settings):
+        missing = [(email, message_id) for email, message_id in messages if str(message_id) not in entry.summaries]
+        if missing:
+            loop = asyncio.get_running_loop()
+            loaded = await loop.run_in_executor(None, self.load_summaries, missing, settings)
+            entry.summaries.update(loaded)
+        wanted = set(str(message_id) for _, message_id in messages)
+        for message_id in list(entry.summaries):
+            if message_id not in wanted:
+                del entry.summaries[message_id]
+        o = {}
+        for email, message_id in sorted(messages, key=lambda m: int(m[1])):
+            summary = entry.summaries.get(str(message_id))
+            if summary is None:
+                continue
+            item = dict(summary, email=email)
+            if isinstance(item['attachments'], list):
+                item['attachments'] = [settings.url + '/api/attachment/' + email + '/' + a for a in item['attachments']]
+            o[item['id']] = item
+        return json.dumps(o if o else []).encode('utf-8')
+
+    def load_summaries(self, messages, settings):
+        loaded = {}
+        for email, message_id in messages:
+            path = os.path.join(resolve_mailbox(email, settings.data_layout), '%s.json' % message_id)
+            summary = load_summary(path, message_id)
+            if summary is not None:
+                loaded[str(message_id)] = summary
+        return loaded
+
+    async def handle_message(self, request):
+        settings = self.get_settings()
+        self.check_access(request, settings)
+        email = request.match_info['email'].lower()
+        message_id = request.match_info['id']
+        if '@' not in email:
+            return self.json_error(404, 'Email not found')
+        if not message_id.isdigit():
+            return self.json_error(400, 'Invalid ID')
+        path = os.path.join(resolve_mailbox(email, settings.data_layout), message_id + '.json')
+        # ids are never reused, so a stored message doesn't change
+        etag = '"%s"' % message_id
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers={'ETag': etag})
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            return self.json_error(404, 'Email ID not found')
+        return self.respond(request, None, (body, etag, None))
+
+    async def handle_html(self, request):
+        settings = self.get_settings()
+        self.check_access(request, settings)
+        email = request.match_info['email'].lower()
+        message_id = request.match_info['id']
+        if '@' not in email:
+            return self.json_error(404, 'Email not found')
+        if not message_id.isdigit():
+            return self.json_error(400, 'Invalid ID')
+        etag = '"%s"' % message_id
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers={'ETag': etag})
+        mailbox = resolve_mailbox(email, settings.data_layout)
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, self.load_html, email, mailbox, message_id, settings)
+        if body is None:
+            return self.json_error(404, 'Email ID not found')
+        return self.respond(request, None, (body, etag, None), 'text/html')
+
+    def load_html(self, email, mailbox, message_id, settings):
+        # the cached body, rendered and cached if it isn't; None if there is no such message
+        try:
+            with open(rendered_path(mailbox, message_id), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            body = None
+        if body is not None:
+            try:
+                self.registry.touch_rendered(email, int(message_id), int(time.time() * 1000))
+            except sqlite3.Error:
+                pass
+            return body
+        try:
+            with open(os.path.join(mailbox, message_id + '.json')) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        body = cache_html(self.registry, mailbox, email, message_id, data, settings.html_cache_size, settings.data_layout)
+        return body if body is not None else b''
+
+    def subscription(self, email, settings):
+        # the ADMIN address follows all mailboxes
+        return ALL if settings.admin and email == settings.admin.lower() else email
+
+    def backlog(self, key, after):
+        rows = self.registry.messages_after(None if key == ALL else key, after)
+        return [message_event(row['email'], row['id'], row['sender'], row['subject'], row['received'], row['seq']) for row in rows]
+
+    async def handle_events(self, request):
+        settings = self.get_settings()
+        self.check_access(request, settings)
+        email = request.match_info['email'].lower()
+        if '@' not in email:
+            return self.json_error(404, 'Email not found')
+        key = self.subscription(email, settings)
+        after = request.headers.get('Last-Event-ID') or request.query.get('after') or ''
+        # subscribe first so nothing arriving while the backlog is sent gets lost
+        queue = self.events.subscribe(key)
+        try:
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                                   'X-Accel-Buffering': 'no'})
+            await response.prepare(request)
+            sent = set()
+            if after.isdigit():
+                for event in self.backlog(key, int(after)):
+                    await response.write(sse_message(event))
+                    sent.add((event['email'], event['id']))
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await response.write(b': keepalive\n\n')
+                    continue
+                if event is None:
+                    break
+                if (event['email'], event['id']) not in sent:
+                    await response.write(sse_message(event))
+        except ConnectionResetError:
+            pass
+        finally:
+            self.events.unsubscribe(key, queue)
+        return response
+
+    async def handle_wait(self, request):
+        settings = self.get_settings()
+        self.check_access(request, settings)
+        email = request.match_info['email'].lower()
+        if '@' not in email:
+            return self.json_error(404, 'Email not found')
+        after = request.query.get('after', '')
+        try:
+            timeout = min(max(float(request.query.get('timeout', 30)), 0), MAX_WAIT)
+        except ValueError:
+            return self.json_error(400, 'Invalid timeout')
+        key = self.subscription(email, settings)
+        queue = self.events.subscribe(key)
+        try:
+            if after.isdigit():
+                events = self.backlog(key, int(after))
+                if events:
+                    return web.json_response(events)
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+            return web.json_response([event] if event else [])
+        finally:
+            self.events.unsubscribe(key, queue)
+
+    def respond(self, request, entry, response, content_type='application/json'):
+        body, etag, gzipped = response
+        headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            if gzipped is None:
+                gzipped = gzip.compress(body, 6)
+                if entry is not None and entry.response is response:
+                    entry.response = (body, etag, gzipped)
+            headers['Content-Encoding'] = 'gzip'
+            body = gzipped
+        return web.Response(body=body, headers=headers, content_type=content_type, charset='utf-8')
+
+    def json_error(self, status, text):
+        return web.Response(status=status, text=json.dumps({'error': text}), content_type='application/json', charset='utf-8')
+
+async def start_readapi_server(api, host, port, reuse_port=False):
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    # with WORKERS every worker serves the API on the same port
+    site = web.TCPSite(runner, host, port, reuse_port=reuse_port or None)
+    await site.start()
+    return runner
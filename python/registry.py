@@ -0,0 +1,307 @@
+import json
+import os
+import sqlite3
+import threading
+
+from listing import listing_of
+from messageid import received_ms
+from storage import DATA_DIR, iter_mailboxes
+
+# Mailbox registry in data/registry.sqlite, kept up to date on ingest and delete
+# so listing accounts doesn't have to scan data/ or open every JSON file.
+# web/inc/core.php reads it (and updates it when mails are deleted) through PDO.
+# Every change is one transaction, WAL lets readers and the workers write concurrently
+#
+# mailboxes  per mailbox counters
+# messages   every stored message with its listing fields (see listing.py), so mailboxes and the
+#            ADMIN view across all of them are listed without opening message files. seq numbers
+#            them in the order they were recorded, the cursor of /wait/ and /events/ (see readapi.py)
+# rendered   the cached HTML bodies (see render.py) with their size and last use, for evicting them
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    email TEXT PRIMARY KEY,
+    domain TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    attachment_bytes INTEGER NOT NULL DEFAULT 0,
+    first_received INTEGER,
+    last_received INTEGER,
+    webhook_enabled INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS mailboxes_domain ON mailboxes (domain, email);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    sender TEXT,
+    subject TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    received INTEGER NOT NULL,
+    md5 TEXT,
+    preview TEXT,
+    attachment_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (email, id)
+);
+CREATE INDEX IF NOT EXISTS messages_received ON messages (received, id);
+CREATE TABLE IF NOT EXISTS rendered (
+    email TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (email, id)
+);
+CREATE INDEX IF NOT EXISTS rendered_used ON rendered (used);
+"""
+
+# bumped when a table or column is added, older registries are rebuilt on start
+SCHEMA_VERSION = 5
+
+COLUMNS = ('email', 'domain', 'messages', 'bytes', 'attachment_bytes', 'first_received', 'last_received', 'webhook_enabled')
+MESSAGE_COLUMNS = ('email', 'id', 'sender', 'subject', 'size', 'received', 'md5', 'preview', 'attachment_count')
+
+class MailboxRegistry:
+    def __init__(self, path=os.path.join(DATA_DIR, 'registry.sqlite')):
+        self.path = path
+        # one connection per thread (controllers run in their own) and per process (workers are forked)
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and self.local.pid == os.getpid():
+            conn.close()
+        self.local.conn = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def version(self):
+        return self.connection().execute('PRAGMA user_version').fetchone()[0]
+
+    def record_message(self, email, message_id, received, size, attachment_bytes, sender, subject, listing):
+        # size is the stored JSON, listing the fields of listing.py; received is in ms since the epoch.
+        # Returns the seq of the message, AUTOINCREMENT never hands out one twice
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.count_message(conn, email, received, size, attachment_bytes)
+            cursor = conn.execute("INSERT OR REPLACE INTO messages (%s) VALUES (%s)" % (', '.join(MESSAGE_COLUMNS), ', '.join('?' * len(MESSAGE_COLUMNS))),
+                         (email, message_id, sender, subject, listing['maillen'], received,
+                          listing['md5'], listing['preview'], listing['attachment_count']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.lastrowid
+
+    def count_message(self, conn, email, received, size, attachment_bytes):
+        conn.execute("""
+            INSERT INTO mailboxes (email, domain, messages, bytes, attachment_bytes, first_received, last_received)
+            VALUES (?, ?, 1, ?, ?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET
+                messages = messages + 1,
+                bytes = bytes + excluded.bytes,
+                attachment_bytes = attachment_bytes + excluded.attachment_bytes,
+                first_received = MIN(COALESCE(first_received, excluded.first_received), excluded.first_received),
+                last_received = MAX(COALESCE(last_received, excluded.last_received), excluded.last_received)
+        """, (email, email.split('@')[-1], size, attachment_bytes, received, received))
+
+    def remove_message(self, email, message_id, size, attachment_bytes=0):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""
+                UPDATE mailboxes SET messages = MAX(messages - 1, 0), bytes = MAX(bytes - ?, 0),
+                    attachment_bytes = MAX(attachment_bytes - ?, 0)
+                WHERE email = ?
+            """, (size, attachment_bytes, email))
+            conn.execute("DELETE FROM messages WHERE email = ? AND id = ?", (email, message_id))
+            conn.execute("DELETE FROM rendered WHERE email = ? AND id = ?", (email, message_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def remove_mailbox(self, email):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM mailboxes WHERE email = ?", (email,))
+            conn.execute("DELETE FROM messages WHERE email = ?", (email,))
+            conn.execute("DELETE FROM rendered WHERE email = ?", (email,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add_rendered(self, email, message_id, size, used, max_bytes):
+        # returns the (email, id) of the least recently used bodies that no longer fit into max_bytes.
+        # The table only holds what fits into the cache, so summing it stays cheap
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT OR REPLACE INTO rendered (email, id, size, used) VALUES (?, ?, ?, ?)", (email, message_id, size, used))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM rendered").fetchone()[0]
+            evicted = []
+            if total > max_bytes:
+                for row in conn.execute("SELECT email, id, size FROM rendered ORDER BY used, id").fetchall():
+                    if total <= max_bytes:
+                        break
+                    evicted.append((row[0], row[1]))
+                    total -= row[2]
+                conn.executemany("DELETE FROM rendered WHERE email = ? AND id = ?", evicted)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return evicted
+
+    def touch_rendered(self, email, message_id, used):
+        self.connection().execute("UPDATE rendered SET used = ? WHERE email = ? AND id = ?", (used, email, message_id))
+
+    def set_webhook(self, email, enabled):
+        # a webhook can be configured before the first mail arrives
+        self.connection().execute("""
+            INSERT INTO mailboxes (email, domain, webhook_enabled) VALUES (?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET webhook_enabled = excluded.webhook_enabled
+        """, (email, email.split('@')[-1], int(bool(enabled))))
+
+    def get(self, email):
+        row = self.connection().execute("SELECT %s FROM mailboxes WHERE email = ?" % ', '.join(COLUMNS), (email,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def query(self, prefix='', domain='', offset=0, limit=50):
+        # returns (total, [mailbox dicts]) ordered by address, prefix uses the primary key range
+        where, params = self.filters(prefix, domain)
+        conn = self.connection()
+        total = conn.execute("SELECT COUNT(*) FROM mailboxes" + where, params).fetchone()[0]
+        rows = conn.execute("SELECT %s FROM mailboxes%s ORDER BY email LIMIT ? OFFSET ?" % (', '.join(COLUMNS), where),
+                            params + [limit, offset]).fetchall()
+        return total, [dict(zip(COLUMNS, row)) for row in rows]
+
+    def mailbox_messages(self, email):
+        rows = self.connection().execute("SELECT %s FROM messages WHERE email = ? ORDER BY id" % ', '.join(MESSAGE_COLUMNS), (email,)).fetchall()
+        return [dict(zip(MESSAGE_COLUMNS, row)) for row in rows]
+
+    def message_ids(self, email):
+        return [row[0] for row in self.connection().execute("SELECT id FROM messages WHERE email = ? ORDER BY id", (email,))]
+
+    def messages_after(self, email, after, limit=100):
+        # the messages recorded after the seq after, in that order; of all mailboxes if email is None.
+        # Not by id: ids are taken when a mail comes in, a slow one is recorded after later ids.
+        # Writers are serialized, so once a seq is visible every lower one is too
+        columns = ('seq',) + MESSAGE_COLUMNS
+        if email is None:
+            rows = self.connection().execute("SELECT %s FROM messages WHERE seq > ? ORDER BY seq LIMIT ?"
+                                             % ', '.join(columns), (after, limit)).fetchall()
+        else:
+            rows = self.connection().execute("SELECT %s FROM messages WHERE email = ? AND seq > ? ORDER BY seq LIMIT ?"
+                                             % ', '.join(columns), (email, after, limit)).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def latest_message_id(self):
+        row = self.connection().execute("SELECT id FROM messages ORDER BY received DESC, id DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def latest_messages(self, offset=0, limit=100):
+        # newest first, reads only the requested page of the received index
+        rows = self.connection().execute("SELECT %s FROM messages ORDER BY received DESC, id DESC LIMIT ? OFFSET ?"
+                                         % ', '.join(MESSAGE_COLUMNS), (limit, offset)).fetchall()
+        return [dict(zip(MESSAGE_COLUMNS, row)) for row in rows]
+
+    def filters(self, prefix, domain):
+        clauses = []
+        params = []
+        if prefix:
+            clauses.append("email >= ? AND email < ?")
+            params += [prefix, prefix + '\uffff']
+        if domain:
+            clauses.append("domain = ?")
+            params.append(domain)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def rebuild(self, root=DATA_DIR):
+        # full scan of data/ (reads every message once), used when the registry is missing
+        # or older than SCHEMA_VERSION. Returns the number of mailboxes
+        rows = []
+        messages = []
+        rendered = []
+        for email, path in iter_mailboxes(root):
+            row, mailbox_messages, mailbox_rendered = scan_mailbox(email, path)
+            rows.append(row)
+            messages.extend(mailbox_messages)
+            rendered.extend(mailbox_rendered)
+        conn = self.connection()
+        if self.version() < SCHEMA_VERSION:
+            # CREATE TABLE IF NOT EXISTS doesn't add columns to an older messages table
+            conn.executescript("DROP TABLE IF EXISTS messages;" + SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM mailboxes")
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM rendered")
+            conn.executemany("INSERT OR REPLACE INTO mailboxes (%s) VALUES (%s)" % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                             [tuple(row[c] for c in COLUMNS) for row in rows])
+            # seq keeps counting from where it was, the existing mail gets new ones in the order it arrived
+            messages.sort(key=lambda m: (m['received'], m['id']))
+            conn.executemany("INSERT OR REPLACE INTO messages (%s) VALUES (%s)" % (', '.join(MESSAGE_COLUMNS), ', '.join('?' * len(MESSAGE_COLUMNS))),
+                             [tuple(message[c] for c in MESSAGE_COLUMNS) for message in messages])
+            conn.executemany("INSERT OR REPLACE INTO rendered (email, id, size, used) VALUES (?, ?, ?, ?)", rendered)
+            conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+def scan_mailbox(email, path):
+    # returns the mailboxes row, the messages rows and the rendered rows of one mailbox
+    row = dict.fromkeys(COLUMNS, 0)
+    row.update(email=email, domain=email.split('@')[-1], first_received=None, last_received=None)
+    messages = []
+    rendered = []
+    for entry in os.scandir(path):
+        if entry.is_file() and entry.name.endswith('.json') and entry.name[:-5].isdigit():
+            message_id = int(entry.name[:-5])
+            received = received_ms(message_id)
+            row['messages'] += 1
+            row['bytes'] += entry.stat().st_size
+            messages.append(scan_message(email, entry.path, message_id, received))
+            row['first_received'] = received if row['first_received'] is None else min(row['first_received'], received)
+            row['last_received'] = received if row['last_received'] is None else max(row['last_received'], received)
+        elif entry.is_file() and entry.name.endswith('.html') and entry.name[:-5].isdigit():
+            stat = entry.stat()
+            rendered.append((email, int(entry.name[:-5]), stat.st_size, int(stat.st_mtime * 1000)))
+        elif entry.is_dir() and entry.name == 'attachments':
+            row['attachment_bytes'] = sum(a.stat().st_size for a in os.scandir(entry.path) if a.is_file())
+        elif entry.name == 'webhook.json':
+            try:
+                with open(entry.path) as f:
+                    row['webhook_enabled'] = int(bool(json.load(f).get('enabled')))
+            except (ValueError, OSError, AttributeError):
+                pass
+    return row, messages, rendered
+
+def scan_message(email, path, message_id, received):
+    message = {'email': email, 'id': message_id, 'sender': None, 'subject': None, 'size': 0, 'received': received,
+               'md5': None, 'preview': None, 'attachment_count': 0}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        listing = listing_of(message_id, data)
+        message.update(sender=data['parsed'].get('from'), subject=data['parsed'].get('subject'), size=listing['maillen'],
+                       md5=listing['md5'], preview=listing['preview'], attachment_count=listing['attachment_count'])
+    except (ValueError, OSError, KeyError, AttributeError, TypeError):
+        pass
+    return message
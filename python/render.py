@@ -0,0 +1,132 @@
+import html
+import logging
+import os
+import re
+import sqlite3
+import time
+from html.parser import HTMLParser
+
+from storage import resolve_mailbox, write_file
+
+logger = logging.getLogger(__name__)
+
+# HTML bodies as /api/raw-html/<email>/<id> serves them, rendered once and kept next to the
+# message as data/<email>/<id>.html
+#
+# Rendering drops scripts, frames, plugins, event handler attributes and javascript: urls and
+# points cid: references at the stored attachments. The files are a cache: the registry tracks
+# their size and last use, the least recently used are deleted once all of them together are
+# larger than HTML_CACHE_SIZE, and a missing one is rendered again on the next view (read API)
+# or served unrendered by web/
+
+# elements removed together with their content
+DROP_CONTENT = ('script', 'iframe', 'frameset', 'object', 'applet', 'noembed')
+# void elements that are removed
+DROP_TAG = ('base', 'meta', 'embed', 'frame')
+URL_ATTRS = ('href', 'src', 'action', 'formaction', 'background', 'poster', 'xlink:href', 'srcset')
+UNSAFE_SCHEMES = ('javascript:', 'vbscript:', 'data:text/html')
+
+class Sanitizer(HTMLParser):
+    def __init__(self, cids):
+        super().__init__(convert_charrefs=False)
+        self.cids = cids
+        self.out = []
+        self.dropping = []
+
+    def attrs(self, attrs):
+        out = []
+        for name, value in attrs:
+            if name.startswith('on') or name == 'srcdoc':
+                continue
+            if value is not None and name in URL_ATTRS:
+                plain = re.sub(r'[\x00-\x20]', '', value).lower()
+                if plain.startswith(UNSAFE_SCHEMES):
+                    continue
+                if plain.startswith('cid:'):
+                    value = self.cids.get(value.strip()[4:].strip('<>'), value)
+            out.append(' %s' % name if value is None else ' %s="%s"' % (name, html.escape(value, quote=True)))
+        return ''.join(out)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT:
+            self.dropping.append(tag)
+        elif not self.dropping and tag not in DROP_TAG:
+            self.out.append('<%s%s>' % (tag, self.attrs(attrs)))
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.dropping and tag not in DROP_TAG and tag not in DROP_CONTENT:
+            self.out.append('<%s%s />' % (tag, self.attrs(attrs)))
+
+    def handle_endtag(self, tag):
+        if self.dropping:
+            if tag == self.dropping[-1]:
+                self.dropping.pop()
+            return
+        if tag not in DROP_TAG and tag not in DROP_CONTENT:
+            self.out.append('</%s>' % tag)
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.out.append(data)
+
+    def handle_entityref(self, name):
+        if not self.dropping:
+            self.out.append('&%s;' % name)
+
+    def handle_charref(self, name):
+        if not self.dropping:
+            self.out.append('&#%s;' % name)
+
+    def handle_decl(self, decl):
+        self.out.append('<!%s>' % decl)
+
+    # comments (conditional ones included) and processing instructions are dropped
+
+def sanitize_html(body, cids=None):
+    parser = Sanitizer(cids or {})
+    try:
+        parser.feed(body)
+        parser.close()
+    except Exception:
+        # what was emitted up to here is sanitized, markup HTMLParser chokes on just ends the body
+        pass
+    return ''.join(parser.out)
+
+def render_html(email, data):
+    # the rendered body of a stored message, None if it has no HTML part
+    parsed = data.get('parsed') or {}
+    body = parsed.get('htmlbody')
+    if not body:
+        return None
+    cids = {}
+    for attachment in parsed.get('attachments_details') or []:
+        if attachment.get('cid'):
+            cids[attachment['cid'].strip('<>')] = '/api/attachment/%s/%s' % (email, attachment['id'])
+    return sanitize_html(body, cids)
+
+def rendered_path(mailbox, message_id):
+    return os.path.join(mailbox, '%s.html' % message_id)
+
+def cache_html(registry, mailbox, email, message_id, data, max_bytes, layout='flat'):
+    # renders the body and stores it, returns it encoded (None without an HTML part)
+    body = render_html(email, data)
+    if body is None:
+        return None
+    body = body.encode('utf-8')
+    if max_bytes <= 0 or len(body) > max_bytes:
+        return body
+    path = rendered_path(mailbox, message_id)
+    # a cache, so no fsync: it is rendered again if it gets lost
+    write_file(path, body)
+    try:
+        evicted = registry.add_rendered(email, int(message_id), len(body), int(time.time() * 1000), max_bytes)
+    except sqlite3.Error as e:
+        # an untracked file would never be evicted
+        logger.error("Could not record rendered HTML: %s" % str(e))
+        evicted = [(email, int(message_id))]
+    for other, other_id in evicted:
+        try:
+            os.remove(rendered_path(resolve_mailbox(other, layout), other_id))
+        except FileNotFoundError:
+            pass
+    return body
@@ -0,0 +1,213 @@
+import errno
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+# Where mailboxes live below data/. Shared by mailserver3.py, the cleanup and
+# tools/migrate_data_layout.py; web/inc/core.php has the same rules in getDirForEmail
+#
+#   flat     data/<email>/
+#   sharded  data/<md5[0:2]>/<md5[2:4]>/<email>/
+#
+# Readers look in both places so a tree can be migrated while the server runs
+
+DATA_DIR = "../data"
+LAYOUTS = ('flat', 'sharded')
+# how files below data/ are written, see write_file and GroupCommit
+DURABILITY = ('none', 'fsync', 'group')
+
+def shard(email):
+    digest = hashlib.md5(email.encode('utf-8')).hexdigest()
+    return digest[0:2], digest[2:4]
+
+def mailbox_path(email, layout='flat', root=DATA_DIR):
+    if layout == 'sharded':
+        return os.path.join(root, *shard(email), email)
+    return os.path.join(root, email)
+
+def other_layout(layout):
+    return 'flat' if layout == 'sharded' else 'sharded'
+
+def resolve_mailbox(email, layout='flat', root=DATA_DIR):
+    # the directory a mailbox is in right now, preferring the configured layout
+    path = mailbox_path(email, layout, root)
+    if os.path.isdir(path):
+        return path
+    legacy = mailbox_path(email, other_layout(layout), root)
+    if os.path.isdir(legacy):
+        return legacy
+    return path
+
+def ensure_mailbox(email, layout='flat', root=DATA_DIR):
+    # creates the mailbox in the configured layout, moving it over from the other one
+    path = mailbox_path(email, layout, root)
+    legacy = mailbox_path(email, other_layout(layout), root)
+    if os.path.isdir(legacy):
+        move_mailbox(legacy, path)
+    elif not os.path.isdir(path):
+        os.makedirs(os.path.dirname(path), 0o755, exist_ok=True)
+        try:
+            os.mkdir(path, 0o755)
+        except FileExistsError:
+            pass
+    return path
+
+def move_mailbox(src, dst):
+    # rename is atomic, if dst appeared in the meantime the contents are merged
+    os.makedirs(os.path.dirname(dst), 0o755, exist_ok=True)
+    try:
+        os.rename(src, dst)
+        return
+    except FileNotFoundError:
+        # somebody else moved it
+        return
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+    for entry in os.scandir(src):
+        target = os.path.join(dst, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            move_mailbox(entry.path, target)
+        else:
+            os.replace(entry.path, target)
+    try:
+        os.rmdir(src)
+    except OSError:
+        pass
+
+def is_shard(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+def iter_mailboxes(root=DATA_DIR):
+    # yields (email, path) for every mailbox in either layout
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        if '@' in entry.name:
+            yield entry.name, entry.path
+        elif is_shard(entry.name):
+            for second in os.scandir(entry.path):
+                if not second.is_dir() or not is_shard(second.name):
+                    continue
+                for mailbox in os.scandir(second.path):
+                    if mailbox.is_dir() and '@' in mailbox.name:
+                        yield mailbox.name, mailbox.path
+
+def prune_shards(root=DATA_DIR):
+    # removes empty shard directories, returns their paths
+    removed = []
+    for entry in os.scandir(root):
+        if not entry.is_dir() or not is_shard(entry.name):
+            continue
+        for second in os.scandir(entry.path):
+            if second.is_dir() and is_shard(second.name) and not os.listdir(second.path):
+                try:
+                    os.rmdir(second.path)
+                    removed.append(second.path)
+                except OSError:
+                    pass
+        if not os.listdir(entry.path):
+            try:
+                os.rmdir(entry.path)
+                removed.append(entry.path)
+            except OSError:
+                pass
+    return removed
+
+# Files are written to a hidden temp file next to the target and renamed over it,
+# so readers never see a partial file and a crash leaves at most a stray *.tmp
+#
+#   none   rename only, the OS writes the data back when it likes
+#   fsync  fsync the file before and its directory after the rename
+#   group  like fsync, but GroupCommit does it for all files written within an interval
+
+def temp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.%d.%d.tmp' % (name, os.getpid(), threading.get_ident()))
+
+def sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_temp(path, data, sync=False):
+    tmp = temp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+def write_file(path, data, durability='none'):
+    tmp = write_temp(path, data, durability == 'fsync')
+    os.replace(tmp, path)
+    if durability == 'fsync':
+        sync_dir(os.path.dirname(path))
+
+class GroupCommit:
+    # Collects written temp files and makes them durable together every `interval`
+    # seconds: fsync all of them, rename them in order, fsync their directories once.
+    # write() returns a Future that is done when the file is in place
+    def __init__(self, interval=0.01):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.pending = []
+        self.thread = None
+        self.pid = None
+
+    def write(self, path, data):
+        tmp = write_temp(path, data)
+        future = Future()
+        with self.lock:
+            self.pending.append((tmp, path, future))
+            # the flusher thread doesn't survive a fork
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+                self.thread.start()
+        return future
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if batch:
+                self.flush(batch)
+
+    def flush(self, batch):
+        done = []
+        directories = set()
+        for tmp, path, future in batch:
+            try:
+                fd = os.open(tmp, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmp, path)
+                directories.add(os.path.dirname(path))
+                done.append((future, os.path.dirname(path)))
+            except OSError as e:
+                future.set_exception(e)
+        errors = {}
+        for directory in directories:
+            try:
+                sync_dir(directory)
+            except OSError as e:
+                errors[directory] = e
+        for future, directory in done:
+            if directory in errors:
+                future.set_exception(errors[directory])
+            else:
+                future.set_result(None)
+        return len(batch)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the stages of CustomHandler.handle_DATA
+
+Feeds a corpus of message fixtures straight into the handler stage methods
+of python/mailserver3.py (no sockets) and reports per-stage timings and
+allocations: parse, part decode, attachment hashing, cid replacement,
+JSON serialization, filesystem writes and webhook rendering.
+
+Fixtures are the DATA sections of tools/testmail*.txt plus generated large
+messages; extra .eml files can be added with --fixtures.
+
+    python3 tools/bench_handler.py --iterations 200 --output new.json --compare old.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'python'))
+sys.path.insert(0, TOOLS_DIR)
+
+import mailserver3
+import render
+from bench_smtp import percentiles
+
+STAGES = ('parse', 'decode', 'attachments', 'replace_cid', 'listing', 'serialize', 'write', 'render_html', 'webhook_render')
+
+WEBHOOK_TEMPLATE = json.dumps({
+    'to': '{{to}}', 'from': '{{from}}', 'subject': '{{subject}}',
+    'body': '{{body}}', 'htmlbody': '{{htmlbody}}', 'sender_ip': '{{sender_ip}}',
+    'attachments': '__ATT__',
+}).replace('"__ATT__"', '{{attachments}}')
+
+
+def session_data(path):
+    """Extract the message from an SMTP session transcript (between DATA and the final dot)"""
+    with open(path, 'rb') as f:
+        lines = f.read().replace(b'\r\n', b'\n').split(b'\n')
+    if b'DATA' not in [l.strip().upper() for l in lines]:
+        return b'\r\n'.join(lines)
+    start = [l.strip().upper() for l in lines].index(b'DATA') + 1
+    body = []
+    for line in lines[start:]:
+        if line.strip() == b'.':
+            break
+        body.append(line[1:] if line.startswith(b'..') else line)
+    return b'\r\n'.join(body) + b'\r\n'
+
+
+def generated_fixtures():
+    text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20 + '\n'
+
+    large_text = MIMEText(text * 1000, 'plain', 'utf-8')
+    large_text['Subject'] = 'Large plain text'
+
+    html = MIMEMultipart('related')
+    html.attach(MIMEText('<html><body>%s<img src="cid:logo@bench"><img src="cid:banner@bench"></body></html>'
+                         % ('<p>%s</p>' % text) * 200, 'html', 'utf-8'))
+    for cid in ('logo@bench', 'banner@bench'):
+        img = MIMEImage(os.urandom(20000), 'png')
+        img['Content-ID'] = '<%s>' % cid
+        img['Content-Disposition'] = 'inline; filename="%s.png"' % cid.split('@')[0]
+        html.attach(img)
+    html['Subject'] = 'HTML with inline images'
+
+    attachments = MIMEMultipart()
+    attachments.attach(MIMEText(text, 'plain', 'utf-8'))
+    for i in range(10):
+        part = MIMEApplication(os.urandom(500000), Name='file-%d.bin' % i)
+        part['Content-Disposition'] = 'attachment; filename="file-%d.bin"' % i
+        attachments.attach(part)
+    attachments['Subject'] = 'Ten 500kB attachments'
+
+    latin1 = MIMEText('Grüße aus Köln, déjà vu. ' * 2000, 'plain', 'latin-1')
+    latin1['Subject'] = '=?iso-8859-1?q?Gr=FC=DFe?='
+
+    fixtures = {}
+    for name, msg in (('large-plain', large_text), ('html-inline', html),
+                      ('attachments-10x500k', attachments), ('latin1', latin1)):
+        msg['From'] = 'bench@bench.local'
+        msg['To'] = 'bench@bench.test'
+        fixtures[name] = msg.as_bytes()
+    return fixtures
+
+
+def load_fixtures(extra):
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(TOOLS_DIR, 'testmail*.txt'))):
+        fixtures[os.path.basename(path)] = session_data(path)
+    fixtures.update(generated_fixtures())
+    for path in extra:
+        with open(path, 'rb') as f:
+            fixtures[os.path.basename(path)] = f.read()
+    return fixtures
+
+
+class StageRecorder:
+    """Collects per-stage durations and, with trace=True, peak allocations"""
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.timings = {stage: [] for stage in STAGES}
+        self.allocs = {stage: [] for stage in STAGES}
+
+    @contextmanager
+    def stage(self, name):
+        if self.trace:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name].append(time.perf_counter() - start)
+            if self.trace:
+                self.allocs[name].append(tracemalloc.get_traced_memory()[1] - base)
+
+
+def run_stages(handler, recorder, content, rcpt, filenamebase, settings):
+    """Run every handle_DATA stage once for one recipient"""
+    handle_attachment = handler.handleAttachment
+
+    def timed_attachment(part, settings):
+        with recorder.stage('attachments'):
+            return handle_attachment(part, settings)
+
+    # attachment hashing is reported on its own and also included in decode
+    handler.handleAttachment = timed_attachment
+    try:
+        with recorder.stage('parse'):
+            message, subject = handler.parse_message(content)
+        with recorder.stage('decode'):
+            plaintext, html, attachments = handler.extract_parts(message, settings)
+    finally:
+        handler.handleAttachment = handle_attachment
+
+    with recorder.stage('replace_cid'):
+        handler.replace_cid_with_attachment_id(html, attachments, filenamebase, rcpt)
+
+    with recorder.stage('listing'):
+        listing = handler.build_listing(filenamebase, content, plaintext, html, attachments)
+
+    savedata = handler.build_email_data(rcpt, ('127.0.0.1', 0), [rcpt], content.decode('utf-8', 'replace'),
+                                        message, subject, plaintext, html, attachments, filenamebase, listing)
+
+    with recorder.stage('serialize'):
+        payload = handler.serialize_email(savedata)
+
+    with recorder.stage('write'):
+        mailbox = handler.mailbox_dir(rcpt, settings)
+        handler.save_attachments(rcpt, mailbox, attachments, savedata['parsed'], settings)
+        handler.write_email(mailbox, filenamebase, payload, settings)
+
+    with recorder.stage('render_html'):
+        render.render_html(rcpt, savedata)
+
+    with recorder.stage('webhook_render'):
+        rendered = handler.replace_template_variables(WEBHOOK_TEMPLATE, savedata)
+        handler.sign_payload(json.dumps(json.loads(rendered)), 'bench-secret')
+
+
+def summarize(recorder):
+    result = {}
+    for stage in STAGES:
+        if not recorder.timings[stage]:
+            continue
+        result[stage] = percentiles(recorder.timings[stage])
+        if recorder.allocs[stage]:
+            result[stage]['alloc_peak_kb'] = max(recorder.allocs[stage]) / 1024
+    return result
+
+
+def compare_results(current, baseline):
+    print('\n📊 Compared to baseline (p50 ms)')
+    print('-' * 70)
+    for name, stages in current['fixtures'].items():
+        before = baseline.get('fixtures', {}).get(name)
+        if not before:
+            continue
+        for stage, values in stages.items():
+            old = before.get(stage, {}).get('p50')
+            if not old:
+                continue
+            change = (values['p50'] - old) / old * 100
+            marker = '✅' if change < 2 else '⚠️ '
+            print('%s %-24s %-15s %10.3f -> %10.3f (%+.1f%%)' % (marker, name, stage, old, values['p50'], change))
+
+
+def main():
+    fixtures = load_fixtures(args.fixtures)
+    handler = mailserver3.CustomHandler('Benchmark')
+    settings = mailserver3.Settings(url='http://localhost:8080', data_layout=args.layout, durability=args.durability)
+
+    # the handler writes to ../data relative to the working directory
+    root = tempfile.mkdtemp(prefix='otm-bench-handler-')
+    os.mkdir(os.path.join(root, 'data'))
+    os.mkdir(os.path.join(root, 'python'))
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, 'python'))
+
+    summary = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'iterations': args.iterations,
+        'durability': args.durability,
+        'fixtures': {},
+    }
+    try:
+        for name, content in fixtures.items():
+            if args.only and args.only not in name:
+                continue
+            rcpt = 'bench-%d@bench.test' % len(summary['fixtures'])
+
+            for i in range(args.warmup):
+                run_stages(handler, StageRecorder(), content, rcpt, 'warmup%d' % i, settings)
+
+            recorder = StageRecorder()
+            for i in range(args.iterations):
+                run_stages(handler, recorder, content, rcpt, str(i), settings)
+
+            # the traced runs are slower, only keep their allocations
+            if args.allocations:
+                traced = StageRecorder(trace=True)
+                tracemalloc.start()
+                for i in range(args.allocations):
+                    run_stages(handler, traced, content, rcpt, 'alloc%d' % i, settings)
+                tracemalloc.stop()
+                recorder.allocs = traced.allocs
+
+            stages = summarize(recorder)
+            summary['fixtures'][name] = stages
+            print('\n📨 %s (%d bytes)' % (name, len(content)))
+            print('   %-15s %10s %10s %10s %12s' % ('stage', 'p50 ms', 'p99 ms', 'mean ms', 'alloc kB'))
+            for stage, values in stages.items():
+                print('   %-15s %10.3f %10.3f %10.3f %12s' % (
+                    stage, values['p50'], values['p99'], values['mean'],
+                    '%.1f' % values['alloc_peak_kb'] if 'alloc_peak_kb' in values else '-'))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('\n💾 Results saved to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(summary, json.load(f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage microbenchmarks for the mailserver handler')
+    parser.add_argument('--iterations', '-n', type=int, default=100, help='timed runs per fixture (default: 100)')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed runs per fixture (default: 3)')
+    parser.add_argument('--allocations', type=int, default=3,
+                        help='extra runs under tracemalloc for allocation peaks, 0 to skip (default: 3)')
+    parser.add_argument('--fixtures', nargs='*', default=[], help='additional raw .eml files')
+    parser.add_argument('--durability', choices=mailserver3.DURABILITY, default='none',
+                        help='how the write stage syncs files, group waits for each commit (default: none)')
+    parser.add_argument('--layout', choices=mailserver3.LAYOUTS, default='flat', help='data/ layout to write (default: flat)')
+    parser.add_argument('--only', help='only run fixtures whose name contains this string')
+    parser.add_argument('--output', '-o', help='save results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+SMTP load generator and throughput benchmark for OpenTrashmail
+
+Drives N concurrent async SMTP clients against mailserver3.py and records
+throughput, latency percentiles, server RSS and files written. By default a
+throwaway server instance is started from this checkout (own config.ini and
+data/ in a temp dir); use --target to benchmark an already running server.
+
+Results can be saved as JSON and compared against an earlier run:
+
+    python3 tools/bench_smtp.py --messages 2000 --concurrency 50 --output new.json --compare old.json
+"""
+
+import asyncio
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# placeholder replaced with the per-message sequence number at send time
+SEQ_MARKER = '__BENCH_SEQ__'
+
+MESSAGE_KINDS = ('plain', 'html', 'multipart', 'rcpts')
+
+
+class SMTPError(Exception):
+    pass
+
+
+class SMTPClient:
+    """Minimal asyncio SMTP client (EHLO/MAIL/RCPT/DATA or BDAT) that keeps a connection open"""
+
+    def __init__(self, host, port, chunking=False):
+        self.host = host
+        self.port = port
+        self.chunking = chunking
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await self.expect(220)
+        lines = await self.command('EHLO bench.local', 250)
+        if self.chunking and not any(line[4:].upper() == 'CHUNKING' for line in lines):
+            raise SMTPError('server does not advertise CHUNKING')
+
+    async def read_reply(self):
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise SMTPError('connection closed by server')
+            lines.append(line.decode('utf-8', 'replace').rstrip())
+            if len(line) < 4 or line[3:4] != b'-':
+                break
+        return int(lines[-1][:3]), lines
+
+    async def expect(self, code):
+        status, lines = await self.read_reply()
+        if status != code:
+            raise SMTPError(' / '.join(lines))
+        return lines
+
+    async def command(self, line, code):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self.expect(code)
+
+    async def send(self, mail_from, rcpts, data):
+        """
+        Send one message on the open connection
+
+        Returns (transaction_seconds, accept_seconds): time from MAIL FROM to the
+        final reply, and time from the end-of-data dot to the final reply.
+        """
+        if self.chunking:
+            return await self.send_chunked(mail_from, rcpts, data)
+        start = time.perf_counter()
+        await self.command('MAIL FROM:<%s>' % mail_from, 250)
+        for rcpt in rcpts:
+            await self.command('RCPT TO:<%s>' % rcpt, 250)
+        await self.command('DATA', 354)
+        # dot-stuffing and CRLF line endings
+        body = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        body = body.replace(b'\r\n.', b'\r\n..')
+        if body.startswith(b'.'):
+            body = b'.' + body
+        if not body.endswith(b'\r\n'):
+            body += b'\r\n'
+        self.writer.write(body)
+        dot_sent = time.perf_counter()
+        self.writer.write(b'.\r\n')
+        await self.writer.drain()
+        await self.expect(250)
+        end = time.perf_counter()
+        return end - start, end - dot_sent
+
+    async def send_chunked(self, mail_from, rcpts, data):
+        """Pipeline MAIL, RCPT and a single BDAT LAST in one write (RFC 2920/3030)"""
+        start = time.perf_counter()
+        body = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        commands = ['MAIL FROM:<%s>' % mail_from] + ['RCPT TO:<%s>' % rcpt for rcpt in rcpts]
+        commands.append('BDAT %d LAST' % len(body))
+        self.writer.write(''.join(c + '\r\n' for c in commands).encode('utf-8') + body)
+        data_sent = time.perf_counter()
+        await self.writer.drain()
+        for _ in commands:
+            await self.expect(250)
+        end = time.perf_counter()
+        return end - start, end - data_sent
+
+    async def quit(self):
+        try:
+            await self.command('QUIT', 221)
+        except Exception:
+            pass
+        self.writer.close()
+
+
+def build_message(kind, domain, attachments=2, attachment_size=50000, recipients=20):
+    """Build a message template of the given kind; returns (rcpts, bytes with SEQ_MARKER)"""
+    rcpt = 'bench-%s@%s' % (kind, domain)
+    rcpts = [rcpt]
+    subject = 'Benchmark %s #%s' % (kind, SEQ_MARKER)
+    text = 'Benchmark message %s.\n\n' % SEQ_MARKER + 'Lorem ipsum dolor sit amet. ' * 40
+
+    if kind == 'plain':
+        msg = MIMEText(text, 'plain', 'utf-8')
+    elif kind == 'html':
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(text, 'plain', 'utf-8'))
+        msg.attach(MIMEText('<html><body><p>%s</p></body></html>' % text.replace('\n', '<br>'), 'html', 'utf-8'))
+    elif kind == 'multipart':
+        msg = MIMEMultipart()
+        msg.attach(MIMEText(text, 'plain', 'utf-8'))
+        for i in range(attachments):
+            part = MIMEApplication(os.urandom(attachment_size), Name='bench-%d.bin' % i)
+            part['Content-Disposition'] = 'attachment; filename="bench-%d.bin"' % i
+            msg.attach(part)
+    elif kind == 'rcpts':
+        msg = MIMEText(text, 'plain', 'utf-8')
+        rcpts = ['bench-rcpt%d@%s' % (i, domain) for i in range(recipients)]
+    else:
+        raise ValueError('unknown message kind: %s' % kind)
+
+    msg['Subject'] = subject
+    msg['From'] = 'bench@bench.local'
+    msg['To'] = ', '.join(rcpts)
+    return rcpts, msg.as_bytes()
+
+
+def parse_mix(mix):
+    """Parse a mix like 'plain=5,html=3,multipart=1,rcpts=1' into weights"""
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGE_KINDS:
+            raise ValueError('unknown message kind in mix: %s' % kind)
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def percentiles(values):
+    """Latency summary in milliseconds"""
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] * 1000
+
+    return {
+        'min': values[0] * 1000,
+        'p50': pct(50),
+        'p90': pct(90),
+        'p99': pct(99),
+        'max': values[-1] * 1000,
+        'mean': sum(values) / len(values) * 1000,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_rss_kb(pid):
+    """Resident set size of a process in kB (Linux only, None elsewhere)"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def directory_usage(path):
+    """Number of files and total bytes below path"""
+    files = 0
+    size = 0
+    for subdir, dirs, filenames in os.walk(path):
+        for name in filenames:
+            files += 1
+            try:
+                size += os.path.getsize(os.path.join(subdir, name))
+            except OSError:
+                pass
+    return files, size
+
+
+class LocalServer:
+    """
+    A throwaway mailserver3.py instance
+
+    mailserver3.py resolves ../config.ini and ../data relative to its working
+    directory, so the temp root mirrors the repo layout with symlinked sources.
+    """
+
+    def __init__(self, domain, config=None):
+        self.domain = domain
+        self.config = config or {}
+        self.root = None
+        self.process = None
+        self.port = None
+        self.log = None
+
+    @property
+    def data_dir(self):
+        return os.path.join(self.root, 'data')
+
+    def write_config(self):
+        sections = {
+            'GENERAL': {'DOMAINS': self.domain, 'URL': 'http://localhost:8080'},
+            'MAILSERVER': {'MAILPORT': str(self.port), 'DISCARD_UNKNOWN': 'false'},
+            'CLEANUP': {'DELETE_OLDER_THAN_DAYS': 'false'},
+            'WEBHOOK': {},
+        }
+        for section, values in self.config.items():
+            sections.setdefault(section, {}).update(values)
+        with open(os.path.join(self.root, 'config.ini'), 'w') as f:
+            for section, values in sections.items():
+                f.write('[%s]\n' % section)
+                for key, value in values.items():
+                    f.write('%s=%s\n' % (key, value))
+                f.write('\n')
+
+    async def start(self):
+        self.root = tempfile.mkdtemp(prefix='otm-bench-')
+        self.port = free_port()
+        os.mkdir(self.data_dir)
+        pydir = os.path.join(self.root, 'python')
+        os.mkdir(pydir)
+        for name in os.listdir(os.path.join(REPO_ROOT, 'python')):
+            if name.endswith('.py'):
+                os.symlink(os.path.join(REPO_ROOT, 'python', name), os.path.join(pydir, name))
+        self.write_config()
+
+        self.log = open(os.path.join(self.root, 'mailserver.log'), 'w')
+        self.process = subprocess.Popen([sys.executable, 'mailserver3.py'], cwd=pydir,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('mailserver exited early, see %s' % self.log.name)
+            try:
+                client = SMTPClient('127.0.0.1', self.port)
+                await client.connect()
+                await client.quit()
+                return
+            except (OSError, SMTPError):
+                await asyncio.sleep(0.1)
+        raise RuntimeError('mailserver did not start within 15s')
+
+    def stop(self, keep=False):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.log:
+            self.log.close()
+        if self.root and not keep:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+async def run_load(host, port, templates, weights, total, concurrency, per_connection, on_sent=None, chunking=False):
+    """
+    Send `total` messages over `concurrency` client connections
+
+    Each worker reconnects after `per_connection` messages (0 = never).
+    With `chunking` messages are sent pipelined with BDAT instead of DATA.
+    Returns a dict with per-message latencies and failures.
+    """
+    kinds = list(weights)
+    kind_weights = [weights[k] for k in kinds]
+    counter = iter(range(total))
+    results = {'latency': [], 'accept': [], 'failed': 0, 'errors': {}, 'by_kind': {k: 0 for k in kinds}}
+
+    async def worker():
+        client = None
+        sent_on_connection = 0
+        for seq in counter:
+            kind = random.choices(kinds, kind_weights)[0]
+            rcpts, data = templates[kind]
+            try:
+                if client is None:
+                    client = SMTPClient(host, port, chunking)
+                    await client.connect()
+                latency, accept = await client.send('bench@bench.local', rcpts,
+                                                    data.replace(SEQ_MARKER.encode(), str(seq).encode()))
+                results['latency'].append(latency)
+                results['accept'].append(accept)
+                results['by_kind'][kind] += 1
+                if on_sent:
+                    on_sent(seq, kind, rcpts, accept)
+                sent_on_connection += 1
+                if per_connection and sent_on_connection >= per_connection:
+                    await client.quit()
+                    client = None
+                    sent_on_connection = 0
+            except (OSError, SMTPError) as e:
+                results['failed'] += 1
+                key = str(e)[:80]
+                results['errors'][key] = results['errors'].get(key, 0) + 1
+                if client is not None:
+                    client.writer.close()
+                client = None
+                sent_on_connection = 0
+        if client is not None:
+            await client.quit()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+
+async def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        rss = read_rss_kb(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+def compare_results(current, baseline):
+    """Print relative change of the headline metrics against a baseline run"""
+    rows = [
+        ('throughput msgs/s', current['throughput'], baseline.get('throughput'), True),
+        ('latency p50 ms', current['latency_ms'].get('p50'), baseline.get('latency_ms', {}).get('p50'), False),
+        ('latency p99 ms', current['latency_ms'].get('p99'), baseline.get('latency_ms', {}).get('p99'), False),
+        ('accept p99 ms', current['accept_latency_ms'].get('p99'), baseline.get('accept_latency_ms', {}).get('p99'), False),
+        ('server rss peak kB', current['server'].get('rss_peak_kb'), baseline.get('server', {}).get('rss_peak_kb'), False),
+    ]
+    print('\n📊 Compared to baseline')
+    print('-' * 60)
+    for name, now, before, higher_is_better in rows:
+        if now is None or not before:
+            continue
+        change = (now - before) / before * 100
+        better = change > 0 if higher_is_better else change < 0
+        marker = '✅' if better or abs(change) < 2 else '⚠️ '
+        print('%s %-20s %12.2f -> %12.2f (%+.1f%%)' % (marker, name, before, now, change))
+
+
+async def main():
+    weights = parse_mix(args.mix)
+    templates = {kind: build_message(kind, args.domain, args.attachments, args.attachment_size, args.recipients)
+                 for kind in weights}
+
+    server = None
+    if args.target:
+        host, _, port = args.target.rpartition(':')
+        port = int(port)
+        data_dir = args.data_dir
+        pid = args.server_pid
+    else:
+        server = LocalServer(args.domain)
+        await server.start()
+        host, port = '127.0.0.1', server.port
+        data_dir = server.data_dir
+        pid = server.process.pid
+        print('🚀 Started local mailserver on port %d (%s)' % (port, server.root))
+
+    files_before = directory_usage(data_dir) if data_dir else (0, 0)
+    rss_samples = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_rss(pid, rss_samples, stop)) if pid else None
+
+    try:
+        if args.warmup:
+            await run_load(host, port, templates, weights, args.warmup, min(args.concurrency, args.warmup), 0,
+                           chunking=args.chunking)
+
+        print('📤 Sending %d messages with %d concurrent clients...' % (args.messages, args.concurrency))
+        started = time.perf_counter()
+        results = await run_load(host, port, templates, weights, args.messages, args.concurrency,
+                                 args.messages_per_connection, chunking=args.chunking)
+        duration = time.perf_counter() - started
+    finally:
+        stop.set()
+        if sampler:
+            await sampler
+        files_after = directory_usage(data_dir) if data_dir else (0, 0)
+        if server:
+            server.stop(keep=args.keep)
+
+    sent = len(results['latency'])
+    summary = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'messages': args.messages,
+            'concurrency': args.concurrency,
+            'messages_per_connection': args.messages_per_connection,
+            'chunking': args.chunking,
+            'mix': weights,
+            'attachments': args.attachments,
+            'attachment_size': args.attachment_size,
+            'recipients': args.recipients,
+            'target': args.target or 'local',
+        },
+        'duration_s': duration,
+        'sent': sent,
+        'failed': results['failed'],
+        'errors': results['errors'],
+        'by_kind': results['by_kind'],
+        'throughput': sent / duration if duration > 0 else 0,
+        'latency_ms': percentiles(results['latency']),
+        'accept_latency_ms': percentiles(results['accept']),
+        'server': {
+            'rss_peak_kb': max(rss_samples) if rss_samples else None,
+            'rss_end_kb': rss_samples[-1] if rss_samples else None,
+            'files_written': files_after[0] - files_before[0],
+            'bytes_written': files_after[1] - files_before[1],
+        },
+    }
+
+    print('\n✅ Sent %d messages in %.2fs (%d failed)' % (sent, duration, results['failed']))
+    print('   Throughput:     %.1f msgs/s' % summary['throughput'])
+    if sent:
+        lat = summary['latency_ms']
+        acc = summary['accept_latency_ms']
+        print('   Transaction ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (lat['p50'], lat['p90'], lat['p99'], lat['max']))
+        print('   Accept ms:      p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (acc['p50'], acc['p90'], acc['p99'], acc['max']))
+    if summary['server']['rss_peak_kb']:
+        print('   Server RSS:     peak %d kB, end %d kB' % (summary['server']['rss_peak_kb'], summary['server']['rss_end_kb']))
+    if data_dir:
+        print('   Files written:  %d (%d bytes)' % (summary['server']['files_written'], summary['server']['bytes_written']))
+    for error, count in results['errors'].items():
+        print('   ❌ %dx %s' % (count, error))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('\n💾 Results saved to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(summary, json.load(f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SMTP throughput benchmark for OpenTrashmail')
+    parser.add_argument('--target', help='HOST:PORT of a running server (default: start a local instance)')
+    parser.add_argument('--data-dir', help='data directory of the --target server, for counting files written')
+    parser.add_argument('--server-pid', type=int, help='PID of the --target server, for RSS sampling')
+    parser.add_argument('--messages', '-n', type=int, default=1000, help='number of messages to send (default: 1000)')
+    parser.add_argument('--concurrency', '-c', type=int, default=20, help='concurrent SMTP clients (default: 20)')
+    parser.add_argument('--messages-per-connection', type=int, default=1,
+                        help='reconnect after this many messages, 0 = reuse one connection per client (default: 1)')
+    parser.add_argument('--chunking', action='store_true',
+                        help='pipeline MAIL/RCPT and send the message with BDAT (CHUNKING) instead of DATA')
+    parser.add_argument('--warmup', type=int, default=0, help='messages to send before measuring')
+    parser.add_argument('--mix', default='plain=5,html=3,multipart=1,rcpts=1',
+                        help='weighted message mix of %s (default: plain=5,html=3,multipart=1,rcpts=1)' % ','.join(MESSAGE_KINDS))
+    parser.add_argument('--attachments', type=int, default=2, help='attachments per multipart message (default: 2)')
+    parser.add_argument('--attachment-size', type=int, default=50000, help='bytes per attachment (default: 50000)')
+    parser.add_argument('--recipients', type=int, default=20, help='recipients per "rcpts" message (default: 20)')
+    parser.add_argument('--domain', default='bench.test', help='recipient domain (default: bench.test)')
+    parser.add_argument('--output', '-o', help='save results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the temp dir of the local server')
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print('\n👋 Aborted')
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Webhook delivery benchmark for OpenTrashmail
+
+Starts a local mailserver (see bench_smtp.py) and a stand-in webhook receiver,
+writes webhook.json for many mailboxes, floods the server and measures:
+
+- latency from the end of SMTP DATA to the webhook POST arriving
+- SMTP accept latency (webhooks are delivered before the 250 reply)
+- sustained deliveries/sec
+- retry behaviour against a slow (--delay) or failing (--failure-rate) receiver
+
+    python3 tools/bench_webhook.py --mailboxes 50 --messages 500 --failure-rate 0.1 --output webhook.json
+"""
+
+import asyncio
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from email.mime.text import MIMEText
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_smtp import LocalServer, SEQ_MARKER, free_port, percentiles, run_load
+
+TOKEN_RE = re.compile(r'#(\d+)')
+
+
+class Receiver:
+    """Stand-in webhook receiver that can be made slow or unreliable"""
+
+    def __init__(self, delay=0, failure_rate=0):
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.attempts = {}
+        self.delivered = {}
+        self.failed_responses = 0
+
+    async def webhook_handler(self, request):
+        data = await request.json()
+        received = time.perf_counter()
+        subject = data.get('subject') or data.get('parsed', {}).get('subject', '')
+        match = TOKEN_RE.search(subject)
+        if not match:
+            return web.Response(text="Unknown message", status=400)
+        seq = int(match.group(1))
+        self.attempts[seq] = self.attempts.get(seq, 0) + 1
+
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failure_rate and random.random() < self.failure_rate:
+            self.failed_responses += 1
+            return web.Response(text="Simulated failure", status=500)
+
+        self.delivered.setdefault(seq, received)
+        return web.Response(text="OK", status=200)
+
+    def pending(self, sent, max_attempts):
+        """Sent messages that are neither delivered nor out of attempts"""
+        return [seq for seq in sent if seq not in self.delivered and self.attempts.get(seq, 0) < max_attempts]
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/webhook', self.webhook_handler)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def write_webhook_config(data_dir, mailbox, webhook_url, max_attempts, backoff, secret):
+    """Write data/<mailbox>/webhook.json the same way the web UI saves it"""
+    path = os.path.join(data_dir, mailbox)
+    os.makedirs(path, exist_ok=True)
+    config = {
+        'enabled': True,
+        'webhook_url': webhook_url,
+        'payload_template': json.dumps({
+            'email': '{{to}}',
+            'from': '{{from}}',
+            'subject': '{{subject}}',
+            'body': '{{body}}',
+        }),
+        'retry_config': {
+            'max_attempts': max_attempts,
+            'backoff_multiplier': backoff,
+        },
+        'secret_key': secret or '',
+    }
+    with open(os.path.join(path, 'webhook.json'), 'w') as f:
+        json.dump(config, f)
+
+
+def build_mailbox_message(mailbox, body_size):
+    msg = MIMEText('Webhook benchmark %s\n\n' % SEQ_MARKER + 'x' * body_size, 'plain', 'utf-8')
+    msg['Subject'] = 'Webhook benchmark #%s' % SEQ_MARKER
+    msg['From'] = 'bench@bench.local'
+    msg['To'] = mailbox
+    return [mailbox], msg.as_bytes()
+
+
+async def main():
+    receiver = Receiver(args.delay, args.failure_rate)
+    receiver_port = free_port()
+    await receiver.start(receiver_port)
+    webhook_url = 'http://127.0.0.1:%d/webhook' % receiver_port
+
+    config = {'WEBHOOK': {'WEBHOOK_URL': webhook_url}} if args.global_webhook else {}
+    server = LocalServer(args.domain, config)
+    await server.start()
+    print('🚀 Started local mailserver on port %d, webhook receiver at %s' % (server.port, webhook_url))
+
+    mailboxes = ['bench-wh%d@%s' % (i, args.domain) for i in range(args.mailboxes)]
+    if not args.global_webhook:
+        for mailbox in mailboxes:
+            write_webhook_config(server.data_dir, mailbox, webhook_url, args.max_attempts, args.backoff, args.secret)
+    templates = {mailbox: build_mailbox_message(mailbox, args.body_size) for mailbox in mailboxes}
+    weights = {mailbox: 1 for mailbox in mailboxes}
+
+    # when the end of DATA was sent for each message
+    data_sent = {}
+
+    def on_sent(seq, mailbox, rcpts, accept):
+        data_sent[seq] = time.perf_counter() - accept
+
+    try:
+        print('📤 Sending %d messages to %d mailboxes with %d concurrent clients...'
+              % (args.messages, args.mailboxes, args.concurrency))
+        started = time.perf_counter()
+        results = await run_load('127.0.0.1', server.port, templates, weights, args.messages, args.concurrency,
+                                 args.messages_per_connection, on_sent)
+        smtp_done = time.perf_counter()
+
+        # retries may still be running on sessions that failed on the client side
+        deadline = time.perf_counter() + args.drain_timeout
+        # the global webhook is sent once without retries
+        max_attempts = 1 if args.global_webhook else args.max_attempts
+        while receiver.pending(data_sent, max_attempts) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+    finally:
+        server.stop(keep=args.keep)
+        await receiver.stop()
+
+    delivered = receiver.delivered
+    latencies = [delivered[seq] - data_sent[seq] for seq in delivered if seq in data_sent]
+    last_delivery = max(delivered.values()) if delivered else started
+    attempts = list(receiver.attempts.values())
+    retry_histogram = {}
+    for count in attempts:
+        retry_histogram[count - 1] = retry_histogram.get(count - 1, 0) + 1
+
+    summary = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'messages': args.messages,
+            'mailboxes': args.mailboxes,
+            'concurrency': args.concurrency,
+            'delay': args.delay,
+            'failure_rate': args.failure_rate,
+            'max_attempts': args.max_attempts,
+            'backoff': args.backoff,
+            'global_webhook': args.global_webhook,
+        },
+        'smtp_sent': len(results['latency']),
+        'smtp_failed': results['failed'],
+        'smtp_duration_s': smtp_done - started,
+        'smtp_accept_latency_ms': percentiles(results['accept']),
+        'delivered': len(delivered),
+        'undelivered': len(data_sent) - len(delivered),
+        'deliveries_per_s': len(delivered) / (last_delivery - started) if delivered else 0,
+        'webhook_latency_ms': percentiles(latencies),
+        'attempts': sum(attempts),
+        'failed_responses': receiver.failed_responses,
+        'retries': {str(k): v for k, v in sorted(retry_histogram.items())},
+    }
+
+    print('\n✅ %d/%d webhooks delivered (%d undelivered, %d SMTP failures)'
+          % (summary['delivered'], len(data_sent), summary['undelivered'], results['failed']))
+    print('   Deliveries/s:     %.1f' % summary['deliveries_per_s'])
+    if latencies:
+        lat = summary['webhook_latency_ms']
+        print('   DATA -> POST ms:  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (lat['p50'], lat['p90'], lat['p99'], lat['max']))
+    if results['accept']:
+        acc = summary['smtp_accept_latency_ms']
+        print('   SMTP accept ms:   p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (acc['p50'], acc['p90'], acc['p99'], acc['max']))
+    print('   Attempts:         %d (%d failed responses)' % (summary['attempts'], summary['failed_responses']))
+    for retries, count in sorted(retry_histogram.items()):
+        print('   %6d message(s) needed %d retr%s' % (count, retries, 'y' if retries == 1 else 'ies'))
+    for error, count in results['errors'].items():
+        print('   ❌ %dx %s' % (count, error))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print('\n💾 Results saved to %s' % args.output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Webhook delivery benchmark for OpenTrashmail')
+    parser.add_argument('--messages', '-n', type=int, default=500, help='number of messages to send (default: 500)')
+    parser.add_argument('--mailboxes', type=int, default=20, help='mailboxes with a webhook configured (default: 20)')
+    parser.add_argument('--concurrency', '-c', type=int, default=20, help='concurrent SMTP clients (default: 20)')
+    parser.add_argument('--messages-per-connection', type=int, default=1,
+                        help='reconnect after this many messages, 0 = never (default: 1)')
+    parser.add_argument('--body-size', type=int, default=2000, help='bytes of body text per message (default: 2000)')
+    parser.add_argument('--delay', type=float, default=0, help='seconds the receiver waits before answering')
+    parser.add_argument('--failure-rate', type=float, default=0, help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--max-attempts', type=int, default=3, help='retry_config.max_attempts (default: 3)')
+    parser.add_argument('--backoff', type=float, default=2, help='retry_config.backoff_multiplier (default: 2)')
+    parser.add_argument('--secret', help='secret_key for signed webhooks')
+    parser.add_argument('--global-webhook', action='store_true',
+                        help='use the global WEBHOOK_URL instead of per-mailbox webhook.json')
+    parser.add_argument('--drain-timeout', type=float, default=10,
+                        help='seconds to wait for outstanding deliveries after sending (default: 10)')
+    parser.add_argument('--domain', default='bench.test', help='recipient domain (default: bench.test)')
+    parser.add_argument('--output', '-o', help='save results as JSON')
+    parser.add_argument('--keep', action='store_true', help='keep the temp dir of the local server')
+
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print('\n👋 Aborted')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Convert the data/ directory between the flat and the sharded layout
+
+    flat     data/<email>/
+    sharded  data/<md5[0:2]>/<md5[2:4]>/<email>/
+
+Mailboxes are moved one by one with rename(), so the mailserver and the web UI
+can keep running: both look in the other layout until a mailbox has been moved,
+and the mailserver moves a mailbox itself when it receives mail for it.
+
+Set DATA_LAYOUT in config.ini first (it is picked up without a restart), then run:
+
+    python3 tools/migrate_data_layout.py --to sharded
+"""
+
+import argparse
+import configparser
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'python'))
+
+from storage import LAYOUTS, iter_mailboxes, mailbox_path, move_mailbox, prune_shards
+
+
+def configured_layout(path):
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read(path)
+    if config.has_option('GENERAL', 'DATA_LAYOUT'):
+        return (config.get('GENERAL', 'DATA_LAYOUT') or 'flat').strip().lower()
+    return 'flat'
+
+
+def main():
+    layout = configured_layout(args.config)
+    if layout != args.to:
+        print('⚠️  DATA_LAYOUT in %s is "%s". The mailserver would move mailboxes back as mail arrives.' % (args.config, layout))
+        if not args.force and not args.dry_run:
+            print('❌ Set DATA_LAYOUT=%s first or pass --force' % args.to)
+            sys.exit(1)
+
+    moved = 0
+    skipped = 0
+    started = time.time()
+    # collect first, moving while scanning would visit mailboxes twice
+    mailboxes = list(iter_mailboxes(args.data_dir))
+    print('📊 %d mailboxes in %s' % (len(mailboxes), args.data_dir))
+
+    for email, path in mailboxes:
+        target = mailbox_path(email, args.to, args.data_dir)
+        if os.path.normpath(path) == os.path.normpath(target):
+            skipped += 1
+            continue
+        if args.dry_run:
+            print('   %s -> %s' % (path, target))
+        else:
+            move_mailbox(path, target)
+        moved += 1
+        if args.batch and moved % args.batch == 0:
+            print('   %d moved...' % moved)
+            if args.sleep:
+                time.sleep(args.sleep)
+
+    if not args.dry_run and args.to == 'flat':
+        prune_shards(args.data_dir)
+
+    print('✅ %s %d mailboxes to the %s layout in %.1fs (%d already there)'
+          % ('Would move' if args.dry_run else 'Moved', moved, args.to, time.time() - started, skipped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate data/ between the flat and sharded layouts')
+    parser.add_argument('--to', choices=LAYOUTS, required=True, help='target layout')
+    parser.add_argument('--data-dir', default=os.path.join(REPO_ROOT, 'data'), help='data directory (default: ./data)')
+    parser.add_argument('--config', default=os.path.join(REPO_ROOT, 'config.ini'), help='config.ini to check DATA_LAYOUT in')
+    parser.add_argument('--batch', type=int, default=1000, help='report progress every N mailboxes (default: 1000)')
+    parser.add_argument('--sleep', type=float, default=0, help='seconds to pause after each batch to limit I/O')
+    parser.add_argument('--dry-run', action='store_true', help='only print what would be moved')
+    parser.add_argument('--force', action='store_true', help='migrate even if DATA_LAYOUT is set differently')
+
+    args = parser.parse_args()
+    main()
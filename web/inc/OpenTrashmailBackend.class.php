@@ -74,6 +74,8 @@ class OpenTrashmailBackend{
                 http_response_code(404);
                 exit('Error: Email not found');
             }
+            if($feed = getFeedFile($email,'rss.xml'))
+                serveFeedFile($feed,'application/rss+xml; charset=UTF8');
             return $this->renderTemplate('rss.xml',[
                 'email'=>$email,
                 'emaildata'=>getEmailsOfEmail($email),
@@ -88,7 +90,13 @@ class OpenTrashmailBackend{
             if($this->url[1]=='listaccounts')
             {
                 if($this->settings['SHOW_ACCOUNT_LIST'] && (($this->settings['ADMIN_PASSWORD'] != "" && $_REQUEST['password']==$this->settings['ADMIN_PASSWORD'])|| !$this->settings['ADMIN_PASSWORD']))
-                    return json_encode(listEmailAdresses());
+                {
+                    // plain list of addresses unless a page or filter is requested
+                    if(!isset($_REQUEST['page']) && !isset($_REQUEST['limit']) && !isset($_REQUEST['prefix']) && !isset($_REQUEST['domain']))
+                        return json_encode(listEmailAdresses());
+                    $query = $this->accountQuery();
+                    return json_encode(listMailboxes($query['prefix'],$query['domain'],$query['page'],$query['limit']));
+                }
                 else exit(json_encode(['error'=>'403 Forbidden']));
             }
             $email = $this->url[1];
@@ -112,6 +120,8 @@ class OpenTrashmailBackend{
                 else
                     return json_encode(getEmail($email,$id));
             }
+            else if($email!=$this->settings['ADMIN'] && ($feed = getFeedFile($email,'list.json')))
+                serveFeedFile($feed,'application/json; charset=UTF8');
             else
                 return json_encode(getEmailsOfEmail($email,true,true));
         }
@@ -126,17 +136,33 @@ class OpenTrashmailBackend{
         $path = getDirForEmail($email);
         if(is_dir($path))
             delTree($path);
+        registryExec('DELETE FROM mailboxes WHERE email = ?',[$email]);
+        registryExec('DELETE FROM messages WHERE email = ?',[$email]);
+        registryExec('DELETE FROM rendered WHERE email = ?',[$email]);
     }
 
     function listAccounts()
     {
-        $accounts = listEmailAdresses();
+        $query = $this->accountQuery();
+        $accounts = listMailboxes($query['prefix'],$query['domain'],$query['page'],$query['limit']);
         return $this->renderTemplate('account-list.html',[
-            'emails'=>$accounts,
+            'accounts'=>$accounts,
+            'query'=>$query,
             'dateformat'=>$this->settings['DATEFORMAT']
         ]);
     }
 
+    // ?prefix=&domain=&page=&limit= for the account list
+    function accountQuery()
+    {
+        return [
+            'prefix'=>strtolower(trim($_REQUEST['prefix']?:'')),
+            'domain'=>strtolower(trim($_REQUEST['domain']?:'')),
+            'page'=>max(1,intval($_REQUEST['page']?:1)),
+            'limit'=>min(500,max(1,intval($_REQUEST['limit']?:50))),
+        ];
+    }
+
     function deleteMail($email,$id)
     {
         if(!filter_var($email, FILTER_VALIDATE_EMAIL))
@@ -157,9 +183,16 @@ class OpenTrashmailBackend{
             return $this->error('Invalid id');
         else if(!emailIDExists($email,$id))
             return $this->error('Email not found');
+        if($htmlbody && ($file = getRenderedHtml($email,$id)))
+        {
+            header('Content-Type: text/html; charset=utf-8');
+            header('Content-Length: ' . filesize($file));
+            readfile($file);
+            exit;
+        }
         $emaildata = getEmail($email,$id);
         if($htmlbody)
-            exit($emaildata['parsed']['htmlbody']);
+            exit(removeScriptsFromHtml($emaildata['parsed']['htmlbody']));
         header('Content-Type: text/plain');
         echo $emaildata['raw'];
         exit;
@@ -207,12 +240,18 @@ class OpenTrashmailBackend{
     {
         if(!filter_var($email, FILTER_VALIDATE_EMAIL))
             return $this->error('Invalid email address');
-        $emails = getEmailsOfEmail($email);
+        $isadmin = ($this->settings['ADMIN']==$email);
+        // the admin view pages through the newest mails of all mailboxes
+        $page = $isadmin?max(1,intval($_REQUEST['page'])):1;
+        $emails = getEmailsOfEmail($email,false,false,$page);
         //var_dump($emails);
         return $this->renderTemplate('email-table.html',[
-            'isadmin'=>($this->settings['ADMIN']==$email),
+            'isadmin'=>$isadmin,
             'email'=>$email,
             'emails'=>$emails,
+            'page'=>$page,
+            // the mailserver pushes new mail on /events/, EventSource can't send the password
+            'liveupdates'=>($this->settings['READAPI_PORT']>0 && !$this->settings['PASSWORD']),
             'dateformat'=>$this->settings['DATEFORMAT']
         ]);
     }
@@ -1,8 +1,38 @@
 <?php
 
+// Mailbox directories, see python/storage.py
+//   flat     data/<email>/
+//   sharded  data/<md5[0:2]>/<md5[2:4]>/<email>/
+// While a tree is being migrated a mailbox can still be in the other layout
+function getDataLayout()
+{
+    static $layout = null;
+    if($layout===null)
+    {
+        $settings = loadSettings();
+        $layout = ($settings && strtolower(trim($settings['DATA_LAYOUT']))=='sharded')?'sharded':'flat';
+    }
+    return $layout;
+}
+
+function getMailboxPath($email,$layout)
+{
+    $root = ROOT.DS.'..'.DS.'data';
+    if($layout=='sharded')
+    {
+        $hash = md5($email);
+        return $root.DS.substr($hash,0,2).DS.substr($hash,2,2).DS.$email;
+    }
+    return $root.DS.$email;
+}
+
 function getDirForEmail($email)
 {
-    return realpath(ROOT.DS.'..'.DS.'data'.DS.$email);
+    $layout = getDataLayout();
+    $path = realpath(getMailboxPath($email,$layout));
+    if($path===false)
+        $path = realpath(getMailboxPath($email,($layout=='sharded')?'flat':'sharded'));
+    return $path;
 }
 
 function startsWith($haystack, $needle)
@@ -33,77 +63,63 @@ function getRawEmail($email,$id)
     return $data['raw'];
 }
 
+// Milliseconds since the epoch a mail was received, from its id (see python/messageid.py).
+// Ids are ms*10000 + worker*100 + sequence, older mails have the plain milliseconds
+function mailTime($id)
+{
+    $id = intval($id);
+    if($id < 10000000000000)
+        return $id;
+    return intdiv($id,10000);
+}
+
 function emailIDExists($email,$id)
 {
     return file_exists(getDirForEmail($email).DS.$id.'.json');
 }
 
-function getEmailsOfEmail($email,$includebody=false,$includeattachments=false)
+// For the ADMIN address $page and $limit select the newest mails across all mailboxes.
+// The listing fields come from the registry (or the 'listing' the mailserver stored with each mail),
+// message files are only opened for their body
+function getEmailsOfEmail($email,$includebody=false,$includeattachments=false,$page=1,$limit=100)
 {
     $o = [];
     $settings = loadSettings();
+    $isadmin = ($settings['ADMIN'] && $settings['ADMIN']==$email);
 
-    if($settings['ADMIN'] && $settings['ADMIN']==$email)
+    $messages = $isadmin?latestMessages(($page-1)*$limit,$limit):mailboxMessages($email);
+    if($messages!==false)
     {
-        $emails = listEmailAdresses();
-        if(count($emails)>0)
+        foreach($messages as $m)
         {
-            foreach($emails as $email)
-            {
-                if ($handle = opendir(getDirForEmail($email))) {
-                    while (false !== ($entry = readdir($handle))) {
-                        if (endsWith($entry,'.json')) {
-                            $time = substr($entry,0,-5);
-                            $json = json_decode(file_get_contents(getDirForEmail($email).DS.$entry),true);
-                            $o[$time] = array(
-                                'email'=>$email,'id'=>$time,
-                                'from'=>$json['parsed']['from'],
-                                'subject'=>$json['parsed']['subject'],
-                                'md5'=>md5($time.$json['raw']),
-                                'maillen'=>strlen($json['raw'])
-                            );
-                            if($includebody==true)
-                                $o[$time]['body'] = $json['parsed']['body'];
-                                if($includeattachments==true)
-                                {
-                                    $o[$time]['attachments'] = $json['parsed']['attachments'];
-                                    //add url to attachments
-                                    foreach($o[$time]['attachments'] as $k=>$v)
-                                        $o[$time]['attachments'][$k] = $settings['URL'].'/api/attachment/'.$email.'/'. $v;
-                                }
-                        }
-                    }
-                    closedir($handle);
-                }
-            }
+            $time = (string)$m['id'];
+            $o[$time] = listingEntry($m['email'],$time,$m['sender'],$m['subject'],$m);
+            if($includebody==true && ($json = json_decode(file_get_contents(getDirForEmail($m['email']).DS.$time.'.json'),true)))
+                addEmailBody($o[$time],$json,$includeattachments,$settings['URL']);
         }
     }
     else
     {
-        if ($handle = opendir(getDirForEmail($email))) {
-            while (false !== ($entry = readdir($handle))) {
-                if (endsWith($entry,'.json')) {
-                    $time = substr($entry,0,-5);
-                    $json = json_decode(file_get_contents(getDirForEmail($email).DS.$entry),true);
-                    $o[$time] = array(
-                                        'email'=>$email,
-                                        'id'=>$time,
-                                        'from'=>$json['parsed']['from'],
-                                        'subject'=>$json['parsed']['subject'],
-                                        'md5'=>md5($time.$json['raw']),'maillen'=>strlen($json['raw'])
-                                    );
-                                    if($includebody==true)
-                                        $o[$time]['body'] = $json['parsed']['body'];
-                                    if($includeattachments==true)
-                                    {
-                                        $o[$time]['attachments'] = $json['parsed']['attachments'];
-                                        //add url to attachments
-                                        foreach($o[$time]['attachments'] as $k=>$v)
-                                            $o[$time]['attachments'][$k] = $settings['URL'].'/api/attachment/'.$email.'/'. $v;
-                                    }
-                }                   
+        $emails = $isadmin?listEmailAdresses():[$email];
+        foreach($emails as $email)
+        {
+            if ($handle = opendir(getDirForEmail($email))) {
+                while (false !== ($entry = readdir($handle))) {
+                    if (endsWith($entry,'.json')) {
+                        $time = substr($entry,0,-5);
+                        $json = json_decode(file_get_contents(getDirForEmail($email).DS.$entry),true);
+                        $o[$time] = listingEntry($email,$time,$json['parsed']['from'],$json['parsed']['subject'],emailListing($time,$json));
+                        if($includebody==true)
+                            addEmailBody($o[$time],$json,$includeattachments,$settings['URL']);
+                    }
+                }
+                closedir($handle);
             }
-            closedir($handle);
+        }
+        if($isadmin)
+        {
+            krsort($o);
+            $o = array_slice($o,($page-1)*$limit,$limit,true);
         }
     }
 
@@ -113,18 +129,176 @@ function getEmailsOfEmail($email,$includebody=false,$includeattachments=false)
     return $o;
 }
 
+function listingEntry($email,$id,$from,$subject,$listing)
+{
+    return array(
+        'email'=>$email,'id'=>$id,
+        'from'=>$from,
+        'subject'=>$subject,
+        'md5'=>$listing['md5'],
+        'maillen'=>intval(isset($listing['maillen'])?$listing['maillen']:$listing['size']),
+        'preview'=>$listing['preview'],
+        'attachment_count'=>intval($listing['attachment_count'])
+    );
+}
+
+// The listing fields the mailserver stored with a mail (python/listing.py), computed for mails stored before
+function emailListing($id,$json)
+{
+    if(isset($json['listing']) && is_array($json['listing']))
+        return $json['listing'];
+    $text = trim($json['parsed']['body'])!==''?$json['parsed']['body']:html_entity_decode(strip_tags(preg_replace('/<(script|style|head|title)\b.*?<\/\1>/is',' ',$json['parsed']['htmlbody'])),ENT_QUOTES|ENT_HTML5,'UTF-8');
+    $text = trim(preg_replace('/\s+/u',' ',$text));
+    if(mb_strlen($text)>200)
+        $text = rtrim(mb_substr($text,0,199))."\u{2026}";
+    return array(
+        'md5'=>md5($id.$json['raw']),
+        'maillen'=>strlen($json['raw']),
+        'preview'=>$text,
+        'attachment_count'=>count($json['parsed']['attachments'])
+    );
+}
+
+function addEmailBody(&$entry,$json,$includeattachments,$url)
+{
+    $entry['body'] = $json['parsed']['body'];
+    if($includeattachments==true)
+    {
+        $entry['attachments'] = $json['parsed']['attachments'];
+        //add url to attachments
+        foreach($entry['attachments'] as $k=>$v)
+            $entry['attachments'][$k] = $url.'/api/attachment/'.$entry['email'].'/'. $v;
+    }
+}
+
 function listEmailAdresses()
 {
     $o = array();
-    if ($handle = opendir(ROOT.DS.'..'.DS.'data'.DS)) {
+    $root = ROOT.DS.'..'.DS.'data'.DS;
+    if ($handle = opendir($root)) {
         while (false !== ($entry = readdir($handle))) {
             if(filter_var($entry, FILTER_VALIDATE_EMAIL))
                 $o[] = $entry;
+            else if(preg_match('/^[0-9a-f]{2}$/',$entry) && is_dir($root.$entry))
+            {
+                // sharded layout: data/ab/cd/<email>
+                foreach(glob($root.$entry.DS.'[0-9a-f][0-9a-f]'.DS.'*',GLOB_ONLYDIR) as $dir)
+                    if(filter_var(basename($dir), FILTER_VALIDATE_EMAIL))
+                        $o[] = basename($dir);
+            }
         }
         closedir($handle);
     }
 
-    return $o;
+    return array_values(array_unique($o));
+}
+
+// data/registry.sqlite is kept up to date by the mailserver (python/registry.py).
+// false if it doesn't exist yet or PDO sqlite isn't available
+function getRegistry()
+{
+    static $db = null;
+    if($db!==null)
+        return $db;
+    $db = false;
+    $path = ROOT.DS.'..'.DS.'data'.DS.'registry.sqlite';
+    if(file_exists($path) && class_exists('PDO') && in_array('sqlite',PDO::getAvailableDrivers()))
+    {
+        try{
+            $db = new PDO('sqlite:'.$path);
+            $db->setAttribute(PDO::ATTR_ERRMODE, PDO::ERRMODE_EXCEPTION);
+            $db->exec('PRAGMA busy_timeout=5000');
+        } catch(PDOException $e) {
+            $db = false;
+        }
+    }
+    return $db;
+}
+
+function registryExec($sql,$params=[])
+{
+    $db = getRegistry();
+    if(!$db)
+        return false;
+    try{
+        return $db->prepare($sql)->execute($params);
+    } catch(PDOException $e) {
+        return false;
+    }
+}
+
+// Newest first across all mailboxes from the messages index, false if there is no registry
+function latestMessages($offset=0,$limit=100)
+{
+    $db = getRegistry();
+    if(!$db)
+        return false;
+    try{
+        $stmt = $db->prepare('SELECT email,id,sender,subject,size,received,md5,preview,attachment_count FROM messages ORDER BY received DESC, id DESC LIMIT '.intval($limit).' OFFSET '.intval($offset));
+        $stmt->execute();
+        return $stmt->fetchAll(PDO::FETCH_ASSOC);
+    } catch(PDOException $e) {
+        return false;
+    }
+}
+
+// The messages of one mailbox with their listing fields, false if there is no registry
+function mailboxMessages($email)
+{
+    $db = getRegistry();
+    if(!$db)
+        return false;
+    try{
+        $stmt = $db->prepare('SELECT email,id,sender,subject,size,received,md5,preview,attachment_count FROM messages WHERE email = ? ORDER BY id');
+        $stmt->execute([$email]);
+        return $stmt->fetchAll(PDO::FETCH_ASSOC);
+    } catch(PDOException $e) {
+        return false;
+    }
+}
+
+// One page of mailboxes ordered by address, optionally filtered by address prefix and domain.
+// Returns ['total'=>..,'page'=>..,'limit'=>..,'mailboxes'=>[['email'=>..,'messages'=>..,..],..]]
+function listMailboxes($prefix='',$domain='',$page=1,$limit=50)
+{
+    $offset = ($page-1)*$limit;
+    $db = getRegistry();
+    if($db)
+    {
+        $where = [];
+        $params = [];
+        if($prefix!=='')
+        {
+            $where[] = 'email >= ? AND email < ?';
+            $params[] = $prefix;
+            $params[] = $prefix."\u{FFFF}";
+        }
+        if($domain!=='')
+        {
+            $where[] = 'domain = ?';
+            $params[] = $domain;
+        }
+        $where = (count($where)>0)?' WHERE '.implode(' AND ',$where):'';
+        try{
+            $stmt = $db->prepare('SELECT COUNT(*) FROM mailboxes'.$where);
+            $stmt->execute($params);
+            $total = intval($stmt->fetchColumn());
+            $stmt = $db->prepare('SELECT email,domain,messages,bytes,attachment_bytes,first_received,last_received,webhook_enabled FROM mailboxes'.$where.' ORDER BY email LIMIT '.intval($limit).' OFFSET '.intval($offset));
+            $stmt->execute($params);
+            return ['total'=>$total,'page'=>$page,'limit'=>$limit,'mailboxes'=>$stmt->fetchAll(PDO::FETCH_ASSOC)];
+        } catch(PDOException $e) {
+            // fall through to scanning data/
+        }
+    }
+
+    $emails = array_filter(listEmailAdresses(),function($email) use ($prefix,$domain){
+        return startsWith($email,$prefix) && ($domain==='' || endsWith($email,'@'.$domain));
+    });
+    sort($emails);
+    $mailboxes = [];
+    foreach(array_slice($emails,$offset,$limit) as $email)
+        $mailboxes[] = ['email'=>$email,'domain'=>substr($email,strrpos($email,'@')+1),'messages'=>countEmailsOfAddress($email)];
+    return ['total'=>count($emails),'page'=>$page,'limit'=>$limit,'mailboxes'=>$mailboxes];
 }
 
 function attachmentExists($email,$id,$attachment=false)
@@ -146,9 +320,67 @@ function deleteEmail($email,$id)
 {
     $dir = getDirForEmail($email);
     $attachments = listAttachmentsOfMailID($email,$id);
+    $attachmentbytes = 0;
     foreach($attachments as $attachment)
+    {
+        $attachmentbytes += filesize($dir.DS.'attachments'.DS.$attachment);
         unlink($dir.DS.'attachments'.DS.$attachment);
-    return unlink($dir.DS.$id.'.json');
+    }
+    $bytes = filesize($dir.DS.$id.'.json');
+    $deleted = unlink($dir.DS.$id.'.json');
+    if($deleted)
+    {
+        // the mailserver rebuilds the feeds on the next mail, until then they're rendered here
+        if(is_dir($dir.DS.'feed'))
+            delTree($dir.DS.'feed');
+        registryExec('UPDATE mailboxes SET messages = MAX(messages - 1, 0), bytes = MAX(bytes - ?, 0), attachment_bytes = MAX(attachment_bytes - ?, 0) WHERE email = ?',[$bytes,$attachmentbytes,$email]);
+        registryExec('DELETE FROM messages WHERE email = ? AND id = ?',[$email,$id]);
+        if(file_exists($dir.DS.$id.'.html'))
+            unlink($dir.DS.$id.'.html');
+        registryExec('DELETE FROM rendered WHERE email = ? AND id = ?',[$email,$id]);
+    }
+    return $deleted;
+}
+
+// Feed documents the mailserver keeps in data/<email>/feed/ (see python/feeds.py), false if there is none
+function getFeedFile($email,$name)
+{
+    $file = getDirForEmail($email).DS.'feed'.DS.$name;
+    return file_exists($file)?$file:false;
+}
+
+// The HTML body the mailserver rendered for /api/raw-html (python/render.py), false if it isn't cached.
+// Serving it counts as a use for evicting the least recently used ones
+function getRenderedHtml($email,$id)
+{
+    $file = getDirForEmail($email).DS.$id.'.html';
+    if(!file_exists($file))
+        return false;
+    registryExec('UPDATE rendered SET used = ? WHERE email = ? AND id = ?',[intval(microtime(true)*1000),$email,$id]);
+    return $file;
+}
+
+// Sends a feed document with Last-Modified, or a 304 if the client has it already
+function serveFeedFile($file,$type)
+{
+    $mtime = filemtime($file);
+    header('Content-Type: '.$type);
+    header('Last-Modified: '.gmdate('D, d M Y H:i:s', $mtime).' GMT');
+    header('Cache-Control: no-cache');
+    if(isset($_SERVER['HTTP_IF_MODIFIED_SINCE']) && strtotime($_SERVER['HTTP_IF_MODIFIED_SINCE']) >= $mtime)
+    {
+        http_response_code(304);
+        exit;
+    }
+    header('Content-Length: '.filesize($file));
+    readfile($file);
+    exit;
+}
+
+function registrySetWebhook($email,$enabled)
+{
+    return registryExec('INSERT INTO mailboxes (email, domain, webhook_enabled) VALUES (?, ?, ?) ON CONFLICT(email) DO UPDATE SET webhook_enabled = excluded.webhook_enabled',
+        [$email,substr($email,strrpos($email,'@')+1),$enabled?1:0]);
 }
 
 
@@ -336,7 +568,7 @@ function saveWebhookConfig($email, $config)
     
     $dir = getDirForEmail($email);
     if (!$dir) {
-        return false;
+        $dir = getMailboxPath($email,getDataLayout());
     }
     
     if (!is_dir($dir)) {
@@ -345,14 +577,19 @@ function saveWebhookConfig($email, $config)
         }
     }
     $webhookFile = $dir.DS.'webhook.json';
-    return file_put_contents($webhookFile, json_encode($config, JSON_PRETTY_PRINT)) !== false;
+    if(file_put_contents($webhookFile, json_encode($config, JSON_PRETTY_PRINT)) === false)
+        return false;
+    registrySetWebhook($email,$config['enabled']);
+    return true;
 }
 
 function deleteWebhookConfig($email)
 {
     $webhookFile = getDirForEmail($email).DS.'webhook.json';
     if (file_exists($webhookFile)) {
-        return unlink($webhookFile);
+        if(!unlink($webhookFile))
+            return false;
+        registrySetWebhook($email,false);
     }
     return true;
 }
\ No newline at end of file
@@ -1,24 +1,39 @@
+<div id="accountlist">
 <div>
-  <a role="button" class="outline" href="/json/listaccounts" target="_blank"><i class="fas fa-file-code"></i> JSON API</a>
+  <a role="button" class="outline" href="/json/listaccounts?page=<?= $query['page'] ?>&limit=<?= $query['limit'] ?>&prefix=<?= urlencode($query['prefix']) ?>&domain=<?= urlencode($query['domain']) ?>" target="_blank"><i class="fas fa-file-code"></i> JSON API</a>
 </div>
 
+<form hx-get="/api/listaccounts" hx-target="#accountlist" hx-swap="outerHTML">
+  <div class="grid">
+    <input type="text" name="prefix" placeholder="Address starts with" value="<?= escape($query['prefix']) ?>" />
+    <input type="text" name="domain" placeholder="Domain" value="<?= escape($query['domain']) ?>" />
+    <input type="hidden" name="limit" value="<?= $query['limit'] ?>" />
+    <input type="submit" value="Filter" />
+  </div>
+</form>
+
 <table>
   <thead>
     <tr>
       <th scope="col">Email Addess</th>
       <th>Emails in Inbox</th>
+      <th>Size</th>
+      <th>Last received</th>
       <th>Action</th>
     </tr>
   </thead>
   <tbody>
-    <?php foreach($emails as $email): ?>
+    <?php foreach($accounts['mailboxes'] as $i => $account): $email = $account['email']; ?>
         <tr>
             <td>
                 <a href="/address/<?= $email; ?>" hx-get="/api/address/<?= $email; ?>" hx-push-url="/address/<?= $email; ?>" hx-target="#main">
                     <?= escape($email) ?>
                 </a>
+                <?php if($account['webhook_enabled']): ?><i class="fas fa-plug" title="Webhook enabled"></i><?php endif; ?>
             </td>
-            <td><?= countEmailsOfAddress($email); ?></td>
+            <td><?= $account['messages']; ?></td>
+            <td><?= isset($account['bytes'])?round(($account['bytes']+$account['attachment_bytes'])/1024).' kB':'' ?></td>
+            <td id="last-td-<?= $i ?>"><?php if($account['last_received']): ?><script>document.getElementById('last-td-<?= $i ?>').innerHTML = moment.unix(parseInt(<?= $account['last_received'] ?>/1000)).format('<?= $dateformat; ?>');</script><?php endif; ?></td>
             <td>
             <a href="/address/<?= $email; ?>" hx-get="/api/address/<?= $email; ?>" hx-push-url="/address/<?= $email; ?>" hx-target="#main" role="button" >Show</a>
             <a href="#" role="button" hx-get="/api/deleteaccount/<?= $email ?>" hx-confirm="Are you sure to delete this account and all its emails?" hx-target="closest tr" hx-swap="outerHTML swap:1s">Delete</a>
@@ -26,4 +41,16 @@
         </tr>
     <?php endforeach; ?>
   </tbody>
-</table>
\ No newline at end of file
+</table>
+
+<?php $pages = max(1,ceil($accounts['total']/$accounts['limit'])); $params = '&limit='.$query['limit'].'&prefix='.urlencode($query['prefix']).'&domain='.urlencode($query['domain']); ?>
+<nav>
+  <ul>
+    <li><?= $accounts['total'] ?> accounts, page <?= $accounts['page'] ?> of <?= $pages ?></li>
+  </ul>
+  <ul>
+    <?php if($accounts['page']>1): ?><li><a href="#" hx-get="/api/listaccounts?page=<?= $accounts['page']-1 ?><?= $params ?>" hx-target="#accountlist" hx-swap="outerHTML">&laquo; Previous</a></li><?php endif; ?>
+    <?php if($accounts['page']<$pages): ?><li><a href="#" hx-get="/api/listaccounts?page=<?= $accounts['page']+1 ?><?= $params ?>" hx-target="#accountlist" hx-swap="outerHTML">Next &raquo;</a></li><?php endif; ?>
+  </ul>
+</nav>
+</div>
@@ -35,10 +35,13 @@
     <?php foreach($emails as $unixtime => $ed): ?>
         <tr>
             <th scope="row"><?= ++$i; ?></th>
-            <td id="date-td-<?= $i ?>"><script>document.getElementById('date-td-<?= $i ?>').innerHTML = moment.unix(parseInt(<?=$unixtime?>/1000)).format('<?= $dateformat; ?>');</script></td>
+            <td id="date-td-<?= $i ?>"><script>document.getElementById('date-td-<?= $i ?>').innerHTML = moment.unix(parseInt(<?= mailTime($unixtime) ?>/1000)).format('<?= $dateformat; ?>');</script></td>
             <td><?= escape($ed['from']) ?></td>
             <?php if($isadmin==true): ?><td><?= $ed['email'] ?></td><?php endif; ?>
-            <td><?= escape($ed['subject']) ?></td>
+            <td>
+              <?= escape($ed['subject']) ?><?php if(!empty($ed['attachment_count'])): ?> <i class="fas fa-paperclip" title="<?= $ed['attachment_count'] ?> attachment(s)"></i><?php endif; ?>
+              <?php if(!empty($ed['preview'])): ?><br/><small><?= escape($ed['preview']) ?></small><?php endif; ?>
+            </td>
             <td>
               <?php if($isadmin==true): ?>
                   <a href="/read/<?= $ed['email'] ?>/<?= $ed['id'] ?>" hx-get="/api/read/<?= $ed['email'] ?>/<?= $ed['id'] ?>" hx-push-url="/read/<?= $ed['email'] ?>/<?= $ed['id'] ?>" hx-target="#main" role="button">Open</a>
@@ -52,7 +55,32 @@
     <?php endforeach; ?>
 </table>
 
+<?php if($isadmin==true && ($page>1 || count($emails)>=100)): ?>
+<nav>
+  <ul>
+    <li>Page <?= $page ?></li>
+  </ul>
+  <ul>
+    <?php if($page>1): ?><li><a href="#" hx-get="/api/address/<?= $email ?>?page=<?= $page-1 ?>" hx-target="#main">&laquo; Newer</a></li><?php endif; ?>
+    <?php if(count($emails)>=100): ?><li><a href="#" hx-get="/api/address/<?= $email ?>?page=<?= $page+1 ?>" hx-target="#main">Older &raquo;</a></li><?php endif; ?>
+  </ul>
+</nav>
+<?php endif; ?>
+
 <script>history.pushState({urlpath:"/address/<?= $email ?>"}, "", "/address/<?= $email ?>");</script>
+<?php if($liveupdates): ?>
+<script>
+  // reload the list when mail arrives, until another page is opened
+  if(window.mailEvents) window.mailEvents.close();
+  window.mailEvents = new EventSource('/events/<?= $email ?>');
+  window.mailEvents.onmessage = function(){
+    if(location.pathname == '/address/<?= $email ?>')
+      htmx.ajax('GET', '/api/address/<?= $email ?>', '#main');
+    else
+      window.mailEvents.close();
+  };
+</script>
+<?php endif; ?>
 <script>
   function copyEmailToClipboard(){
     navigator.clipboard.writeText("<?= $email ?>");
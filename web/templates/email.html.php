@@ -8,7 +8,7 @@
 <article>
     <header>
         <p>Subject: <?= escape($emaildata['parsed']['subject']) ?></p>
-        <p>Received: <span id="date2-<?= $mailid ?>"><script>document.getElementById('date2-<?= $mailid ?>').innerHTML = moment.unix(parseInt(<?=$mailid?>/1000)).format('<?= $dateformat; ?>');</script></span></p>
+        <p>Received: <span id="date2-<?= $mailid ?>"><script>document.getElementById('date2-<?= $mailid ?>').innerHTML = moment.unix(parseInt(<?= mailTime($mailid) ?>/1000)).format('<?= $dateformat; ?>');</script></span></p>
 
         <p>
             Recipients:
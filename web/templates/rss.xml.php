@@ -13,11 +13,11 @@
   </image>
   <?php foreach ($emaildata as $id => $d): 
     $data = getEmail($email, $id);
-    $time = substr($id, 0, -3);
+    $time = intdiv(mailTime($id), 1000);
     $att_text = [];
     if (is_array($data['parsed']['attachments']))
         foreach ($data['parsed']['attachments'] as $filename) {
-            $filepath = ROOT . DS . '..' . DS . 'data' . DS . $email . DS . 'attachments' . DS . $filename;
+            $filepath = getDirForEmail($email) . DS . 'attachments' . DS . $filename;
             $parts = explode('-', $filename);
             $fid = $parts[0];
             $fn = $parts[1];